@@ -1,5 +1,8 @@
 '''Pagoda is yet another simulator framework!'''
 
+from . import archive
 from . import cooper
 from . import physics
+from . import results
+from . import shared
 from . import skeleton
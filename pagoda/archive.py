@@ -0,0 +1,302 @@
+'''Compact on-disk archives of simulated body trajectories.
+
+An archive stores the states of a fixed set of bodies (see
+:func:`pagoda.physics.World.get_state_array`) for a sequence of frames. Frames
+are grouped into chunks; each chunk is quantized to fixed precision,
+delta-encoded along time, byte-shuffled and compressed with zlib. An index of
+chunks is written at the end of the file, so that any window of frames can be
+read back by decompressing only the chunks that overlap the window.
+
+The file layout is::
+
+    MAGIC
+    chunk 0 | chunk 1 | ... | chunk N-1
+    footer (JSON metadata, including the chunk index)
+    footer length (8 bytes, little-endian) | MAGIC
+'''
+
+from __future__ import division
+
+import json
+import numpy as np
+import struct
+import zlib
+
+from . import physics
+
+MAGIC = b'PAGODA\x00\x01'
+
+# default quantization step for each field of a body state.
+DEFAULT_PRECISION = dict(
+    position=1e-5,
+    quaternion=1e-6,
+    linear_velocity=1e-4,
+    angular_velocity=1e-4,
+)
+
+
+def _steps(precision):
+    '''Build a per-column array of quantization steps.'''
+    steps = np.zeros(physics.STATE_WIDTH, float)
+    for name, cols in physics.STATE_FIELDS.items():
+        steps[cols] = precision[name]
+    return steps
+
+
+def encode(frames, steps, level=6):
+    '''Encode a chunk of body state frames as compressed bytes.
+
+    Parameters
+    ----------
+    frames : ndarray of shape (num-frames, num-bodies, 13)
+        Body state data to encode.
+    steps : ndarray of shape (13, )
+        Quantization step for each column of body state.
+    level : int, optional
+        zlib compression level. Defaults to 6.
+
+    Returns
+    -------
+    data : bytes
+        The compressed chunk.
+    '''
+    q = np.round(frames / steps).astype('<i4')
+    q[1:] -= q[:-1].copy()
+    # store the bytes of each int as separate planes; the high-order planes of
+    # small deltas are nearly all zero and compress extremely well.
+    planes = q.view(np.uint8).reshape(-1, 4).T
+    return zlib.compress(np.ascontiguousarray(planes).tobytes(), level)
+
+
+def decode(data, shape, steps):
+    '''Decode a chunk of compressed body state frames.
+
+    Parameters
+    ----------
+    data : bytes
+        A chunk created by :func:`encode`.
+    shape : tuple of int
+        The (num-frames, num-bodies, 13) shape of the encoded chunk.
+    steps : ndarray of shape (13, )
+        Quantization step for each column of body state.
+
+    Returns
+    -------
+    frames : ndarray of shape (num-frames, num-bodies, 13)
+        Decoded body state data.
+    '''
+    planes = np.frombuffer(zlib.decompress(data), np.uint8).reshape(4, -1)
+    q = np.ascontiguousarray(planes.T).view('<i4').reshape(shape)
+    return np.cumsum(q, axis=0, dtype=np.int64) * steps
+
+
+class Writer(object):
+    '''Write body states from a world into a chunked, compressed archive.
+
+    Parameters
+    ----------
+    filename : str
+        Name of the archive file to create.
+    world : :class:`pagoda.physics.World`
+        Record body states from this world.
+    bodies : sequence of :class:`pagoda.physics.Body`, optional
+        Record states for these bodies. Defaults to all bodies in the world.
+    chunk_frames : int, optional
+        Number of frames to store in each compressed chunk. Larger chunks
+        compress better but make reading small windows more expensive. Defaults
+        to 256.
+    precision : dict, optional
+        Quantization step for each state field. See ``DEFAULT_PRECISION``.
+    level : int, optional
+        zlib compression level. Defaults to 6.
+    '''
+
+    def __init__(self, filename, world, bodies=None, chunk_frames=256,
+                 precision=None, level=6):
+        self.world = world
+        self.bodies = list(world.bodies if bodies is None else bodies)
+        self.chunk_frames = chunk_frames
+        self.precision = dict(DEFAULT_PRECISION, **(precision or {}))
+        self.level = level
+
+        self._steps = _steps(self.precision)
+        self._buffer = np.zeros(
+            (chunk_frames, len(self.bodies), physics.STATE_WIDTH), float)
+        self._count = 0
+        self._index = []
+        self._num_frames = 0
+
+        self._handle = open(filename, 'wb')
+        self._handle.write(MAGIC)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def num_frames(self):
+        '''Number of frames appended to the archive so far.'''
+        return self._num_frames + self._count
+
+    def append(self, states=None):
+        '''Append one frame of body states to the archive.
+
+        Parameters
+        ----------
+        states : ndarray of shape (num-bodies, 13), optional
+            Body states to append. Defaults to the current states of our bodies
+            in the world.
+        '''
+        row = self._buffer[self._count]
+        if states is None:
+            self.world.get_state_array(self.bodies, out=row)
+        else:
+            row[:] = states
+        self._count += 1
+        if self._count == self.chunk_frames:
+            self.flush()
+
+    def flush(self):
+        '''Compress and write out any buffered frames.'''
+        if not self._count:
+            return
+        data = encode(self._buffer[:self._count], self._steps, self.level)
+        self._index.append(
+            (self._num_frames, self._count, self._handle.tell(), len(data)))
+        self._handle.write(data)
+        self._num_frames += self._count
+        self._count = 0
+
+    def close(self):
+        '''Flush buffered frames and write the archive index.'''
+        if self._handle is None:
+            return
+        self.flush()
+        footer = json.dumps(dict(
+            bodies=[b.name for b in self.bodies],
+            dt=self.world.dt,
+            precision=self.precision,
+            num_frames=self._num_frames,
+            index=self._index,
+        )).encode('utf-8')
+        self._handle.write(footer)
+        self._handle.write(struct.pack('<Q', len(footer)))
+        self._handle.write(MAGIC)
+        self._handle.close()
+        self._handle = None
+
+
+class Reader(object):
+    '''Read windows of body states from a trajectory archive.
+
+    Parameters
+    ----------
+    filename : str
+        Name of an archive file created by :class:`Writer`.
+
+    Attributes
+    ----------
+    bodies : list of str
+        Names of the bodies stored in the archive, in storage order.
+    dt : float
+        Time step of the world that was recorded.
+    num_frames : int
+        Total number of frames in the archive.
+    '''
+
+    def __init__(self, filename):
+        self._handle = open(filename, 'rb')
+        if self._handle.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{}: not a pagoda archive'.format(filename))
+        self._handle.seek(-8 - len(MAGIC), 2)
+        size, = struct.unpack('<Q', self._handle.read(8))
+        if self._handle.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{}: archive was not closed'.format(filename))
+        self._handle.seek(-8 - len(MAGIC) - size, 2)
+        meta = json.loads(self._handle.read(size).decode('utf-8'))
+
+        self.bodies = meta['bodies']
+        self.dt = meta['dt']
+        self.precision = meta['precision']
+        self.num_frames = meta['num_frames']
+
+        self._steps = _steps(self.precision)
+        self._index = np.array(meta['index'], np.int64).reshape((-1, 4))
+        self._cached = (None, None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.num_frames
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(self.num_frames)
+            return self.read(start, stop)[::step]
+        if idx < 0:
+            idx += self.num_frames
+        return self.read(idx, idx + 1)[0]
+
+    def close(self):
+        self._handle.close()
+
+    def _chunk(self, c):
+        '''Get the decoded frames for chunk number c.'''
+        if self._cached[0] != c:
+            start, count, offset, size = self._index[c]
+            self._handle.seek(offset)
+            frames = decode(self._handle.read(size),
+                            (count, len(self.bodies), physics.STATE_WIDTH),
+                            self._steps)
+            frames.flags.writeable = False
+            self._cached = (c, frames)
+        return self._cached[1]
+
+    def read(self, start=0, stop=None, field=None):
+        '''Read a window of frames from the archive.
+
+        Only the chunks overlapping the requested window are decompressed. If
+        the window falls within one chunk, the result is a read-only view of
+        the decoded chunk.
+
+        Parameters
+        ----------
+        start : int, optional
+            First frame to read. Defaults to 0.
+        stop : int, optional
+            Read frames up to, but not including, this one. Defaults to the end
+            of the archive.
+        field : str, optional
+            If given, return only this state field, e.g. "position" or
+            "quaternion". See ``pagoda.physics.STATE_FIELDS``.
+
+        Returns
+        -------
+        states : ndarray of shape (stop - start, num-bodies, ...)
+            Body states for the requested frames.
+        '''
+        if stop is None or stop > self.num_frames:
+            stop = self.num_frames
+        start = max(0, min(start, stop))
+        if not len(self._index):
+            states = np.zeros((0, len(self.bodies), physics.STATE_WIDTH))
+            return states if field is None else \
+                states[..., physics.STATE_FIELDS[field]]
+        starts = self._index[:, 0]
+        first = max(0, np.searchsorted(starts, start, 'right') - 1)
+        last = max(first, np.searchsorted(starts, stop, 'left') - 1)
+        parts = []
+        for c in range(first, last + 1):
+            offset = starts[c]
+            frames = self._chunk(c)
+            parts.append(frames[max(0, start - offset):stop - offset])
+        states = parts[0] if len(parts) == 1 else np.concatenate(parts)
+        if field is not None:
+            states = states[..., physics.STATE_FIELDS[field]]
+        return states
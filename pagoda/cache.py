@@ -0,0 +1,197 @@
+'''A content-addressed on-disk cache for arrays derived from data files.
+
+Entries in a :class:`Cache` are directories of ``.npy`` files plus a small JSON
+metadata file. Entries are identified by a key computed from the contents of
+the source files they were derived from, together with any parameters used to
+derive them, so changing either the data or the parameters results in a new
+entry. Arrays are memory-mapped when an entry is loaded, which makes loading
+nearly free and lets several processes share the same pages.
+
+The cache is bounded in size; when it grows too large, the least recently used
+entries are removed.
+'''
+
+from __future__ import division
+
+import hashlib
+import json
+import logging
+import numpy as np
+import os
+import shutil
+import tempfile
+import time
+
+
+def default_root():
+    '''Get the default cache directory.
+
+    This is the value of the ``PAGODA_CACHE`` environment variable, or
+    ``~/.cache/pagoda`` if that is not set.
+    '''
+    return os.environ.get('PAGODA_CACHE') or os.path.join(
+        os.path.expanduser('~'), '.cache', 'pagoda')
+
+
+class Cache(object):
+    '''A size-bounded, content-addressed cache of memory-mappable arrays.
+
+    Parameters
+    ----------
+    root : str, optional
+        Store cache entries in this directory. Defaults to
+        :func:`default_root`.
+    max_bytes : int, optional
+        Evict least recently used entries when the total size of the cache
+        exceeds this many bytes. Defaults to 4GB.
+    '''
+
+    def __init__(self, root=None, max_bytes=4 << 30):
+        self.root = root or default_root()
+        self.max_bytes = max_bytes
+        self._digests = {}
+        for path in (self.root, os.path.join(self.root, 'digests')):
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+    def digest(self, filename):
+        '''Compute a hash of the contents of a file.
+
+        Digests are remembered, keyed on the file's path, size and
+        modification time, so files are only read again when they change.
+
+        Parameters
+        ----------
+        filename : str
+            Name of the file to hash.
+
+        Returns
+        -------
+        digest : str
+            Hex digest of the file contents.
+        '''
+        path = os.path.abspath(filename)
+        st = os.stat(path)
+        stamp = [st.st_size, st.st_mtime]
+        memo = os.path.join(self.root, 'digests', hashlib.sha1(
+            path.encode('utf-8')).hexdigest() + '.json')
+        if path in self._digests and self._digests[path][0] == stamp:
+            return self._digests[path][1]
+        if os.path.exists(memo):
+            with open(memo) as handle:
+                saved = json.load(handle)
+            if saved['stamp'] == stamp:
+                self._digests[path] = stamp, saved['digest']
+                return saved['digest']
+        sha = hashlib.sha1()
+        with open(path, 'rb') as handle:
+            for block in iter(lambda: handle.read(1 << 20), b''):
+                sha.update(block)
+        digest = sha.hexdigest()
+        self._digests[path] = stamp, digest
+        with open(memo, 'w') as handle:
+            json.dump(dict(stamp=stamp, digest=digest), handle)
+        return digest
+
+    def key(self, *parts):
+        '''Compute a cache key from file digests and parameters.
+
+        Parameters
+        ----------
+        parts : JSON-serializable values
+            Values that identify a cache entry, e.g. file digests (see
+            :func:`digest`) and the parameters used to process a file.
+
+        Returns
+        -------
+        key : str
+            A hex digest of the given values.
+        '''
+        text = json.dumps(parts, sort_keys=True, default=repr)
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def get(self, key, mmap_mode='c'):
+        '''Load a cache entry.
+
+        Parameters
+        ----------
+        key : str
+            The key for the entry to load.
+        mmap_mode : str, optional
+            Memory-map arrays with this mode. Defaults to "c"
+            (copy-on-write), which shares pages between processes until an
+            array is modified.
+
+        Returns
+        -------
+        arrays : dict
+            A mapping from names to arrays, or None if there is no such entry.
+        meta : dict
+            Metadata stored with the entry, or None if there is no such entry.
+        '''
+        path = os.path.join(self.root, key)
+        meta_path = os.path.join(path, 'meta.json')
+        if not os.path.exists(meta_path):
+            return None, None
+        with open(meta_path) as handle:
+            meta = json.load(handle)
+        arrays = {}
+        for name in meta.pop('_arrays'):
+            arrays[name] = np.load(os.path.join(path, name + '.npy'),
+                                   mmap_mode=mmap_mode)
+        now = time.time()
+        os.utime(path, (now, now))
+        return arrays, meta
+
+    def put(self, key, arrays, meta=None):
+        '''Store a cache entry.
+
+        Parameters
+        ----------
+        key : str
+            The key for the entry to store.
+        arrays : dict
+            A mapping from names to arrays to store.
+        meta : dict, optional
+            JSON-serializable metadata to store with the entry.
+        '''
+        path = os.path.join(self.root, key)
+        tmp = tempfile.mkdtemp(prefix='.tmp-', dir=self.root)
+        for name, value in arrays.items():
+            np.save(os.path.join(tmp, name + '.npy'), value)
+        meta = dict(meta or {}, _arrays=sorted(arrays))
+        with open(os.path.join(tmp, 'meta.json'), 'w') as handle:
+            json.dump(meta, handle)
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # another process stored this entry first.
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict()
+
+    def entries(self):
+        '''List cache entries as (last-used time, size, path) tuples.'''
+        entries = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if name.startswith('.') or name == 'digests' or \
+               not os.path.isdir(path):
+                continue
+            size = sum(os.path.getsize(os.path.join(path, f))
+                       for f in os.listdir(path))
+            entries.append((os.path.getmtime(path), size, path))
+        return sorted(entries)
+
+    def evict(self):
+        '''Remove least recently used entries until the cache is small enough.
+
+        The most recently used entry is never removed.
+        '''
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries[:-1]:
+            if total <= self.max_bytes:
+                break
+            logging.info('%s: evicting cache entry', path)
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
@@ -12,21 +12,30 @@ the package as a whole.
 
 from __future__ import division, print_function, absolute_import
 
+import collections
+import gzip
+import hashlib
+import itertools
+import json
 import logging
 import numpy as np
 import ode
+import os
 import re
+import timeit
 
 from . import physics
 from . import skeleton
 
 
-class Markers:
+class Markers(object):
     '''
     '''
 
     DEFAULT_CFM = 1e-6
     DEFAULT_ERP = 0.3
+    INVALID_VELOCITY = 1000
+    MAX_VELOCITY = 10
 
     def __init__(self, world):
         self.world = world
@@ -34,21 +43,47 @@ class Markers:
 
         self.bodies = {}
         self.joints = {}
+        self._joints = {}
         self.targets = {}
         self.offsets = {}
         self.channels = {}
 
         self.data = None
+        self.dt = None
         self.cfms = None
-        self.erp = Markers.DEFAULT_ERP
+        self.erps = None
+        self._erp = Markers.DEFAULT_ERP
+
+        # rules for deciding when markers can be attached; see
+        # compute_attachable.
+        self.attachable = None
+        self.max_velocity = Markers.MAX_VELOCITY
+        self.max_residual = None
+        self.filled_cfm = None
 
         # these arrays are derived from the data array.
         self.visibility = None
         self.positions = None
         self.velocities = None
+        self.accelerations = None
+
+        # marks samples that were filled in by fill_gaps.
+        self.filled = None
+
+        # distances replayed from cached inverse kinematics; see distances.
+        self._replayed = None
 
         self._frame_no = -1
 
+        # cached label order, and buffers for distances and forces.
+        self._labels = None, []
+        self._attach_count = 0
+        self._distances = None
+        self._forces = None
+        self._dx = None
+        self._dx_tm1 = None
+        self._dx_tm1_count = -1
+
     @property
     def num_frames(self):
         '''Return the number of frames of marker data.'''
@@ -59,10 +94,28 @@ class Markers:
         '''Return the number of markers in each frame of data.'''
         return self.data.shape[1]
 
+    @property
+    def erp(self):
+        '''The ERP value for marker joints.
+
+        Setting this value sets the ERP for all frames in :attr:`erps`.
+        '''
+        return self._erp
+
+    @erp.setter
+    def erp(self, erp):
+        self._erp = erp
+        if self.erps is not None:
+            self.erps[:] = erp
+
     @property
     def labels(self):
         '''Return the names of our marker labels in canonical order.'''
-        return sorted(self.channels, key=lambda c: self.channels[c])
+        channels, labels = self._labels
+        if channels is not self.channels or len(labels) != len(channels):
+            labels = sorted(self.channels, key=lambda c: self.channels[c])
+            self._labels = self.channels, labels
+        return labels
 
     def __iter__(self):
         return iter(self.data)
@@ -77,53 +130,95 @@ class Markers:
             return dict((c, i) for i, c in enumerate(labels))
         return labels or {}
 
-    def load_csv(self, filename, start_frame=10, max_frames=int(1e300)):
+    def load_csv(self, filename, start_frame=10, max_frames=int(1e300),
+                 end_frame=None, tolerance=0.01, sidecar=True, cache=None,
+                 resample=False):
         '''Load marker data from a CSV file.
 
-        The file will be imported using Pandas, which must be installed to use
-        this method. (``pip install pandas``)
-
         The first line of the CSV file will be used for header information. The
-        "time" column will be used as the index for the data frame. There must
-        be columns named 'markerAB-foo-x','markerAB-foo-y','markerAB-foo-z', and
-        'markerAB-foo-c' for marker 'foo' to be included in the model.
+        "time" column gives the time of each frame. There must be columns named
+        'markerAB-foo-x','markerAB-foo-y','markerAB-foo-z', and 'markerAB-foo-c'
+        for marker 'foo' to be included in the model. Missing values are
+        treated as dropouts.
+
+        The file is parsed in chunks straight into one preallocated array. By
+        default this array is a binary ``.npy`` "sidecar" file stored next to
+        the CSV file; later loads of the same (unchanged) CSV file memory-map
+        the sidecar (copy-on-write) instead of parsing any text.
+
+        The whole file is always parsed -- one pass counts the frames, and a
+        second pass parses them -- and ``start_frame``, ``end_frame`` and
+        ``max_frames`` are applied afterwards, so that one sidecar serves any
+        window of frames.
 
         Parameters
         ----------
         filename : str
-            Name of the CSV file to load.
+            Name of the CSV file to load. Files ending in ".gz" are
+            decompressed on the fly.
+        start_frame : int, optional
+            Discard the first N frames. Defaults to 10.
+        max_frames : int, optional
+            Maximum number of frames to load. Defaults to loading all frames.
+        end_frame : int, optional
+            Stop loading before this frame. Defaults to the end of the file.
+        tolerance : float, optional
+            Raise ValueError if the frame rate in the file differs from the
+            frame rate of our world by more than this fraction, unless
+            ``resample`` is True. Defaults to 0.01.
+        sidecar : bool, optional
+            If True (the default), read and write a binary sidecar file.
+        cache : :class:`pagoda.cache.Cache`, optional
+            If given, look up processed marker data in this cache before
+            loading the file, and store processed data in the cache after
+            loading.
+        resample : bool, optional
+            If True, resample the marker data to the frame rate of our world;
+            see :func:`resample`. Defaults to False.
         '''
-        import pandas as pd
-
-        compression = None
-        if filename.endswith('.gz'):
-            compression = 'gzip'
-        df = pd.read_csv(filename, compression=compression).set_index('time').fillna(-1)
-
-        # make sure the data frame's time index matches our world.
-        assert self.world.dt == pd.Series(df.index).diff().mean()
-
-        markers = []
-        for c in df.columns:
-            m = re.match(r'^marker\d\d-(.*)-c$', c)
-            if m:
-                markers.append(m.group(1))
-        self.channels = self._map_labels_to_channels(markers)
-
-        cols = [c for c in df.columns if re.match(r'^marker\d\d-.*-[xyzc]$', c)]
-        self.data = df[cols].values.reshape((len(df), len(markers), 4))[start_frame:]
-        self.data[:, :, [1, 2]] = self.data[:, :, [2, 1]]
+        if cache is not None:
+            key, hit = self._load_cached(cache, filename, dict(
+                loader='csv', start_frame=start_frame, max_frames=max_frames,
+                end_frame=end_frame, resample=resample))
+            if hit:
+                return
+
+        labels, data, dt = _read_csv(filename, sidecar)
+
+        # make sure the time index in the file matches our world.
+        mismatch = abs(dt - self.world.dt) > tolerance * self.world.dt
+        if mismatch and not resample:
+            raise ValueError('{}: frame interval {} does not match world dt {}'
+                             .format(filename, dt, self.world.dt))
+
+        self.channels = self._map_labels_to_channels(labels)
+        stop = len(data) if end_frame is None else min(len(data), end_frame)
+        stop = int(min(stop, start_frame + max_frames))
+        self.data = data[start_frame:stop]
+        self.dt = dt
+        self.filled = None
+        self.cfms = self.erps = None
 
         logging.info('%s: loaded marker data %s', filename, self.data.shape)
-        self.process_data()
-        self.create_bodies()
+        if mismatch:
+            self.resample()
+        else:
+            self.process_data()
+        if cache is not None:
+            self._store_cached(cache, key)
 
-    def load_c3d(self, filename, start_frame=0, max_frames=int(1e300)):
+    def load_c3d(self, filename, start_frame=0, max_frames=int(1e300),
+                 end_frame=None, dtype=float, mmap=None, cache=None,
+                 resample=False):
         '''Load marker data from a C3D file.
 
         The file will be imported using the c3d module, which must be installed
         to use this method. (``pip install c3d``)
 
+        Frames are streamed from the file straight into one preallocated array,
+        and reading stops as soon as the requested window has been read, so
+        only the frames in the window are ever held in memory.
+
         Parameters
         ----------
         filename : str
@@ -132,7 +227,32 @@ class Markers:
             Discard the first N frames. Defaults to 0.
         max_frames : int, optional
             Maximum number of frames to load. Defaults to loading all frames.
+        end_frame : int, optional
+            Stop loading before this frame. Defaults to the end of the file.
+        dtype : numpy dtype, optional
+            Store marker data with this type; use float32 to halve the memory
+            needed for large captures. Defaults to float64.
+        mmap : str, optional
+            If given, store marker data in a memory-mapped ``.npy`` file with
+            this name instead of in memory.
+        cache : :class:`pagoda.cache.Cache`, optional
+            If given, look up processed marker data in this cache before
+            loading the file, and store processed data in the cache after
+            loading.
+        resample : bool, optional
+            If True, resample the marker data to the frame rate of our world;
+            see :func:`resample`. Otherwise a warning is logged if the frame
+            rates differ, and each frame of marker data will be played back
+            over one world step. Defaults to False.
         '''
+        if cache is not None:
+            key, hit = self._load_cached(cache, filename, dict(
+                loader='c3d', start_frame=start_frame, max_frames=max_frames,
+                end_frame=end_frame, dtype=np.dtype(dtype).str,
+                resample=resample))
+            if hit:
+                return
+
         import c3d
 
         with open(filename, 'rb') as handle:
@@ -140,19 +260,46 @@ class Markers:
 
             logging.info('world frame rate %s, marker frame rate %s',
                          1 / self.world.dt, reader.point_rate)
-
-            # set up a map from marker label to index in the data stream.
-            self.channels = self._map_labels_to_channels([
-                s.strip() for s in reader.point_labels])
-
-            # read the actual c3d data into a numpy array.
-            data = []
-            for i, (_, frame, _) in enumerate(reader.read_frames()):
-                if i >= start_frame:
-                    data.append(frame[:, [0, 1, 2, 4]])
-                if len(data) > max_frames:
-                    break
-            self.data = np.array(data)
+            self.dt = float(1 / reader.point_rate)
+            mismatch = abs(self.dt - self.world.dt) > 1e-3 * self.world.dt
+            if mismatch and not resample:
+                logging.warning('%s: marker frame rate %s differs from world '
+                                'frame rate %s', filename, reader.point_rate,
+                                1 / self.world.dt)
+
+            # set up a map from marker label to index in the data stream. the
+            # stream has one column per point in use, whatever the labels.
+            used = int(reader.point_used)
+            labels = [s.strip() for s in reader.point_labels[:used]]
+            self.channels = self._map_labels_to_channels(_unique_labels(
+                labels + [''] * (used - len(labels))))
+
+            first, last = reader.first_frame, reader.last_frame
+            if callable(first):  # older versions of the c3d module
+                first, last = first(), last()
+            stop = last - first + 1
+            if end_frame is not None:
+                stop = min(stop, end_frame)
+            stop = int(min(stop, start_frame + max_frames))
+            shape = (max(0, stop - start_frame), used, 4)
+            if mmap:
+                data = np.lib.format.open_memmap(mmap, 'w+', dtype, shape)
+            else:
+                data = np.empty(shape, dtype)
+
+            # read the actual c3d data into our array, one frame at a time.
+            count = 0
+            if shape[0] > 0:
+                for i, (_, frame, _) in enumerate(reader.read_frames(copy=False)):
+                    if i < start_frame:
+                        continue
+                    data[count] = frame[:, [0, 1, 2, 4]]
+                    count += 1
+                    if count == len(data):
+                        break
+            self.data = data[:count]
+            self.filled = None
+            self.cfms = self.erps = None
 
             # scale the data to meters -- mm is a very common C3D unit.
             if reader.get('POINT:UNITS').string_value.strip().lower() == 'mm':
@@ -160,29 +307,334 @@ class Markers:
                 self.data[:, :, :3] /= 1000.
 
         logging.info('%s: loaded marker data %s', filename, self.data.shape)
-        self.process_data()
-        self.create_bodies()
+        if mismatch and resample:
+            self.resample()
+        else:
+            self.process_data()
+        if cache is not None:
+            self._store_cached(cache, key)
+
+    def _load_cached(self, cache, filename, params):
+        '''Try to load processed marker data from a cache.
 
-    def process_data(self):
-        '''Process data to produce velocity and dropout information.'''
+        Parameters
+        ----------
+        cache : :class:`pagoda.cache.Cache`
+            The cache to look in.
+        filename : str
+            Name of the marker data file.
+        params : dict
+            Parameters used to load the file.
+
+        Returns
+        -------
+        key : str
+            The cache key for the file and parameters.
+        hit : bool
+            True iff marker data were loaded from the cache.
+        '''
+        key = cache.key('markers', cache.digest(filename), params, self.world.dt)
+        arrays, meta = cache.get(key)
+        if arrays is None:
+            return key, False
+        self.channels = self._map_labels_to_channels(meta['labels'])
+        self.data = arrays['data']
+        self.dt = meta.get('dt')
+        self.filled = None
+        self.cfms = self.erps = None
         self.visibility = self.data[:, :, 3]
         self.positions = self.data[:, :, :3]
-        self.velocities = np.zeros_like(self.positions) + 1000
-        for frame_no in range(1, len(self.data) - 1):
-            prev = self.data[frame_no - 1]
-            next = self.data[frame_no + 1]
-            for c in range(self.num_markers):
-                if -1 < prev[c, 3] < 100 and -1 < next[c, 3] < 100:
-                    self.velocities[frame_no, c] = (
-                        next[c, :3] - prev[c, :3]) / (2 * self.world.dt)
-        self.cfms = np.zeros_like(self.visibility) + self.DEFAULT_CFM
+        self.velocities = arrays['velocities']
+        self.accelerations = None
+        self.compute_attachable()
+        logging.info('%s: loaded cached marker data %s', filename, self.data.shape)
+        return key, True
+
+    def _store_cached(self, cache, key):
+        '''Store our processed marker data in a cache.'''
+        cache.put(key, dict(data=self.data, velocities=self.velocities),
+                  dict(labels=self.labels,
+                       dt=None if self.dt is None else float(self.dt)))
+
+    def digest(self):
+        '''Get a hash of our marker data and attachment configuration.
+
+        The hash covers the marker data and labels, the per-frame CFM, ERP and
+        attachable values (see :func:`compute_attachable`), and the skeleton
+        body and offset for each attached marker, so it changes whenever any
+        of these would change the result of following the markers.
+
+        Returns
+        -------
+        digest : str
+            Hex digest of the marker data and attachments.
+        '''
+        sha = hashlib.sha1()
+        for values in (self.data, self.cfms, self.erps, self.attachable):
+            if values is not None:
+                sha.update(np.ascontiguousarray(values))
+        attachments = sorted(
+            (label, target.name, np.round(self.offsets[label], 9).tolist())
+            for label, target in self.targets.items())
+        sha.update(json.dumps([self.labels, attachments]).encode('utf-8'))
+        return sha.hexdigest()
+
+    def process_data(self, estimator='central', accelerations=False, **kwargs):
+        '''Process data to produce velocity and dropout information.
+
+        A marker sample is considered valid when its visibility (residual)
+        value lies strictly between -1 and 100. Derivatives are only computed
+        from valid samples; frames where an estimate is not available are
+        filled with the value ``INVALID_VELOCITY`` (a large number that
+        prevents markers from being attached during those frames).
+
+        Parameters
+        ----------
+        estimator : str, optional
+            Method for estimating marker velocities:
+
+            - "central": central finite differences (the default),
+            - "savgol": a Savitzky-Golay filter; accepts ``window`` (number of
+              frames, odd; defaults to 7) and ``order`` (polynomial order,
+              defaults to 2) keyword arguments,
+            - "spline": a smoothing spline fit to each run of valid samples;
+              accepts a ``smoothing`` keyword argument (squared position error
+              allowed per sample, defaults to 1e-6).
+
+            The "savgol" and "spline" estimators require scipy.
+        accelerations : bool, optional
+            If True, also estimate marker accelerations and store them in
+            :attr:`accelerations`. Defaults to False.
+        '''
+        self.visibility = self.data[:, :, 3]
+        self.positions = self.data[:, :, :3]
+        valid = (-1 < self.visibility) & (self.visibility < 100)
+        estimate = ESTIMATORS[estimator]
+        # derivatives are per second, measured over the marker frame interval.
+        vel, acc = estimate(self.positions, valid, self.dt or self.world.dt,
+                            accelerations, **kwargs)
+        self.velocities = vel
+        self.accelerations = acc
+        self.compute_attachable()
+
+    def compute_attachable(self, **kwargs):
+        '''Decide, for every frame, which markers can be attached.
+
+        This computes the boolean :attr:`attachable` array of shape
+        (num-frames, num-markers), along with the per-frame :attr:`cfms` and
+        :attr:`erps` arrays used for marker joints. A marker is attachable in
+        a frame if its visibility is at least 0 (and at most
+        :attr:`max_residual`, if that is set) and the magnitude of its
+        velocity is at most :attr:`max_velocity`.
+
+        This is called automatically by :func:`process_data`; call it again
+        after changing the rules to update the arrays.
+
+        Values set in :attr:`cfms` and :attr:`erps` by the caller (e.g.
+        ``markers.cfms[:] = 1e-4``) are kept as long as the number of frames
+        and markers does not change, so they survive :func:`process_data` and
+        :func:`fill_gaps`, except that ``filled_cfm`` is applied again to
+        filled samples. Loading new marker data, or resampling to a different
+        number of frames, resets both arrays to ``DEFAULT_CFM`` and
+        :attr:`erp`, so overrides must be set again afterwards.
+
+        Keyword arguments set the corresponding attributes before computing
+        the arrays:
+
+        - ``max_velocity``: velocity threshold for attaching markers, in
+          meters per second. Defaults to ``MAX_VELOCITY``.
+        - ``max_residual``: largest visibility value of an attachable marker.
+          Defaults to None (no limit).
+        - ``filled_cfm``: CFM for samples filled in by :func:`fill_gaps`, e.g.
+          a larger value to make these attachments softer. Defaults to None,
+          which leaves the CFM of filled samples unchanged.
+        '''
+        for name, value in kwargs.items():
+            if name not in ('max_velocity', 'max_residual', 'filled_cfm'):
+                raise TypeError('unknown attachment rule {}'.format(name))
+            setattr(self, name, value)
+        speed = np.sqrt((self.velocities * self.velocities).sum(axis=-1))
+        ok = (self.visibility >= 0) & (speed <= self.max_velocity)
+        if self.max_residual is not None:
+            ok &= self.visibility <= self.max_residual
+        self.attachable = ok
+        shape = self.visibility.shape
+        if self.cfms is None or self.cfms.shape != shape:
+            self.cfms = np.full(shape, self.DEFAULT_CFM)
+        if self.erps is None or self.erps.shape != shape:
+            self.erps = np.full(shape, self._erp)
+        if self.filled_cfm is not None and self.filled is not None:
+            self.cfms[self.filled] = self.filled_cfm
+        logging.info('markers attachable in %.1f%% of samples',
+                     100 * ok.mean() if ok.size else 0)
+
+    def resample(self, rate=None, **kwargs):
+        '''Resample marker data to a different frame rate.
+
+        Marker positions and visibility values are linearly interpolated
+        between the two source frames that surround each target frame. A
+        resampled sample is only valid when both of these source samples are
+        valid (or when the target frame falls exactly on a valid source
+        frame); otherwise it is marked as a dropout, so interpolation never
+        bridges a gap in the source data.
+
+        After resampling, :func:`process_data` is called to recompute marker
+        velocities.
+
+        Parameters
+        ----------
+        rate : float, optional
+            Target frame rate, in Hz. Defaults to the frame rate of our world.
+
+        Additional keyword arguments are passed to :func:`process_data`.
+        '''
+        dt = 1 / rate if rate else self.world.dt
+        source = self.dt or self.world.dt
+        data = self.data
+        if abs(dt - source) > 1e-9 * source and len(data) > 1:
+            # positions of the target frames, in units of source frames.
+            t = np.arange(int((len(data) - 1) * source / dt + 1e-6) + 1)
+            t = t * (dt / source)
+            lo = np.minimum(t.astype(int), len(data) - 2)
+            frac = t - lo
+            frac[frac < 1e-6] = 0
+            frac[frac > 1 - 1e-6] = 1
+            vis = data[:, :, 3]
+            ok = (-1 < vis) & (vis < 100)
+            valid = (ok[lo] | (frac == 1)[:, None]) & \
+                (ok[lo + 1] | (frac == 0)[:, None])
+            frac = frac.astype(data.dtype)
+            f = frac[:, None, None]
+            data = (1 - f) * data[lo] + f * data[lo + 1]
+            data[:, :, 3][~valid] = -1
+            logging.info('resampled marker data from %.1f Hz to %.1f Hz: %s',
+                         1 / source, 1 / dt, data.shape)
+        self.data = data
+        self.dt = dt
+        self.filled = None
+        self.process_data(**kwargs)
+
+    def fill_gaps(self, max_gap=10, method='linear', clusters=True, **kwargs):
+        '''Fill short dropouts in the marker data.
+
+        Dropouts of at most ``max_gap`` frames are filled in two passes, each
+        computed for the whole trial at once:
+
+        1. If ``clusters`` is True, a missing marker is reconstructed from
+           other markers attached to the same skeleton body (see
+           :func:`load_attachments`). The rigid transform that best maps these
+           markers from the nearest frame where the missing marker was
+           visible to the current frame is applied to the missing marker.
+           This requires at least three other markers on the body to be
+           visible in both frames.
+        2. Remaining gaps with valid samples on both sides are interpolated
+           from the marker's own trajectory.
+
+        Filled samples are given a visibility value of 0, and are marked in
+        the boolean :attr:`filled` array so that they can be down-weighted
+        later on. Afterwards, :func:`process_data` is called to recompute
+        marker velocities.
+
+        Parameters
+        ----------
+        max_gap : int, optional
+            Only fill dropouts lasting at most this many frames. Defaults to
+            10.
+        method : str, optional
+            Interpolation method: "linear" (the default) or "cubic" (a cubic
+            Hermite spline matching the marker velocity at each end of the
+            gap).
+        clusters : bool, optional
+            If True (the default), fill gaps from co-segment markers before
+            interpolating.
+
+        Additional keyword arguments are passed to :func:`process_data`.
+        '''
+        # work on a copy of memory-mapped data, so that filling never changes
+        # a marker data file or sidecar.
+        if isinstance(self.data, np.memmap) or not self.data.flags.writeable:
+            self.data = np.array(self.data)
+        positions = self.data[:, :, :3]
+        visibility = self.data[:, :, 3]
+        valid = (-1 < visibility) & (visibility < 100)
+        before, after = _gap_bounds(valid)
+        filled = ~valid & (after - before - 1 <= max_gap) & \
+            ((before >= 0) | (after < len(valid)))
+        done = np.zeros_like(filled)
+
+        if clusters:
+            groups = {}
+            for label, body in self.targets.items():
+                groups.setdefault(body.name, []).append(self.channels[label])
+            for cols in groups.values():
+                if len(cols) < 4:
+                    continue
+                for i, col in enumerate(cols):
+                    frames = np.where(filled[:, col])[0]
+                    if not len(frames):
+                        continue
+                    # use the nearest frame where this marker was visible.
+                    lo, hi = before[frames, col], after[frames, col]
+                    ref = np.where(
+                        (lo >= 0) & ((frames - lo <= hi - frames) |
+                                     (hi >= len(valid))), lo, hi)
+                    w = valid[frames][:, cols] & valid[ref][:, cols]
+                    w[:, i] = False
+                    ok = w.sum(axis=1) >= 3
+                    frames, ref, w = frames[ok], ref[ok], w[ok]
+                    if not len(frames):
+                        continue
+                    rot, trans = _kabsch(positions[ref][:, cols],
+                                         positions[frames][:, cols], w)
+                    positions[frames, col] = trans + np.einsum(
+                        'nij,nj->ni', rot, positions[ref, col])
+                    done[frames, col] = True
+
+        todo = filled & ~done & (before >= 0) & (after < len(valid))
+        frames, cols = np.where(todo)
+        lo, hi = before[frames, cols], after[frames, cols]
+        p0, p1 = positions[lo, cols], positions[hi, cols]
+        span = (hi - lo)[:, None]
+        s = (frames - lo)[:, None] / span
+        if method == 'linear':
+            fill = p0 + s * (p1 - p0)
+        elif method == 'cubic':
+            # endpoint slopes (per frame), falling back to the gap's secant.
+            secant = (p1 - p0) / span
+            ok = (lo > 0) & valid[np.maximum(lo - 1, 0), cols]
+            m0 = np.where(ok[:, None],
+                          p0 - positions[np.maximum(lo - 1, 0), cols], secant)
+            last = len(valid) - 1
+            ok = (hi < last) & valid[np.minimum(hi + 1, last), cols]
+            m1 = np.where(ok[:, None],
+                          positions[np.minimum(hi + 1, last), cols] - p1, secant)
+            s2, s3 = s * s, s * s * s
+            fill = ((2 * s3 - 3 * s2 + 1) * p0 + (s3 - 2 * s2 + s) * span * m0 +
+                    (-2 * s3 + 3 * s2) * p1 + (s3 - s2) * span * m1)
+        else:
+            raise ValueError('unknown gap filling method {}'.format(method))
+        positions[frames, cols] = fill
+        done[frames, cols] = True
+
+        visibility[done] = 0
+        self.filled = done
+        logging.info('filled %d of %d missing marker samples',
+                     done.sum(), (~valid).sum())
+        self.process_data(**kwargs)
 
     def create_bodies(self):
-        '''Create physics bodies corresponding to each marker in our data.'''
+        '''Create physics bodies for each marker that has an attachment target.
+
+        Marker bodies are kinematic and do not collide with anything, so they
+        are kept out of the world's collision space and out of the world's
+        list of bodies; they are only reachable through :attr:`bodies`.
+        '''
+        self._clear_joints()
         self.bodies = {}
-        for label in self.channels:
-            body = self.world.create_body(
-                'sphere', name='marker:{}'.format(label), radius=0.02)
+        for label in self.targets:
+            body = physics.Body.build(
+                'sphere', 'marker:{}'.format(label), self.world,
+                collide=False, radius=0.02)
             body.is_kinematic = True
             body.color = 0.9, 0.1, 0.1, 0.5
             self.bodies[label] = body
@@ -205,6 +657,9 @@ class Markers:
         respectively) extent of the body's bounding box along the corresponding
         dimension.
 
+        A marker body is created for each marker that is attached to the
+        skeleton; see :func:`create_bodies`.
+
         Parameters
         ----------
         source : str or file-like
@@ -245,40 +700,86 @@ class Markers:
                 np.array(list(map(float, tokens))) * b.dimensions / 2
             logging.info('%s <--> %s, offset %s', label, b.name, o)
 
+        self.create_bodies()
+
+    def set_offsets(self, offsets):
+        '''Move the points where markers are attached to skeleton bodies.
+
+        Marker joints are rebuilt with the new offsets the next time markers
+        are attached.
+
+        Parameters
+        ----------
+        offsets : dict
+            A mapping from marker labels to new body-relative offsets, in the
+            same units as :attr:`offsets`. Markers that are not in the mapping
+            keep their current offsets.
+        '''
+        for label, offset in offsets.items():
+            self.offsets[label] = np.asarray(offset, float)
+        self._clear_joints()
+
+    def _clear_joints(self):
+        '''Destroy all of our marker joints.'''
+        self.jointgroup.empty()
+        self.joints = {}
+        self._joints = {}
+
+    def _create_joints(self):
+        '''Create one ball joint for each attached marker.
+
+        Joints are created once and then kept for the life of an attachment
+        configuration. Anchors are given relative to the marker and skeleton
+        bodies, so they follow the bodies without being reset each frame.
+        '''
+        self._clear_joints()
+        for label, target in self.targets.items():
+            joint = ode.BallJoint(self.world.ode_world, self.jointgroup)
+            joint.attach(self.bodies[label].ode_body, target.ode_body)
+            joint.setAnchor1Rel([0, 0, 0])
+            joint.setAnchor2Rel(self.offsets[label])
+            joint.name = label
+            joint.disable()
+            self._joints[label] = joint
+
     def detach(self):
         '''Detach all marker bodies from their associated skeleton bodies.'''
-        self.jointgroup.empty()
+        for joint in self.joints.values():
+            joint.disable()
         self.joints = {}
+        self._replayed = None
 
     def attach(self, frame_no):
         '''Attach marker bodies to the corresponding skeleton bodies.
 
-        Attachments are only made for markers that are not in a dropout state in
-        the given frame.
+        Attachments are only made for markers that are marked as attachable in
+        the given frame (see :func:`compute_attachable`); joints for other
+        markers are disabled.
 
         Parameters
         ----------
         frame_no : int
             The frame of data we will use for attaching marker bodies.
         '''
-        assert not self.joints
-        for label, j in self.channels.items():
-            target = self.targets.get(label)
-            if target is None:
-                continue
-            if self.visibility[frame_no, j] < 0:
+        if len(self._joints) != len(self.targets):
+            self._create_joints()
+        self._replayed = None
+        attachable = self.attachable[frame_no]
+        cfms = self.cfms[frame_no]
+        erps = self.erps[frame_no]
+        joints = {}
+        for label, joint in self._joints.items():
+            j = self.channels[label]
+            if not attachable[j]:
+                joint.disable()
                 continue
-            if np.linalg.norm(self.velocities[frame_no, j]) > 10:
-                continue
-            joint = ode.BallJoint(self.world.ode_world, self.jointgroup)
-            joint.attach(self.bodies[label].ode_body, target.ode_body)
-            joint.setAnchor1Rel([0, 0, 0])
-            joint.setAnchor2Rel(self.offsets[label])
-            joint.setParam(ode.ParamCFM, self.cfms[frame_no, j])
-            joint.setParam(ode.ParamERP, self.erp)
-            joint.name = label
-            self.joints[label] = joint
+            joint.setParam(ode.ParamCFM, cfms[j])
+            joint.setParam(ode.ParamERP, erps[j])
+            joint.enable()
+            joints[label] = joint
+        self.joints = joints
         self._frame_no = frame_no
+        self._attach_count += 1
 
     def reposition(self, frame_no):
         '''Reposition markers to a specific frame of data.
@@ -291,13 +792,20 @@ class Markers:
             In addition, linear velocities of the markers will be set according
             to the data as long as there are no dropouts in neighboring frames.
         '''
-        for label, j in self.channels.items():
-            body = self.bodies[label]
+        for label, body in self.bodies.items():
+            j = self.channels[label]
             body.position = self.positions[frame_no, j]
             body.linear_velocity = self.velocities[frame_no, j]
 
-    def distances(self):
-        '''Get a list of the distances between markers and their attachments.
+    def distances(self, out=None):
+        '''Get the distances between markers and their attachments.
+
+        Parameters
+        ----------
+        out : ndarray of shape (num-markers, 3), optional
+            Store distances in this array. By default, distances are stored in
+            a buffer that is reused (and overwritten) by later calls; copy the
+            result to keep it.
 
         Returns
         -------
@@ -305,13 +813,24 @@ class Markers:
             Array of distances for each marker joint in our attachment setup. If
             a marker does not currently have an associated joint (e.g. because
             it is not currently visible) this will contain NaN for that row.
+            While cached inverse kinematics are replayed (see
+            :func:`World.inverse_kinematics`), these are the stored distances
+            for the current frame.
         '''
-        distances = []
-        for label in self.labels:
-            joint = self.joints.get(label)
-            distances.append([np.nan, np.nan, np.nan] if joint is None else
-                             np.array(joint.getAnchor()) - joint.getAnchor2())
-        return np.array(distances)
+        if out is None:
+            if self._distances is None or \
+               len(self._distances) != len(self.channels):
+                self._distances = np.empty((len(self.channels), 3))
+            out = self._distances
+        if self._replayed is not None:
+            out[:] = self._replayed
+            return out
+        out.fill(np.nan)
+        for label, joint in self.joints.items():
+            row = out[self.channels[label]]
+            row[:] = joint.getAnchor()
+            row -= joint.getAnchor2()
+        return out
 
     def forces(self, dx_tm1=None):
         '''Return an array of the forces exerted by marker springs.
@@ -333,26 +852,369 @@ class Markers:
 
         Parameters
         ----------
-        dx_tm1 : ndarray
+        dx_tm1 : ndarray, optional
             An array of distances from markers to their attachment targets,
-            measured at the previous time step.
+            measured at the previous time step. By default, the distances
+            measured by the previous call to this method are used, if that call
+            was made during the previous time step.
 
         Returns
         -------
         F : ndarray
             An array of forces that the markers are exerting on the skeleton.
+            This is a buffer that is overwritten by later calls; copy the result
+            to keep it.
         '''
+        n = len(self.channels)
+        if self._forces is None or len(self._forces) != n:
+            self._forces = np.empty((n, 3))
+            self._dx = np.empty((n, 3))
+            self._dx_tm1 = np.empty((n, 3))
+            self._dx_tm1_count = -1
+        if dx_tm1 is None and self._dx_tm1_count == self._attach_count - 1:
+            dx_tm1 = self._dx_tm1
         cfm = self.cfms[self._frame_no][:, None]
-        kp = self.erp / (cfm * self.world.dt)
-        kd = (1 - self.erp) / cfm
-        dx = self.distances()
-        F = kp * dx
+        erp = self.erps[self._frame_no][:, None]
+        dt = self.world.dt
+        # not the buffer from distances(), which callers may pass as dx_tm1.
+        dx = self.distances(out=self._dx)
+        F = np.multiply(erp / (cfm * dt), dx, out=self._forces)
         if dx_tm1 is not None:
-            bad = np.isnan(dx) | np.isnan(dx_tm1)
-            F[~bad] += (kd * (dx - dx_tm1) / self.world.dt)[~bad]
+            ddx = dx - dx_tm1
+            ddx *= (1 - erp) / (cfm * dt)
+            np.add(F, ddx, out=F, where=~np.isnan(ddx))
+        self._dx_tm1[:] = dx
+        self._dx_tm1_count = self._attach_count
         return F
 
 
+def _unique_labels(labels):
+    '''Give each point a distinct label, numbering blank and repeated ones.
+
+    Parameters
+    ----------
+    labels : sequence of str
+        Labels for a sequence of points.
+
+    Returns
+    -------
+    labels : list of str
+        The same labels, except that blank labels become "point-N" and later
+        copies of a repeated label become "label-N", where N is the index of
+        the point.
+    '''
+    seen = set()
+    unique = []
+    for i, label in enumerate(labels):
+        name = label or 'point'
+        if not label or label in seen:
+            name = '{}-{}'.format(name, i)
+        while name in seen:
+            name += '-'
+        seen.add(name)
+        unique.append(name)
+    return unique
+
+
+def _open_text(filename):
+    '''Open a (possibly gzipped) text file for reading bytes.'''
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rb')
+    return open(filename, 'rb')
+
+
+def _read_csv(filename, sidecar=True, chunk_size=4096):
+    '''Read marker data from a CSV file, or from its binary sidecar.
+
+    Parameters
+    ----------
+    filename : str
+        Name of the CSV file to load. See :func:`Markers.load_csv`.
+    sidecar : bool, optional
+        If True, parse the CSV file into a memory-mapped ``.npy`` file named
+        after the CSV file, or reuse this file if it is newer than the CSV
+        file. Defaults to True.
+    chunk_size : int, optional
+        Parse this many lines of text at a time. Defaults to 4096.
+
+    Returns
+    -------
+    labels : list of str
+        The marker labels, in channel order.
+    data : ndarray of shape (num-frames, num-markers, 4)
+        Marker positions and visibility values for every frame in the file.
+    dt : float
+        Mean time interval between frames.
+    '''
+    stat = os.stat(filename)
+    data_path = filename + '.npy'
+    meta_path = filename + '.json'
+    if sidecar and os.path.exists(meta_path) and os.path.exists(data_path):
+        with open(meta_path) as handle:
+            meta = json.load(handle)
+        if meta['size'] == stat.st_size and meta['mtime'] == stat.st_mtime:
+            logging.info('%s: loading marker data from %s', filename, data_path)
+            return meta['labels'], np.load(data_path, mmap_mode='c'), meta['dt']
+
+    with _open_text(filename) as handle:
+        header = handle.readline().decode('utf-8').strip().split(',')
+        num_frames = sum(1 for line in handle if line.strip())
+
+    labels = []
+    columns = []
+    axes = dict(x=0, y=2, z=1, c=3)  # swap y and z.
+    for i, column in enumerate(header):
+        m = re.match(r'^marker\d\d-(.*)-([xyzc])$', column)
+        if m:
+            if m.group(1) not in labels:
+                labels.append(m.group(1))
+            columns.append((i, labels.index(m.group(1)), axes[m.group(2)]))
+    cols, markers, dims = (np.array(x, int) for x in zip(*columns))
+    time_col = header.index('time')
+
+    shape = (num_frames, len(labels), 4)
+    data = None
+    if sidecar:
+        try:
+            data = np.lib.format.open_memmap(data_path, 'w+', float, shape)
+        except (IOError, OSError):
+            logging.info('%s: cannot write sidecar, parsing into memory',
+                         data_path)
+    if data is None:
+        data = np.empty(shape, float)
+
+    times = np.empty(num_frames, float)
+    usecols = [time_col] + cols.tolist()
+    with _open_text(filename) as handle:
+        handle.readline()
+        lines = (line for line in handle if line.strip())
+        start = 0
+        while start < num_frames:
+            chunk = list(itertools.islice(lines, chunk_size))
+            values = np.atleast_2d(np.genfromtxt(
+                chunk, delimiter=',', usecols=usecols, dtype=float))
+            values[np.isnan(values)] = -1
+            stop = start + len(values)
+            times[start:stop] = values[:, 0]
+            data[start:stop, markers, dims] = values[:, 1:]
+            start = stop
+
+    dt = float(np.diff(times).mean()) if num_frames > 1 else 0.
+    if sidecar and isinstance(data, np.memmap):
+        data.flush()
+        del data
+        with open(meta_path, 'w') as handle:
+            json.dump(dict(labels=labels, dt=dt, size=stat.st_size,
+                           mtime=stat.st_mtime), handle)
+        # map the sidecar copy-on-write, as when it is reused, so that later
+        # changes to the data never write through to the file.
+        data = np.load(data_path, mmap_mode='c')
+    return labels, data, dt
+
+
+def _runs(valid):
+    '''Find runs of valid samples for each marker.
+
+    Parameters
+    ----------
+    valid : ndarray of shape (num-frames, num-markers)
+        Boolean array indicating valid marker samples.
+
+    Returns
+    -------
+    runs : list of (marker, start, end) tuples
+        One entry for each maximal run of valid frames ``[start, end)``.
+    '''
+    padded = np.zeros((valid.shape[0] + 2, valid.shape[1]), np.int8)
+    padded[1:-1] = valid
+    edges = np.diff(padded, axis=0)
+    starts = np.argwhere(edges.T == 1).tolist()
+    ends = np.argwhere(edges.T == -1).tolist()
+    return [(m, a, b) for (m, a), (_, b) in zip(starts, ends)]
+
+
+def _gap_bounds(valid):
+    '''Find the nearest valid frames around each marker sample.
+
+    Parameters
+    ----------
+    valid : ndarray of shape (num-frames, num-markers)
+        Boolean array indicating valid marker samples.
+
+    Returns
+    -------
+    before : ndarray of int
+        For each sample, the index of the closest valid frame at or before the
+        sample, or -1 if there is none.
+    after : ndarray of int
+        For each sample, the index of the closest valid frame at or after the
+        sample, or num-frames if there is none.
+    '''
+    n = len(valid)
+    idx = np.arange(n)[:, None]
+    before = np.maximum.accumulate(np.where(valid, idx, -1), axis=0)
+    after = np.minimum.accumulate(np.where(valid, idx, n)[::-1], axis=0)[::-1]
+    return before, after
+
+
+def _kabsch(source, target, weights):
+    '''Find rigid transforms that best map sets of source to target points.
+
+    Parameters
+    ----------
+    source : ndarray of shape (N, K, 3)
+        N sets of K source points.
+    target : ndarray of shape (N, K, 3)
+        N sets of K target points.
+    weights : ndarray of shape (N, K)
+        Weight for each pair of points; zero-weight points are ignored.
+
+    Returns
+    -------
+    rotations : ndarray of shape (N, 3, 3)
+        Rotation matrices.
+    translations : ndarray of shape (N, 3)
+        Translation vectors, so that ``target ~ rotation . source +
+        translation``.
+    '''
+    w = np.asarray(weights, float)[:, :, None]
+    total = w.sum(axis=1)
+    src_c = (w * source).sum(axis=1) / total
+    tgt_c = (w * target).sum(axis=1) / total
+    cov = np.einsum('nki,nkj->nij', w * (source - src_c[:, None]),
+                    target - tgt_c[:, None])
+    u, _, vt = np.linalg.svd(cov)
+    # flip the last axis where needed to avoid reflections.
+    d = np.sign(np.linalg.det(np.einsum('nji,nkj->nik', vt, u)))
+    vt[:, 2] *= d[:, None]
+    rot = np.einsum('nji,nkj->nik', vt, u)
+    return rot, tgt_c - np.einsum('nij,nj->ni', rot, src_c)
+
+
+def _scale_constraints(cfms, erps, ratio):
+    '''Convert marker CFM and ERP values for a time step that is longer.
+
+    ODE's CFM and ERP describe a damped spring whose stiffness k and damping c
+    are related to the time step h by ``erp = h k / (h k + c)`` and ``cfm = 1
+    / (h k + c)``. This gives values that keep k and c fixed when the time step
+    is multiplied by ``ratio``.
+    '''
+    scale = 1 + erps * (ratio - 1)
+    return cfms / scale, ratio * erps / scale
+
+
+def _wrap_angles(angles):
+    '''Wrap angles into the range [-pi, pi).'''
+    return (angles + np.pi) % (2 * np.pi) - np.pi
+
+
+def _slerp(q0, q1, t):
+    '''Spherically interpolate between unit quaternions.
+
+    Parameters
+    ----------
+    q0, q1 : ndarray of shape (..., 4)
+        Quaternions to interpolate between.
+    t : ndarray
+        Interpolation weights, broadcastable to the leading shape of the
+        quaternions; 0 gives q0 and 1 gives q1.
+
+    Returns
+    -------
+    q : ndarray of shape (..., 4)
+        Unit quaternions along the shortest arc from q0 to q1.
+    '''
+    dot = (q0 * q1).sum(axis=-1)
+    q1 = np.where((dot < 0)[..., None], -q1, q1)
+    theta = np.arccos(np.clip(abs(dot), -1, 1))
+    sin = np.sin(theta)
+    # fall back to linear interpolation for (nearly) identical rotations.
+    near = sin < 1e-6
+    safe = np.where(near, 1, sin)
+    w0 = np.where(near, 1 - t, np.sin((1 - t) * theta) / safe)
+    w1 = np.where(near, t, np.sin(t * theta) / safe)
+    q = w0[..., None] * q0 + w1[..., None] * q1
+    return q / np.linalg.norm(q, axis=-1)[..., None]
+
+
+def _rotate(quaternions, vectors):
+    '''Rotate vectors by unit quaternions given as (w, x, y, z).'''
+    w = quaternions[..., :1]
+    u = quaternions[..., 1:]
+    uv = np.cross(u, vectors)
+    return vectors + 2 * w * uv + 2 * np.cross(u, uv)
+
+
+def _window_valid(valid, width):
+    '''Mark frames whose centered window of samples is entirely valid.'''
+    half = width // 2
+    counts = np.cumsum(np.vstack([np.zeros((1, valid.shape[1]), int),
+                                  valid.astype(int)]), axis=0)
+    ok = np.zeros_like(valid)
+    if len(valid) >= width:
+        ok[half:len(valid) - half] = counts[width:] - counts[:-width] == width
+    return ok
+
+
+def _central_difference(positions, valid, dt, accelerations):
+    '''Estimate marker derivatives using central finite differences.'''
+    vel = np.full(positions.shape, Markers.INVALID_VELOCITY, positions.dtype)
+    ok = valid[2:] & valid[:-2]
+    diff = (positions[2:] - positions[:-2]) / (2 * dt)
+    vel[1:-1][ok] = diff[ok]
+    acc = None
+    if accelerations:
+        acc = np.full(positions.shape, np.nan, positions.dtype)
+        ok &= valid[1:-1]
+        diff = (positions[2:] - 2 * positions[1:-1] + positions[:-2]) / dt ** 2
+        acc[1:-1][ok] = diff[ok]
+    return vel, acc
+
+
+def _savitzky_golay(positions, valid, dt, accelerations, window=7, order=2):
+    '''Estimate marker derivatives using a Savitzky-Golay filter.'''
+    import scipy.signal
+
+    x = np.where(valid[:, :, None], positions, 0)
+    ok = _window_valid(valid, window)
+    vel = np.full(positions.shape, Markers.INVALID_VELOCITY, positions.dtype)
+    vel[ok] = scipy.signal.savgol_filter(
+        x, window, order, deriv=1, delta=dt, axis=0)[ok]
+    acc = None
+    if accelerations:
+        acc = np.full(positions.shape, np.nan, positions.dtype)
+        acc[ok] = scipy.signal.savgol_filter(
+            x, window, order, deriv=2, delta=dt, axis=0)[ok]
+    return vel, acc
+
+
+def _smoothing_spline(positions, valid, dt, accelerations, smoothing=1e-6):
+    '''Estimate marker derivatives using smoothing splines.'''
+    import scipy.interpolate
+
+    vel = np.full(positions.shape, Markers.INVALID_VELOCITY, positions.dtype)
+    acc = np.full(positions.shape, np.nan, positions.dtype) if accelerations else None
+    for m, start, end in _runs(valid):
+        if end - start < 4:
+            continue
+        t = np.arange(start, end) * dt
+        for d in range(3):
+            spline = scipy.interpolate.UnivariateSpline(
+                t, positions[start:end, m, d], k=3, s=smoothing * (end - start))
+            vel[start:end, m, d] = spline.derivative(1)(t)
+            if accelerations:
+                acc[start:end, m, d] = spline.derivative(2)(t)
+    return vel, acc
+
+
+# velocity estimators for Markers.process_data.
+ESTIMATORS = dict(
+    central=_central_difference,
+    savgol=_savitzky_golay,
+    spline=_smoothing_spline,
+)
+
+
 class World(physics.World):
     '''Simulate a physics world that includes an articulated skeleton model.
 
@@ -408,6 +1270,17 @@ class World(physics.World):
     the :func:`settle_to_markers` and :func:`follow_markers` methods.
     '''
 
+    # remember settled poses for at most this many frames.
+    MAX_SETTLED = 256
+
+    def __init__(self, *args, **kwargs):
+        super(World, self).__init__(*args, **kwargs)
+        # poses settled for each frame, used for warm starts; see
+        # settle_to_markers. these are forgotten when a new skeleton or new
+        # marker data are loaded.
+        self._settled = collections.OrderedDict()
+        self._settled_skeleton = None
+
     def load_skeleton(self, filename, pid_params=None):
         '''Create and configure a skeleton in our model.
 
@@ -426,8 +1299,9 @@ class World(physics.World):
             self.skeleton.set_pid_params(**pid_params)
         self.skeleton.erp = 0.1
         self.skeleton.cfm = 0
+        self._settled.clear()
 
-    def load_markers(self, filename, attachments, max_frames=1e100):
+    def load_markers(self, filename, attachments, max_frames=1e100, **kwargs):
         '''Load marker data and attachment preferences into the model.
 
         Parameters
@@ -444,6 +1318,9 @@ class World(physics.World):
             Only read in this many frames of marker data. By default, the entire
             data file is read into memory.
 
+        Additional keyword arguments are passed to :func:`Markers.load_c3d` or
+        :func:`Markers.load_csv`.
+
         Returns
         -------
         markers : :class:`Markers`
@@ -451,11 +1328,12 @@ class World(physics.World):
             skeleton attachment configuration.
         '''
         self.markers = Markers(self)
+        self._settled.clear()
         fn = filename.lower()
         if fn.endswith('.c3d'):
-            self.markers.load_c3d(filename, max_frames=max_frames)
+            self.markers.load_c3d(filename, max_frames=max_frames, **kwargs)
         elif fn.endswith('.csv') or fn.endswith('.csv.gz'):
-            self.markers.load_csv(filename, max_frames=max_frames)
+            self.markers.load_csv(filename, max_frames=max_frames, **kwargs)
         else:
             logging.fatal('%s: not sure how to load markers!', filename)
         self.markers.load_attachments(attachments, self.skeleton)
@@ -468,7 +1346,6 @@ class World(physics.World):
         entirely can be used).
         '''
         # by default we step by following our loaded marker data.
-        self.frame_no += 1
         try:
             next(self.follower)
         except (AttributeError, StopIteration) as err:
@@ -485,42 +1362,174 @@ class World(physics.World):
         self.follower = self.follow_markers()
 
     def settle_to_markers(self, frame_no=0, max_distance=0.05, max_iters=300,
-                          states=None):
+                          states=None, warm_start=False, align=False,
+                          min_improvement=0.001, patience=None, cache=None):
         '''Settle the skeleton to our marker data at a specific frame.
 
+        Settling steps the world repeatedly at one frame of marker data,
+        zeroing the skeleton's velocities between steps, until the marker
+        distance is small enough (or, if ``patience`` is given, stops
+        improving).
+
         Parameters
         ----------
         frame_no : int, optional
             Settle the skeleton to marker data at this frame. Defaults to 0.
         max_distance : float, optional
             The settling process will stop when the mean marker distance falls
-            below this threshold. Defaults to 0.1m (10cm). Setting this too
-            small prevents the settling process from finishing (it will loop
-            indefinitely), and setting it too large prevents the skeleton from
-            settling to a stable state near the markers.
+            below this threshold. Defaults to 0.05m (5cm).
         max_iters : int, optional
             Attempt to settle markers for at most this many iterations. Defaults
-            to 1000.
+            to 300.
         states : list of body states, optional
             If given, set the bodies in our skeleton to these kinematic states
             before starting the settling process.
+        warm_start : bool, optional
+            If True and no states are given, start from the pose that was
+            settled (or loaded from a cache) for the nearest frame in an
+            earlier call, if any. Settled poses are forgotten whenever a
+            skeleton or marker data are loaded, so results never depend on a
+            previous skeleton. Defaults to False.
+        align : bool, optional
+            If True, rigidly move the whole skeleton so that its marker
+            attachment points best match the markers visible in this frame
+            before settling. Defaults to False.
+        min_improvement : float, optional
+            Count an iteration as stalled when it reduces the best marker
+            distance so far by less than this fraction. Defaults to 0.001.
+        patience : int, optional
+            If given, stop settling after this many consecutive stalled
+            iterations, e.g. 10. Defaults to None, which settles until the
+            marker distance is below ``max_distance`` or ``max_iters`` is
+            reached.
+        cache : :class:`pagoda.cache.Cache`, optional
+            If given, look up the settled pose in this cache, and store it
+            there after settling. Entries are keyed on the frame, the
+            skeleton, the marker data and attachments, the world and settling
+            parameters, and the given ``states``; the current pose of the
+            skeleton and any warm-start pose are not part of the key.
+
+        Returns
+        -------
+        states : list of body states
+            The states of the skeleton bodies after settling.
         '''
+        bodies = self.skeleton.bodies
+        settled = self._settled
+        if self._settled_skeleton != self.skeleton.digest():
+            settled.clear()
+            self._settled_skeleton = self.skeleton.digest()
+
         if states is not None:
             self.skeleton.set_body_states(states)
-        dist = None
-        for _ in range(max_iters):
+
+        key = None
+        if cache is not None:
+            key = self._memo_key(cache, 'settle', pose=states is not None,
+                                 frame_no=frame_no, max_distance=max_distance,
+                                 max_iters=max_iters, warm_start=warm_start,
+                                 align=align, min_improvement=min_improvement,
+                                 patience=patience)
+            arrays, _ = cache.get(key)
+            if arrays is not None:
+                logging.info('loaded cached pose for frame %d', frame_no)
+                self.set_state_array(arrays['states'], bodies)
+                self._remember_settled(frame_no)
+                return self.skeleton.get_body_states()
+
+        if states is None and warm_start and settled:
+            nearest = min(settled, key=lambda f: abs(f - frame_no))
+            self.set_state_array(settled[nearest], bodies)
+        if align:
+            self._align_to_markers(frame_no)
+
+        zero = (0, 0, 0)
+        ode_bodies = [b.ode_body for b in bodies]
+        best = dist = None
+        stalled = iters = 0
+        while iters < max_iters:
+            iters += 1
             for _ in self._step_to_marker_frame(frame_no):
                 pass
             dist = np.nanmean(abs(self.markers.distances()))
-            logging.info('settling to frame %d: marker distance %.3f', frame_no, dist)
+            logging.debug('settling to frame %d: marker distance %.3f',
+                          frame_no, dist)
             if dist < max_distance:
-                return self.skeleton.get_body_states()
-            for b in self.skeleton.bodies:
-                b.linear_velocity = 0, 0, 0
-                b.angular_velocity = 0, 0, 0
-        return states
+                break
+            if best is not None and best - dist < min_improvement * best:
+                stalled += 1
+            else:
+                stalled = 0
+            best = dist if best is None else min(best, dist)
+            if patience is not None and stalled >= patience:
+                break
+            for body in ode_bodies:
+                body.setLinearVel(zero)
+                body.setAngularVel(zero)
+        logging.info('settled to frame %d after %d iterations: '
+                     'marker distance %s', frame_no, iters, dist)
+
+        self._remember_settled(frame_no)
+        if key is not None:
+            cache.put(key, dict(states=settled[frame_no]))
+        return self.skeleton.get_body_states()
+
+    def _remember_settled(self, frame_no):
+        '''Keep the current skeleton pose as a warm start for settling.'''
+        settled = self._settled
+        settled.pop(frame_no, None)
+        settled[frame_no] = self.get_state_array(self.skeleton.bodies)
+        while len(settled) > self.MAX_SETTLED:
+            settled.popitem(last=False)
+
+    def _memo_key(self, cache, name, pose=True, **params):
+        '''Compute a cache key for a result of following our marker data.
+
+        Keys combine the skeleton structure and controller settings, the
+        marker data and attachments (see :func:`Markers.digest`), the world
+        settings, the current skeleton pose (if ``pose`` is True) and the
+        given parameters.
+        '''
+        skel = self.skeleton
+        if pose:
+            # round the pose so that tiny changes, like ODE renormalizing
+            # quaternions, don't change the key.
+            pose = np.round(self.get_state_array(skel.bodies), 6) + 0.
+            pose = hashlib.sha1(np.ascontiguousarray(pose)).hexdigest()
+        else:
+            pose = None
+        return cache.key(
+            name, skel.digest(), skel.pid_params, skel.erp, skel.cfm,
+            self.markers.digest(), self.dt, list(self.gravity), self.erp,
+            self.cfm, self.friction, self.elasticity, pose, params)
 
-    def follow_markers(self, start=0, end=1e100, states=None):
+    def _align_to_markers(self, frame_no):
+        '''Rigidly move the skeleton to best match markers at one frame.
+
+        Parameters
+        ----------
+        frame_no : int
+            Align the skeleton to the attachable markers in this frame. Nothing
+            happens if fewer than three markers can be attached.
+        '''
+        markers = self.markers
+        labels = [l for l in markers.targets
+                  if markers.attachable[frame_no, markers.channels[l]]]
+        if len(labels) < 3:
+            return
+        source = np.array([markers.targets[l].body_to_world(markers.offsets[l])
+                           for l in labels])
+        target = markers.positions[frame_no, [markers.channels[l]
+                                              for l in labels]]
+        rot, trans = _kabsch(source[None], target[None],
+                             np.ones((1, len(labels))))
+        rot, trans = rot[0], trans[0]
+        for body in self.skeleton.bodies:
+            body.position = rot.dot(body.position) + trans
+            body.rotation = rot.dot(body.rotation)
+
+    def follow_markers(self, start=0, end=1e100, states=None, snap=False,
+                       out=None):
         '''Iterate over a set of marker data, dragging its skeleton along.
 
         Parameters
@@ -533,18 +1542,32 @@ class World(physics.World):
         states : list of body states, optional
             If given, set the states of the skeleton bodies to these values
             before starting to follow the marker data.
+        snap : bool, optional
+            If True, read the states of the skeleton bodies at each frame and
+            set the bodies to exactly these states before stepping. Defaults
+            to False.
+        out : ndarray of shape (num-frames, num-bodies, 13), optional
+            If given, record the state of every skeleton body at each frame in
+            this array (see :func:`pagoda.physics.World.get_state_array`).
+
+        Returns
+        -------
+        states : sequence of :class:`pagoda.physics.LazyStates`
+            A generator of the skeleton's body states at each frame. States
+            are only read from the simulation when they are accessed, which
+            must happen before the generator advances; pass ``out`` to keep the
+            states for every frame.
         '''
         if states is not None:
             self.skeleton.set_body_states(states)
-        for frame_no, frame in enumerate(self.markers):
-            if frame_no < start:
-                continue
-            if frame_no >= end:
-                break
-            for states in self._step_to_marker_frame(frame_no):
+        stop = int(min(end, self.markers.num_frames))
+        for i, frame_no in enumerate(range(int(start), stop)):
+            buf = None if out is None else out[i]
+            for states in self._step_to_marker_frame(frame_no, snap=snap,
+                                                     out=buf):
                 yield states
 
-    def _step_to_marker_frame(self, frame_no, dt=None):
+    def _step_to_marker_frame(self, frame_no, dt=None, snap=False, out=None):
         '''Update the simulator to a specific frame of marker data.
 
         This method returns a generator of body states for the skeleton! This
@@ -554,11 +1577,10 @@ class World(physics.World):
         This process involves the following steps:
 
         - Move the markers to their new location:
-          - Detach from the skeleton
           - Update marker locations
-          - Reattach to the skeleton
+          - Enable joints for markers that are visible in this frame
         - Detect ODE collisions
-        - Yield the states of the bodies in the skeleton
+        - Yield the (lazily read) states of the bodies in the skeleton
         - Advance the ODE world one step
 
         Parameters
@@ -567,35 +1589,38 @@ class World(physics.World):
             Step to this frame of marker data.
         dt : float, optional
             Step with this time duration. Defaults to ``self.dt``.
+        snap : bool, optional
+            If True, read the skeleton body states and set the bodies to
+            exactly these states before stepping. Defaults to False.
+        out : ndarray of shape (num-bodies, 13), optional
+            If given, read the skeleton body states into this array.
 
         Returns
         -------
-        states : sequence of state tuples
-            A generator of a sequence of one body state for the skeleton. This
+        states : sequence of :class:`pagoda.physics.LazyStates`
+            A generator of one set of body states for the skeleton. This
             generator must be exhausted for the simulation to work properly.
         '''
         # update the positions and velocities of the markers.
-        self.markers.detach()
         self.markers.reposition(frame_no)
         self.markers.attach(frame_no)
 
-        # detect collisions.
-        self.ode_space.collide(None, self.on_collision)
-
-        # record the state of each skeleton body.
-        states = self.skeleton.get_body_states()
-        self.skeleton.set_body_states(states)
-
-        # yield the current simulation state to our caller.
-        yield states
-
-        # update the ode world.
-        self.ode_world.step(dt or self.dt)
-
-        # clear out contact joints to prepare for the next frame.
-        self.ode_contactgroup.empty()
-
-    def inverse_kinematics(self, start=0, end=1e100, states=None, max_force=20):
+        # detect collisions; the world is advanced when we resume stepping.
+        for _ in self._step(dt or self.dt):
+            # skeleton body states are only read if someone asks for them.
+            bodies = self.skeleton.bodies
+            if out is not None:
+                self.get_state_array(bodies, out=out)
+            states = physics.LazyStates(self, bodies, out)
+            if snap:
+                self.set_state_array(states.array, bodies)
+
+            # yield the current simulation state to our caller.
+            yield states
+            states.expire()
+
+    def inverse_kinematics(self, start=0, end=1e100, states=None, max_force=20,
+                           cache=None):
         '''Follow a set of marker data, yielding kinematic joint angles.
 
         Parameters
@@ -613,6 +1638,15 @@ class World(physics.World):
             force when attempting to maintain its equilibrium position. This
             defaults to 20N. Set this value higher to simulate a stiff skeleton
             while following marker data.
+        cache : :class:`pagoda.cache.Cache`, optional
+            If given, look up joint angles and skeleton states in this cache
+            before following the marker data, and store them there after all
+            frames have been generated. Entries are keyed on the skeleton, the
+            marker data and attachments, the world settings, the starting pose
+            and the parameters to this method. When angles are loaded from the
+            cache, the world is not simulated: the skeleton is moved to the
+            stored state for each frame, and :func:`Markers.distances` gives
+            the stored marker distances for that frame.
 
         Returns
         -------
@@ -621,6 +1655,11 @@ class World(physics.World):
             joint angles will be generated for each frame of marker data between
             `start` and `end`.
         '''
+        if cache is not None:
+            for angles in self._memoized_inverse_kinematics(
+                    cache, start, end, states, max_force):
+                yield angles
+            return
         zeros = None
         if max_force > 0:
             self.skeleton.enable_motors(max_force)
@@ -630,13 +1669,239 @@ class World(physics.World):
                 self.skeleton.set_target_angles(zeros)
             yield self.skeleton.joint_angles
 
-    def inverse_dynamics(self, angles, start=0, end=1e100, states=None, max_force=100):
+    def _memoized_inverse_kinematics(self, cache, start, end, states,
+                                     max_force):
+        '''Run inverse kinematics, loading and storing results in a cache.'''
+        start = int(start)
+        end = int(min(end, self.markers.num_frames))
+        bodies = self.skeleton.bodies
+        if states is not None:
+            self.skeleton.set_body_states(states)
+        key = self._memo_key(cache, 'inverse-kinematics', start=start,
+                             end=end, max_force=max_force)
+        arrays, _ = cache.get(key)
+        # entries stored before residuals were cached are computed again.
+        if arrays is not None and 'residuals' in arrays:
+            logging.info('loaded cached inverse kinematics for frames %d-%d',
+                         start, end)
+            if max_force > 0:
+                self.skeleton.enable_motors(max_force)
+            try:
+                for angles, row, dist in zip(arrays['angles'],
+                                             arrays['states'],
+                                             arrays['residuals']):
+                    self.set_state_array(row, bodies)
+                    self.markers._replayed = dist
+                    yield angles
+            finally:
+                self.markers._replayed = None
+            self.set_state_array(arrays['final'], bodies)
+            return
+        frames = max(0, end - start)
+        angles = np.zeros((frames, self.skeleton.num_dofs))
+        states = np.zeros((frames, len(bodies), physics.STATE_WIDTH))
+        residuals = np.zeros((frames, len(self.markers.channels), 3))
+        count = 0
+        for i, values in enumerate(self.inverse_kinematics(
+                start, end, max_force=max_force)):
+            angles[i] = values
+            self.get_state_array(bodies, out=states[i])
+            self.markers.distances(out=residuals[i])
+            count += 1
+            yield values
+        # only complete runs are stored, so partial results never leak into
+        # later runs.
+        if count == frames:
+            cache.put(key, dict(angles=angles, states=states,
+                                residuals=residuals,
+                                final=self.get_state_array(bodies)),
+                      dict(start=start, end=end))
+
+    def multirate_inverse_kinematics(self, start=0, end=1e100, states=None,
+                                     max_force=20, decimation=4,
+                                     tolerance=0.005):
+        '''Follow marker data at a reduced rate, interpolating joint angles.
+
+        The world is stepped at every ``decimation``-th frame of marker data
+        (and at the last frame), with each step lasting until the next
+        simulated frame. Marker CFM and ERP values are converted for the length
+        of each step so that marker springs keep the same stiffness and
+        damping, and the proportional gain of the skeleton's PID controllers is
+        divided by the same factor so that joints still converge in about one
+        step. Angles and body states for the skipped frames are
+        interpolated between the simulated ones, using spherical linear
+        interpolation for body rotations.
+
+        Interpolated poses are then checked against the marker data: if the
+        mean distance between markers and their attachment points at a skipped
+        frame exceeds the value interpolated from the neighboring simulated
+        frames by more than ``tolerance``, the frames between those simulated
+        frames are simulated again at the full rate.
+
+        Parameters
+        ----------
+        start : int, optional
+            Start following marker data after this frame. Defaults to 0.
+        end : int, optional
+            Stop following marker data after this frame. Defaults to the end of
+            the marker data.
+        states : list of body states, optional
+            If given, set the states of the skeleton bodies to these values
+            before starting to follow the marker data.
+        max_force : float, optional
+            Maximum force for each degree of freedom in the skeleton; see
+            :func:`inverse_kinematics`. Defaults to 20N.
+        decimation : int, optional
+            Simulate one of every this many frames. Defaults to 4.
+        tolerance : float, optional
+            Simulate frames again at the full rate where interpolation adds more
+            than this distance (in meters) to the mean marker residual. Defaults
+            to 0.005 (5mm). Set to None to skip this check.
+
+        Returns
+        -------
+        angles : ndarray of shape (num-frames, num-dofs)
+            Joint angles for each frame of marker data between `start` and
+            `end`.
+        states : ndarray of shape (num-frames, num-bodies, 13)
+            Skeleton body states for each frame, as seen while iterating over
+            :func:`inverse_kinematics`. The skeleton is left in the state for
+            the last frame.
+        '''
+        start = int(start)
+        end = int(min(end, self.markers.num_frames))
+        frames = max(0, end - start)
+        skel = self.skeleton
+        bodies = skel.bodies
+        angles = np.zeros((frames, skel.num_dofs))
+        out = np.zeros((frames, len(bodies), physics.STATE_WIDTH))
+        if states is not None:
+            skel.set_body_states(states)
+        if not frames:
+            return angles, out
+
+        # simulate every decimation-th frame, and always the last one.
+        coarse = list(range(0, frames, max(1, int(decimation))))
+        if coarse[-1] != frames - 1:
+            coarse.append(frames - 1)
+        coarse = np.array(coarse)
+        self._follow_coarse_frames(start, coarse, decimation, max_force,
+                                   angles, out)
+
+        redone = []
+        if len(coarse) > 1:
+            idx = np.arange(frames)
+            k = np.minimum(np.searchsorted(coarse, idx, 'right') - 1,
+                           len(coarse) - 2)
+            a, b = coarse[k], coarse[k + 1]
+            t = (idx - a) / (b - a)
+            skipped = (0 < t) & (t < 1)
+            ts = t[skipped][:, None]
+            sa, sb = a[skipped], b[skipped]
+            angles[skipped] = _wrap_angles(angles[sa] + ts * _wrap_angles(
+                angles[sb] - angles[sa]))
+            ts = ts[:, :, None]
+            out[skipped] = (1 - ts) * out[sa] + ts * out[sb]
+            out[skipped, :, 3:7] = _slerp(out[sa, :, 3:7], out[sb, :, 3:7],
+                                          ts[:, :, 0])
+
+            if tolerance is not None:
+                res = self._attachment_residuals(idx + start, out)
+                excess = res - ((1 - t) * res[a] + t * res[b])
+                redone = np.unique(k[skipped & (excess > tolerance)])
+                for j in redone:
+                    lo, hi = coarse[j], coarse[j + 1]
+                    self.set_state_array(out[lo], bodies)
+                    for i, values in enumerate(self.inverse_kinematics(
+                            start + lo, start + hi, max_force=max_force)):
+                        angles[lo + i] = values
+                        self.get_state_array(bodies, out=out[lo + i])
+
+        self.set_state_array(out[-1], bodies)
+        logging.info('followed %d frames, simulating %d frames and '
+                     're-running %d of %d intervals', frames, len(coarse),
+                     len(redone), max(0, len(coarse) - 1))
+        return angles, out
+
+    def _follow_coarse_frames(self, start, coarse, decimation, max_force,
+                              angles, out):
+        '''Follow a subset of marker frames with a longer time step.'''
+        skel = self.skeleton
+        markers = self.markers
+        dt, cfms, erps = self.dt, markers.cfms, markers.erps
+        args, kwargs = skel.pid_params
+        ratio = 1
+        try:
+            zeros = None
+            if max_force > 0:
+                skel.enable_motors(max_force)
+                zeros = np.zeros(skel.num_dofs)
+            for k, i in enumerate(coarse):
+                gap = int(coarse[k + 1] - i if k + 1 < len(coarse) else
+                          max(1, int(decimation)))
+                if gap != ratio:
+                    # match marker springs and PID gains (which read our dt)
+                    # to the length of this step.
+                    ratio = gap
+                    self.dt = dt * ratio
+                    markers.cfms, markers.erps = _scale_constraints(
+                        cfms, erps, ratio)
+                    if args:
+                        skel.set_pid_params(args[0] / ratio, *args[1:],
+                                            **kwargs)
+                    else:
+                        skel.set_pid_params(**dict(
+                            kwargs, kp=kwargs.get('kp', 0) / ratio))
+                for _ in self._step_to_marker_frame(start + i, out=out[i]):
+                    if zeros is not None:
+                        skel.set_target_angles(zeros)
+                    angles[i] = skel.joint_angles
+        finally:
+            self.dt = dt
+            markers.cfms, markers.erps = cfms, erps
+            if ratio != 1:
+                skel.set_pid_params(*args, **kwargs)
+
+    def _attachment_residuals(self, frames, states):
+        '''Get mean distances between markers and their attachment points.
+
+        Parameters
+        ----------
+        frames : ndarray of int
+            Frames of marker data to compare with.
+        states : ndarray of shape (len(frames), num-bodies, 13)
+            Skeleton body states for each frame.
+
+        Returns
+        -------
+        residuals : ndarray of shape (len(frames), )
+            Mean distance over attachable markers in each frame, or NaN for
+            frames with no attachable markers.
+        '''
+        markers = self.markers
+        labels = sorted(markers.targets)
+        index = dict((b.name, i) for i, b in enumerate(self.skeleton.bodies))
+        bodies = [index[markers.targets[l].name] for l in labels]
+        channels = [markers.channels[l] for l in labels]
+        offsets = np.array([markers.offsets[l] for l in labels])
+        points = states[:, bodies, 0:3] + _rotate(states[:, bodies, 3:7],
+                                                  offsets)
+        ok = markers.attachable[frames][:, channels]
+        err = np.linalg.norm(points - markers.positions[frames][:, channels],
+                             axis=-1)
+        count = ok.sum(axis=1)
+        total = np.where(ok, err, 0).sum(axis=1)
+        return np.where(count > 0, total / np.maximum(count, 1), np.nan)
+
+    def inverse_dynamics(self, angles, start=0, end=1e100, states=None,
+                         max_force=100, mode='twostep'):
         '''Follow a set of angle data, yielding dynamic joint torques.
 
         Parameters
         ----------
         angles : ndarray (num-frames x num-dofs)
-            Follow angle data provided by this array of angle values.
+            Follow angle data provided by this array of angle values. Any
+            iterable of angle frames (e.g., a generator) can be used.
         start : int, optional
             Start following angle data after this frame. Defaults to the start
             of the angle data.
@@ -652,6 +1917,21 @@ class World(physics.World):
             100N. Setting this value to be large results in more accurate
             following but can cause oscillations in the PID controllers,
             resulting in noisy torques.
+        mode : str, optional
+            How to compute torques for each frame:
+
+            - "twostep" (the default): step once with joint motors following
+              the angle data to measure torques, restore the skeleton to its
+              state before that step, and step again by applying the measured
+              torques with the motors switched off. Any numerical error in the
+              motor-driven step is thus discarded.
+            - "onestep": step once with joint motors following the angle
+              data, and keep the result. This needs about half the work of
+              "twostep", but the motion is driven by motor constraints rather
+              than by the reported torques, so small solver errors accumulate
+              in the skeleton's trajectory. Use
+              :func:`compare_inverse_dynamics` to measure the difference for
+              a trial.
 
         Returns
         -------
@@ -660,50 +1940,167 @@ class World(physics.World):
             of joint torques will be generated for each frame of angle data
             between `start` and `end`.
         '''
+        if mode not in ('onestep', 'twostep'):
+            raise ValueError('unknown inverse dynamics mode {}'.format(mode))
+
         if states is not None:
             self.skeleton.set_body_states(states)
 
-        for frame_no, frame in enumerate(angles):
-            if frame_no < start:
-                continue
-            if frame_no >= end:
-                break
-
-            self.ode_space.collide(None, self.on_collision)
+        skeleton = self.skeleton
+        bodies = skeleton.bodies
+        saved = np.empty((len(bodies), physics.STATE_WIDTH))
+        skeleton.enable_motors(max_force)
+        if mode == 'twostep':
+            skeleton.set_max_forces(0)
 
-            states = self.skeleton.get_body_states()
-            self.skeleton.set_body_states(states)
+        # motors are switched off even if the caller stops early.
+        try:
+            for frame_no, frame in enumerate(angles):
+                if frame_no < start:
+                    continue
+                if frame_no >= end:
+                    break
 
-            # joseph's stability fix: step to compute torques, then reset the
-            # skeleton to the start of the step, and then step using computed
-            # torques. thus any numerical errors between the body states after
-            # stepping using angle constraints will be removed, because we
-            # will be stepping the model using the computed torques.
+                if mode == 'onestep':
+                    for _ in self._step(self.dt):
+                        skeleton.set_target_angles(frame)
+                    yield skeleton.joint_torques
+                    continue
+
+                # joseph's stability fix: step to compute torques, then reset
+                # the skeleton to the start of the step, and then step using
+                # computed torques. thus any numerical errors between the body
+                # states after stepping using angle constraints will be
+                # removed, because we will be stepping the model using the
+                # computed torques.
+
+                for _ in self._step(self.dt):
+                    self.get_state_array(bodies, out=saved)
+                    skeleton.set_max_forces(max_force)
+                    skeleton.set_target_angles(frame)
+                    self._apply_hook_forces()
+                    self._solve(self.dt)
+                    torques = skeleton.joint_torques
+                    skeleton.set_max_forces(0)
+
+                    self.set_state_array(saved, bodies)
+                    skeleton.add_torques(torques)
+                    yield torques
+        finally:
+            skeleton.disable_motors()
+
+    def compare_inverse_dynamics(self, angles, start=0, end=1e100, states=None,
+                                 max_force=100):
+        '''Compare "onestep" and "twostep" inverse dynamics for some angles.
+
+        Both modes (see :func:`inverse_dynamics`) are run from the same
+        initial skeleton state, and the skeleton is returned to this state
+        afterwards.
 
-            self.skeleton.enable_motors(max_force)
-            self.skeleton.set_target_angles(angles[frame_no])
-            self.ode_world.step(self.dt)
-            torques = self.skeleton.joint_torques
-            self.skeleton.disable_motors()
+        Parameters
+        ----------
+        angles : ndarray (num-frames x num-dofs)
+            Angle data to follow.
+        start : int, optional
+            Start following angle data after this frame. Defaults to 0.
+        end : int, optional
+            Stop following angle data after this frame. Defaults to the end of
+            the angle data.
+        states : list of body states, optional
+            If given, start both runs from these skeleton body states.
+            Defaults to the current states.
+        max_force : float, optional
+            Maximum motor force; see :func:`inverse_dynamics`. Defaults to 100.
 
+        Returns
+        -------
+        report : dict
+            A dictionary containing the "rms" and "max" absolute differences
+            between the torques computed by the two modes, the "relative" RMS
+            difference (as a fraction of the RMS two-step torque), the
+            elapsed seconds for each mode ("onestep_time" and
+            "twostep_time"), and the "speedup" of the one-step mode.
+        '''
+        if states is not None:
             self.skeleton.set_body_states(states)
-            self.skeleton.add_torques(torques)
-            yield torques
-            self.ode_world.step(self.dt)
+        bodies = self.skeleton.bodies
+        initial = self.get_state_array(bodies)
+        torques = {}
+        elapsed = {}
+        for mode in ('twostep', 'onestep'):
+            self.set_state_array(initial, bodies)
+            begin = timeit.default_timer()
+            torques[mode] = np.array(list(self.inverse_dynamics(
+                angles, start, end, max_force=max_force, mode=mode)))
+            elapsed[mode] = timeit.default_timer() - begin
+        self.set_state_array(initial, bodies)
+        diff = torques['onestep'] - torques['twostep']
+        rms = float(np.sqrt((diff * diff).mean())) if diff.size else 0.
+        scale = float(np.sqrt((torques['twostep'] ** 2).mean())) \
+            if diff.size else 0.
+        report = dict(
+            rms=rms,
+            max=float(abs(diff).max()) if diff.size else 0.,
+            relative=rms / scale if scale else 0.,
+            onestep_time=elapsed['onestep'],
+            twostep_time=elapsed['twostep'],
+            speedup=elapsed['twostep'] / max(elapsed['onestep'], 1e-12),
+        )
+        logging.info('onestep vs twostep inverse dynamics: rms torque '
+                     'difference %(rms).4g (relative %(relative).3f), '
+                     'speedup %(speedup).2fx', report)
+        return report
+
+    def forward_dynamics(self, torques, start=0, end=None, states=None,
+                         angles_out=None, states_out=None):
+        '''Move the skeleton according to a set of torque data.
+
+        Joint motors are disabled, and then at each frame the torques for
+        that frame are applied to the skeleton joints before stepping the
+        world.
 
-            self.ode_contactgroup.empty()
+        Parameters
+        ----------
+        torques : ndarray of shape (num-frames, num-dofs)
+            Torques to apply to each degree of freedom at each frame.
+        start : int, optional
+            Start applying torques at this frame. Defaults to 0.
+        end : int, optional
+            Stop before this frame. Defaults to the end of the torque data.
+        states : list of body states or ndarray, optional
+            If given, set the skeleton bodies to these states before starting.
+            Either a list of body state tuples or an array of shape
+            (num-bodies, 13) (see :func:`pagoda.physics.World.get_state_array`).
+        angles_out : ndarray of shape (end - start, num-dofs), optional
+            Store the skeleton's joint angles after each step in this array.
+            A new array is allocated if this is not given.
+        states_out : ndarray of shape (end - start, num-bodies, 13), optional
+            Store the skeleton's body states after each step in this array. A
+            new array is allocated if this is not given.
 
-    def forward_dynamics(self, torques, start=0, states=None):
-        '''Move the body according to a set of torque data.'''
-        if states is not None:
-            self.skeleton.set_body_states(states)
-        for frame_no, torque in enumerate(torques):
-            if frame_no < start:
-                continue
-            if frame_no >= end:
-                break
-            self.ode_space.collide(None, self.on_collision)
-            self.skeleton.add_torques(torque)
-            self.ode_world.step(self.dt)
-            yield
-            self.ode_contactgroup.empty()
+        Returns
+        -------
+        angles : ndarray of shape (end - start, num-dofs)
+            Joint angles after each step.
+        states : ndarray of shape (end - start, num-bodies, 13)
+            Body states after each step.
+        '''
+        skeleton = self.skeleton
+        bodies = skeleton.bodies
+        if isinstance(states, np.ndarray):
+            self.set_state_array(states, bodies)
+        elif states is not None:
+            skeleton.set_body_states(states)
+        end = len(torques) if end is None else min(end, len(torques))
+        n = max(0, end - start)
+        if angles_out is None:
+            angles_out = np.zeros((n, skeleton.num_dofs))
+        if states_out is None:
+            states_out = np.zeros((n, len(bodies), physics.STATE_WIDTH))
+        skeleton.disable_motors()
+        for i in range(n):
+            for _ in self._step(self.dt):
+                skeleton.add_torques(torques[start + i])
+            angles_out[i] = skeleton.joint_angles
+            self.get_state_array(bodies, out=states_out[i])
+        return angles_out, states_out
@@ -0,0 +1,361 @@
+'''Estimate the uncertainty of inverse dynamics with Monte Carlo ensembles.
+
+Joint torques computed from motion-capture data (see
+:func:`pagoda.cooper.World.inverse_dynamics`) depend on noisy marker positions
+and on hand-placed marker attachments. An ensemble runs the whole chain --
+perturb the marker data, settle the skeleton, compute inverse kinematics and
+then inverse dynamics -- for many random replicas of the data, as described by
+a :class:`NoiseModel`.
+
+Replicas run in worker processes that each build one world from a
+:class:`pagoda.parallel.WorldFactory`. The unperturbed marker data are written
+once to a temporary ``.npy`` file that every worker maps read-only, so the
+processes share one copy of the data instead of each keeping its own. Each
+replica is generated from its own seed, so
+results do not depend on the number of processes. Torques are reduced as they
+arrive into running means and variances (:class:`Moments`) and quantile
+estimates (:class:`Quantile`), so memory use does not grow with the number of
+replicas.
+'''
+
+from __future__ import division
+
+import logging
+import multiprocessing
+import numpy as np
+import os
+
+from . import parallel
+from . import shared
+
+
+class NoiseModel(object):
+    '''Random perturbations of marker data and attachments.
+
+    Parameters
+    ----------
+    jitter : float or sequence of float, optional
+        Standard deviation, in meters, of Gaussian noise added to each marker
+        position coordinate. A sequence gives a value for each marker
+        channel. Defaults to 0.002 (2mm).
+    offset_jitter : float, optional
+        Standard deviation, in meters, of Gaussian noise added to each
+        coordinate of each marker's attachment offset. Defaults to 0.
+    dropout : float, optional
+        Approximate fraction of marker samples to mark as dropped out.
+        Defaults to 0.
+    dropout_frames : int, optional
+        Length, in frames, of each injected dropout. Defaults to 1.
+    '''
+
+    def __init__(self, jitter=0.002, offset_jitter=0., dropout=0.,
+                 dropout_frames=1):
+        self.jitter = jitter
+        self.offset_jitter = offset_jitter
+        self.dropout = dropout
+        self.dropout_frames = dropout_frames
+
+    def perturb(self, data, offsets, rng):
+        '''Create one random replica of marker data and attachments.
+
+        Parameters
+        ----------
+        data : ndarray of shape (num-frames, num-markers, 4)
+            Marker positions and visibility values; see
+            :attr:`pagoda.cooper.Markers.data`. This array is not modified.
+        offsets : dict
+            A mapping from marker labels to body-relative attachment offsets.
+        rng : numpy.random.RandomState
+            Source of random numbers.
+
+        Returns
+        -------
+        data : ndarray of shape (num-frames, num-markers, 4)
+            A perturbed copy of the marker data. Injected dropouts have a
+            visibility value of -1.
+        offsets : dict
+            Perturbed attachment offsets.
+        '''
+        data = np.array(data, float)
+        frames, markers = data.shape[:2]
+        std = np.asarray(self.jitter, float) * np.ones(markers)
+        data[:, :, :3] += rng.standard_normal((frames, markers, 3)) * \
+            std[None, :, None]
+        if self.dropout > 0:
+            starts = rng.random_sample((frames, markers)) < \
+                self.dropout / self.dropout_frames
+            dropped = starts.copy()
+            for i in range(1, self.dropout_frames):
+                dropped[i:] |= starts[:-i]
+            data[:, :, 3][dropped] = -1
+        offsets = dict(
+            (label, np.asarray(offset, float) +
+             self.offset_jitter * rng.standard_normal(3))
+            for label, offset in sorted(offsets.items()))
+        return data, offsets
+
+
+class Moments(object):
+    '''Running mean and variance of arrays, using Welford's method.
+
+    Parameters
+    ----------
+    shape : tuple of int
+        Shape of the arrays to summarize.
+    '''
+
+    def __init__(self, shape):
+        self.count = 0
+        self.mean = np.zeros(shape)
+        self._m2 = np.zeros(shape)
+
+    def update(self, values):
+        '''Add one array of values to the summary.'''
+        self.count += 1
+        delta = values - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (values - self.mean)
+
+    @property
+    def variance(self):
+        '''The sample variance (with one degree of freedom removed).'''
+        return self._m2 / max(1, self.count - 1)
+
+    @property
+    def std(self):
+        '''The sample standard deviation.'''
+        return np.sqrt(self.variance)
+
+
+class Quantile(object):
+    '''Running estimate of a quantile for each element of an array.
+
+    This uses the P-squared algorithm (Jain & Chlamtac, 1985 Comm. ACM), which
+    keeps five markers per element and updates them with a few vectorized
+    operations for each new array. Quantiles of the first five arrays are
+    computed exactly.
+
+    Parameters
+    ----------
+    p : float
+        The quantile to estimate, between 0 and 1.
+    shape : tuple of int
+        Shape of the arrays to summarize.
+    '''
+
+    def __init__(self, p, shape):
+        self.p = p
+        self.count = 0
+        self._heights = np.zeros((5, ) + tuple(shape))
+        self._positions = np.zeros((5, ) + tuple(shape))
+        self._desired = np.array([1, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5])
+        self._increments = np.array([0, p / 2, p, (1 + p) / 2, 1])
+
+    def update(self, values):
+        '''Add one array of values to the summary.'''
+        q = self._heights
+        n = self._positions
+        if self.count < 5:
+            q[self.count] = values
+            self.count += 1
+            if self.count == 5:
+                q.sort(axis=0)
+                n[:] = np.arange(1, 6).reshape((5, ) + (1, ) * (q.ndim - 1))
+            return
+        self.count += 1
+
+        # find the cell containing each value, and update the extremes.
+        q[0] = np.minimum(q[0], values)
+        q[4] = np.maximum(q[4], values)
+        k = (values >= q[1]).astype(int) + (values >= q[2]) + (values >= q[3])
+        for i in range(1, 5):
+            n[i] += i > k
+        self._desired += self._increments
+
+        # move the middle markers toward their desired positions.
+        for i in (1, 2, 3):
+            d = self._desired[i] - n[i]
+            up = (d >= 1) & (n[i + 1] - n[i] > 1)
+            down = (d <= -1) & (n[i - 1] - n[i] < -1)
+            move = up | down
+            if not move.any():
+                continue
+            s = np.where(up, 1., -1.)
+            parabolic = q[i] + s / (n[i + 1] - n[i - 1]) * (
+                (n[i] - n[i - 1] + s) * (q[i + 1] - q[i]) / (n[i + 1] - n[i]) +
+                (n[i + 1] - n[i] - s) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+            linear = np.where(
+                up, q[i] + (q[i + 1] - q[i]) / (n[i + 1] - n[i]),
+                q[i] - (q[i - 1] - q[i]) / (n[i - 1] - n[i]))
+            ok = (q[i - 1] < parabolic) & (parabolic < q[i + 1])
+            q[i] = np.where(move, np.where(ok, parabolic, linear), q[i])
+            n[i] += np.where(move, s, 0)
+
+    @property
+    def value(self):
+        '''The current estimate of the quantile.'''
+        if self.count == 0:
+            return np.full(self._heights.shape[1:], np.nan)
+        if self.count <= 5:
+            return np.percentile(self._heights[:self.count], 100 * self.p,
+                                 axis=0)
+        return self._heights[2].copy()
+
+
+def _share(data):
+    '''Write an array to a temporary file for worker processes to map.'''
+    filename = shared._default_filename('.npy')
+    np.save(filename, np.asarray(data))
+    return filename
+
+
+class _Replica(object):
+    '''Run inverse kinematics and dynamics for replicas in one process.'''
+
+    def __init__(self, factory, noise, seed, start, end, ik_force, id_force,
+                 max_distance, max_iters, data_file=None):
+        self.factory = factory
+        self.noise = noise
+        self.seed = seed
+        self.start = start
+        self.end = end
+        self.ik_force = ik_force
+        self.id_force = id_force
+        self.max_distance = max_distance
+        self.max_iters = max_iters
+        self.data_file = data_file
+        self.world = None
+
+    def __call__(self, replica):
+        if self.world is None:
+            self.world = self.factory()
+            if self.data_file is None:
+                self.data = self.world.markers.data
+            else:
+                self.data = np.load(self.data_file, mmap_mode='r')
+            self.offsets = dict(self.world.markers.offsets)
+            self.initial = self.world.get_state_array(
+                self.world.skeleton.bodies)
+        world = self.world
+        markers = world.markers
+        skeleton = world.skeleton
+
+        rng = np.random.RandomState([self.seed, replica])
+        data, offsets = self.noise.perturb(self.data, self.offsets, rng)
+        markers.data = data
+        markers.process_data()
+        parallel._configure(markers, self.factory.marker_settings)
+        markers.set_offsets(offsets)
+
+        world.set_state_array(self.initial, skeleton.bodies)
+        skeleton.disable_motors()
+        skeleton.reset_controllers()
+        pose = world.settle_to_markers(self.start, self.max_distance,
+                                       self.max_iters, warm_start=False)
+        angles = np.array([
+            np.array(a, float) for a in world.inverse_kinematics(
+                self.start, self.end, max_force=self.ik_force)])
+        markers.detach()
+        torques = np.array([
+            np.array(t, float) for t in world.inverse_dynamics(
+                angles, states=pose, max_force=self.id_force)])
+        return torques.reshape((len(angles), skeleton.num_dofs))
+
+
+def inverse_dynamics(factory, noise, replicas=32, start=0, end=None,
+                     quantiles=(0.05, 0.5, 0.95), seed=None, processes=None,
+                     ik_force=20, id_force=100, max_distance=0.05,
+                     max_iters=300):
+    '''Compute inverse dynamics for an ensemble of perturbed marker data.
+
+    Parameters
+    ----------
+    factory : :class:`pagoda.parallel.WorldFactory`
+        Builds the world (with skeleton and marker data) used by each process.
+    noise : :class:`NoiseModel`
+        Describes how to perturb the marker data for each replica.
+    replicas : int, optional
+        Number of perturbed replicas to run. Defaults to 32.
+    start : int, optional
+        First frame of marker data to process. Defaults to 0.
+    end : int, optional
+        Stop before this frame of marker data. Defaults to the end of the
+        data, which requires building a world in this process to count the
+        frames.
+    quantiles : sequence of float, optional
+        Estimate these quantiles of the torques. Defaults to (0.05, 0.5,
+        0.95).
+    seed : int, optional
+        Seed for the random replicas. Replica i uses the seed (seed, i), so
+        results are the same for any number of processes. Defaults to a random
+        seed.
+    processes : int, optional
+        Number of worker processes. Defaults to the number of CPUs. If 1, all
+        replicas are run in this process.
+    ik_force : float, optional
+        Maximum motor force for inverse kinematics. Defaults to 20.
+    id_force : float, optional
+        Maximum motor force for inverse dynamics. Defaults to 100.
+    max_distance : float, optional
+        Settling threshold; see :func:`pagoda.cooper.World.settle_to_markers`.
+        Defaults to 0.05.
+    max_iters : int, optional
+        Maximum number of settling iterations for each replica. Defaults to
+        300.
+
+    Returns
+    -------
+    summary : dict
+        Contains "count", the number of replicas; "mean" and "std", arrays of
+        shape (end - start, num-dofs) giving the mean and standard deviation
+        of the joint torques; and "quantiles", a dictionary mapping each
+        requested quantile to an array of torque estimates of the same shape.
+    '''
+    pooled = processes != 1 and replicas != 1
+    world = factory() if end is None or pooled else None
+    if end is None:
+        end = world.markers.num_frames
+    if seed is None:
+        seed = np.random.randint(1 << 30)
+    args = (factory, noise, seed, start, end, ik_force, id_force,
+            max_distance, max_iters)
+
+    logging.info('inverse dynamics for %d replicas of frames %d-%d',
+                 replicas, start, end)
+    pool = data_file = None
+    if pooled:
+        # workers map this file instead of each keeping a copy of the data.
+        data_file = _share(world.markers.data)
+        del world
+
+    moments = estimates = None
+    try:
+        if pooled:
+            pool = multiprocessing.Pool(
+                processes, parallel._init_worker,
+                (_Replica, ) + args + (data_file, ))
+            results = pool.imap(parallel._run_task, range(replicas))
+        else:
+            replica = _Replica(*args)
+            results = (replica(i) for i in range(replicas))
+        for i, torques in enumerate(results):
+            if moments is None:
+                moments = Moments(torques.shape)
+                estimates = [Quantile(p, torques.shape) for p in quantiles]
+            moments.update(torques)
+            for estimate in estimates:
+                estimate.update(torques)
+            logging.info('finished replica %d of %d', i + 1, replicas)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if data_file is not None:
+            os.remove(data_file)
+
+    if moments is None:
+        return dict(count=0, mean=None, std=None, quantiles={})
+    return dict(count=moments.count,
+                mean=moments.mean,
+                std=moments.std,
+                quantiles=dict((e.p, e.value) for e in estimates))
@@ -0,0 +1,492 @@
+'''Run inverse kinematics for long trials using several processes.
+
+Inverse kinematics (see :func:`pagoda.cooper.World.inverse_kinematics`) is
+inherently sequential: each frame starts from the skeleton pose at the end of
+the previous frame. A long trial can still be processed in parallel by
+splitting it into windows that each start from a pose settled to the marker
+data (see :func:`pagoda.cooper.World.settle_to_markers`) a little before the
+window begins. The frames in this "warm-up" overlap are discarded, except for
+a short region just before the window, where results are linearly blended with
+the end of the previous window.
+
+Worker processes build their own worlds from a picklable
+:class:`WorldFactory`, so only small task descriptions and result arrays are
+sent between processes.
+
+This module also provides :func:`pipeline`, which computes inverse kinematics
+in a child process while inverse dynamics runs in the calling process, passing
+joint angles through a bounded buffer in shared memory.
+'''
+
+from __future__ import division
+
+import logging
+import multiprocessing
+import numpy as np
+import os
+
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+
+from . import cooper
+from . import shared
+
+# seconds between checks that the child process of pipeline() is alive.
+_POLL_INTERVAL = 0.5
+
+
+class WorldFactory(object):
+    '''A picklable recipe for building a :class:`pagoda.cooper.World`.
+
+    Parameters
+    ----------
+    skeleton : str
+        Name of a skeleton file; see :func:`pagoda.cooper.World.load_skeleton`.
+    markers : str
+        Name of a marker data file; see :func:`pagoda.cooper.World.load_markers`.
+    attachments : str
+        Name of a marker attachment file.
+    dt : float, optional
+        Time step for the world. Defaults to 1/60.
+    pid_params : dict, optional
+        PID parameters for the skeleton's joints.
+    settings : dict, optional
+        Attributes to set on the world after it is built, e.g. ``friction``.
+    marker_settings : dict, optional
+        Attributes to set on the world's :class:`pagoda.cooper.Markers`, e.g.
+        ``erp`` or ``cfms``. Values for array attributes fill the array.
+
+    Additional keyword arguments are passed to
+    :func:`pagoda.cooper.World.load_markers`.
+    '''
+
+    def __init__(self, skeleton, markers, attachments, dt=1. / 60,
+                 pid_params=None, settings=None, marker_settings=None, **kwargs):
+        self.skeleton = skeleton
+        self.markers = markers
+        self.attachments = attachments
+        self.dt = dt
+        self.pid_params = pid_params
+        self.settings = settings or {}
+        self.marker_settings = marker_settings or {}
+        self.kwargs = kwargs
+
+    def __call__(self):
+        '''Build a new world.
+
+        Returns
+        -------
+        world : :class:`pagoda.cooper.World`
+            A world with our skeleton and marker data loaded.
+        '''
+        world = cooper.World(dt=self.dt)
+        world.load_skeleton(self.skeleton, self.pid_params)
+        world.load_markers(self.markers, self.attachments, **self.kwargs)
+        _configure(world, self.settings)
+        _configure(world.markers, self.marker_settings)
+        return world
+
+
+def _configure(obj, settings):
+    '''Set attributes on an object, filling array attributes in place.'''
+    for name, value in sorted(settings.items()):
+        current = getattr(obj, name, None)
+        if isinstance(current, np.ndarray):
+            current[...] = value
+        else:
+            setattr(obj, name, value)
+
+
+class _Solver(object):
+    '''Run inverse kinematics for windows of a trial in one process.'''
+
+    def __init__(self, factory, max_force, max_distance, max_iters):
+        self.factory = factory
+        self.max_force = max_force
+        self.max_distance = max_distance
+        self.max_iters = max_iters
+        self.world = None
+        self.initial = None
+
+    def __call__(self, task):
+        first, stop = task
+        if self.world is None:
+            self.world = self.factory()
+            self.initial = self.world.get_state_array(
+                self.world.skeleton.bodies)
+        world = self.world
+        # every window starts from the same pose, so results do not depend on
+        # which windows a process has handled before.
+        world.set_state_array(self.initial, world.skeleton.bodies)
+        world.skeleton.disable_motors()
+        world.skeleton.reset_controllers()
+        world.settle_to_markers(first, self.max_distance, self.max_iters,
+                                warm_start=False)
+        angles = np.array([
+            np.array(a, float) for a in world.inverse_kinematics(
+                first, stop, max_force=self.max_force)])
+        return angles.reshape((stop - first, world.skeleton.num_dofs))
+
+
+class _Roller(object):
+    '''Run forward dynamics for torque variants in one process.'''
+
+    def __init__(self, factory, states, start, end):
+        self.factory = factory
+        self.states = states
+        self.start = start
+        self.end = end
+        self.world = None
+
+    def __call__(self, torques):
+        if self.world is None:
+            self.world = self.factory()
+        # controllers keep no state from variants rolled out before.
+        self.world.skeleton.reset_controllers()
+        return self.world.forward_dynamics(
+            torques, self.start, self.end, states=self.states)
+
+
+# solver for pool worker processes; see _init_worker.
+_solver = None
+
+
+def _init_worker(cls, *args):
+    global _solver
+    _solver = cls(*args)
+
+
+def _run_task(task):
+    return _solver(task)
+
+
+def windows(start, end, window, overlap):
+    '''Split a range of frames into overlapping windows.
+
+    Parameters
+    ----------
+    start : int
+        First frame in the range.
+    end : int
+        Stop before this frame.
+    window : int
+        Number of frames in each window, not counting the overlap.
+    overlap : int
+        Number of frames each window (except the first) extends before its
+        start.
+
+    Returns
+    -------
+    windows : list of (first, begin, stop) tuples
+        For each window, the first frame computed, the first frame the window
+        is responsible for, and the frame before which it stops.
+    '''
+    result = []
+    for begin in range(start, end, window):
+        result.append((max(start, begin - overlap), begin,
+                       min(end, begin + window)))
+    return result
+
+
+def inverse_kinematics(factory, start=0, end=None, window=2400, overlap=120,
+                       blend=None, processes=None, max_force=20,
+                       max_distance=0.05, max_iters=300):
+    '''Compute inverse kinematics for a trial in parallel windows.
+
+    Parameters
+    ----------
+    factory : :class:`WorldFactory`
+        Builds the world (with skeleton and marker data) used by each process.
+    start : int, optional
+        First frame of marker data to process. Defaults to 0.
+    end : int, optional
+        Stop before this frame of marker data. Defaults to the end of the
+        data, which requires building a world in this process to count the
+        frames.
+    window : int, optional
+        Number of frames each task is responsible for. Defaults to 2400.
+    overlap : int, optional
+        Number of frames each window starts before the frames it is
+        responsible for. Defaults to 120.
+    blend : int, optional
+        Number of frames at the end of each overlap where results are blended
+        linearly with the previous window. The remaining ``overlap - blend``
+        frames are discarded as warm-up. Defaults to ``overlap // 2``.
+    processes : int, optional
+        Number of worker processes. Defaults to the number of CPUs. If 1, all
+        windows are processed in this process.
+    max_force : float, optional
+        Maximum motor force for the skeleton; see
+        :func:`pagoda.cooper.World.inverse_kinematics`. Defaults to 20.
+    max_distance : float, optional
+        Settling threshold; see :func:`pagoda.cooper.World.settle_to_markers`.
+        Defaults to 0.05.
+    max_iters : int, optional
+        Maximum number of settling iterations at the start of each window.
+        Defaults to 300.
+
+    Returns
+    -------
+    angles : ndarray of shape (end - start, num-dofs)
+        Joint angles for each frame, identical regardless of the number of
+        processes.
+    seams : list of dict
+        One entry for each seam between windows, giving the "frame" where the
+        seam is, the "max" absolute angle difference between the two windows
+        over the blended frames, and the "final" maximum absolute difference
+        on the last blended frame.
+    '''
+    if end is None:
+        end = factory().markers.num_frames
+    if blend is None:
+        blend = overlap // 2
+    blend = min(blend, overlap)
+    tasks = windows(start, end, window, overlap)
+    args = (factory, max_force, max_distance, max_iters)
+
+    logging.info('inverse kinematics for frames %d-%d in %d windows',
+                 start, end, len(tasks))
+    if processes == 1 or len(tasks) == 1:
+        solver = _Solver(*args)
+        results = [solver((first, stop)) for first, _, stop in tasks]
+    else:
+        pool = multiprocessing.Pool(processes, _init_worker, (_Solver, ) + args)
+        try:
+            results = pool.map(_run_task, [(f, s) for f, _, s in tasks], 1)
+        finally:
+            pool.close()
+            pool.join()
+
+    angles = np.zeros((end - start, results[0].shape[1]))
+    seams = []
+    for (first, begin, stop), result in zip(tasks, results):
+        angles[begin - start:stop - start] = result[begin - first:]
+        n = min(blend, begin - first)
+        if begin == start or n == 0:
+            continue
+        lo = begin - n - start
+        prev = angles[lo:begin - start]
+        new = result[begin - first - n:begin - first]
+        diff = abs(new - prev)
+        seams.append(dict(frame=begin, max=float(diff.max()),
+                          final=float(diff[-1].max())))
+        w = (np.arange(1, n + 1) / (n + 1))[:, None]
+        angles[lo:begin - start] = (1 - w) * prev + w * new
+    for seam in seams:
+        logging.info('seam at frame %(frame)d: max difference %(max).4f, '
+                     'final difference %(final).4f', seam)
+    return angles, seams
+
+
+def forward_dynamics(factory, torques, states, start=0, end=None,
+                     processes=None, angles_out=None, states_out=None):
+    '''Run forward dynamics for several torque variants in parallel.
+
+    Every variant starts from the same skeleton state, so this can be used to
+    replay inverse dynamics torques, or to study the effect of perturbing
+    them.
+
+    Parameters
+    ----------
+    factory : :class:`WorldFactory`
+        Builds the world used by each process.
+    torques : ndarray of shape (num-variants, num-frames, num-dofs)
+        Torques to apply for each variant.
+    states : ndarray of shape (num-bodies, 13)
+        Skeleton body states to start each variant from (see
+        :func:`pagoda.physics.World.get_state_array`).
+    start : int, optional
+        Start applying torques at this frame. Defaults to 0.
+    end : int, optional
+        Stop before this frame. Defaults to the end of the torque data.
+    processes : int, optional
+        Number of worker processes. Defaults to the number of CPUs. If 1, all
+        variants are run in this process.
+    angles_out : ndarray of shape (num-variants, end - start, num-dofs)
+        Store joint angles for each variant in this array. A new array is
+        allocated if this is not given.
+    states_out : ndarray of shape (num-variants, end - start, num-bodies, 13)
+        Store body states for each variant in this array. A new array is
+        allocated if this is not given.
+
+    Returns
+    -------
+    angles : ndarray of shape (num-variants, end - start, num-dofs)
+        Joint angles after each step of each variant.
+    states : ndarray of shape (num-variants, end - start, num-bodies, 13)
+        Body states after each step of each variant.
+    '''
+    torques = np.asarray(torques)
+    states = np.asarray(states, float)
+    end = torques.shape[1] if end is None else min(end, torques.shape[1])
+    n = max(0, end - start)
+    args = (factory, states, start, end)
+    if processes == 1 or len(torques) == 1:
+        roller = _Roller(*args)
+        results = (roller(t) for t in torques)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(processes, _init_worker, (_Roller, ) + args)
+        results = pool.imap(_run_task, torques)
+    try:
+        for i, (angles, body_states) in enumerate(results):
+            if angles_out is None:
+                angles_out = np.zeros((len(torques), n, angles.shape[1]))
+            if states_out is None:
+                states_out = np.zeros((len(torques), ) + body_states.shape)
+            angles_out[i] = angles
+            states_out[i] = body_states
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return angles_out, states_out
+
+
+def _pipeline_arrays(filename, slots, dofs, bodies, mode):
+    '''Map the pose and angle-slot arrays for a pipeline buffer file.'''
+    pose = np.memmap(filename, np.float64, mode, 0, (bodies, 13))
+    angles = np.memmap(filename, np.float64, mode, pose.nbytes, (slots, dofs))
+    return pose, angles
+
+
+def _produce(factory, filename, slots, free, ready, start, end, max_force,
+             max_distance, max_iters):
+    '''Run the inverse kinematics stage of a pipeline.'''
+    try:
+        world = factory()
+        skeleton = world.skeleton
+        pose, angles = _pipeline_arrays(
+            filename, slots, skeleton.num_dofs, len(skeleton.bodies), 'r+')
+        world.settle_to_markers(start, max_distance, max_iters)
+        world.get_state_array(skeleton.bodies, out=pose)
+        ready.put(('pose', -1))
+        frames = world.inverse_kinematics(start, end, max_force=max_force)
+        for i, values in enumerate(frames):
+            free.acquire()
+            angles[i % slots] = values
+            ready.put((start + i, i % slots))
+        ready.put(None)
+    except Exception as err:
+        logging.exception('inverse kinematics stage failed')
+        ready.put(('error', repr(err)))
+
+
+def pipeline(factory, start=0, end=1e100, id_factory=None, slots=64,
+             ik_force=20, id_force=100, max_distance=0.05, max_iters=300,
+             timeout=None):
+    '''Compute inverse kinematics and inverse dynamics concurrently.
+
+    A child process settles a world to the marker data at frame ``start`` and
+    then computes inverse kinematics, writing joint angles into a ring of
+    ``slots`` frames in shared memory. Meanwhile, this process starts from
+    the settled pose and computes inverse dynamics for each frame of angles as
+    soon as it is available. The child blocks when all slots are full, so
+    memory use does not depend on the length of the trial.
+
+    Parameters
+    ----------
+    factory : :class:`WorldFactory`
+        Builds the world used for inverse kinematics.
+    start : int, optional
+        First frame of marker data to process. Defaults to 0.
+    end : int, optional
+        Stop before this frame of marker data. Defaults to the end of the
+        data.
+    id_factory : :class:`WorldFactory`, optional
+        Builds the world used for inverse dynamics. Defaults to ``factory``.
+    slots : int, optional
+        Number of frames of angles that can be buffered. Defaults to 64.
+    ik_force : float, optional
+        Maximum motor force for inverse kinematics. Defaults to 20.
+    id_force : float, optional
+        Maximum motor force for inverse dynamics. Defaults to 100.
+    max_distance : float, optional
+        Settling threshold; see :func:`pagoda.cooper.World.settle_to_markers`.
+        Defaults to 0.05.
+    max_iters : int, optional
+        Maximum number of settling iterations. Defaults to 300.
+    timeout : float, optional
+        Raise an error if the child process sends nothing for this many
+        seconds. Defaults to None, which waits as long as the child process is
+        alive.
+
+    Returns
+    -------
+    frames : sequence of (frame-no, angles, torques) tuples
+        A generator of joint angles and torques for each frame.
+
+    Raises
+    ------
+    RuntimeError
+        If inverse kinematics fails, the child process exits without
+        finishing, or ``timeout`` expires.
+    '''
+    world = (id_factory or factory)()
+    skeleton = world.skeleton
+    filename = shared._default_filename()
+    with open(filename, 'wb') as handle:
+        handle.truncate(8 * (13 * len(skeleton.bodies) +
+                             slots * skeleton.num_dofs))
+    pose, angles = _pipeline_arrays(
+        filename, slots, skeleton.num_dofs, len(skeleton.bodies), 'r+')
+
+    free = multiprocessing.Semaphore(slots)
+    ready = multiprocessing.Queue()
+    child = multiprocessing.Process(target=_produce, args=(
+        factory, filename, slots, free, ready, start, end, ik_force,
+        max_distance, max_iters))
+    child.daemon = True
+    child.start()
+
+    current = [None, None]
+
+    def receive():
+        waited = 0
+        while True:
+            try:
+                msg = ready.get(timeout=_POLL_INTERVAL)
+                break
+            except queue.Empty:
+                waited += _POLL_INTERVAL
+            if not child.is_alive():
+                # the child may have sent its last message just before exiting.
+                try:
+                    msg = ready.get(timeout=_POLL_INTERVAL)
+                    break
+                except queue.Empty:
+                    raise RuntimeError(
+                        'inverse kinematics process exited with code {}'
+                        .format(child.exitcode))
+            if timeout is not None and waited >= timeout:
+                raise RuntimeError('inverse kinematics process sent nothing '
+                                   'for {} seconds'.format(waited))
+        if msg is not None and msg[0] == 'error':
+            raise RuntimeError('inverse kinematics failed: ' + msg[1])
+        return msg
+
+    def frames():
+        while True:
+            msg = receive()
+            if msg is None:
+                return
+            frame_no, slot = msg
+            current[:] = frame_no, np.array(angles[slot])
+            free.release()
+            yield current[1]
+
+    try:
+        receive()
+        world.set_state_array(pose, skeleton.bodies)
+        for torques in world.inverse_dynamics(frames(), max_force=id_force):
+            yield current[0], current[1], torques
+        child.join()
+    finally:
+        if child.is_alive():
+            child.terminate()
+            child.join()
+        del pose, angles
+        if os.path.exists(filename):
+            os.unlink(filename)
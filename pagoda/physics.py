@@ -5,11 +5,22 @@ from __future__ import division
 import collections
 import numpy as np
 import ode
+import timeit
 
 
 BodyState = collections.namedtuple(
     'BodyState', 'name position quaternion linear_velocity angular_velocity')
 
+# each row of a body state array holds position (3), quaternion (4), linear
+# velocity (3) and angular velocity (3) for one body.
+STATE_WIDTH = 13
+STATE_FIELDS = collections.OrderedDict([
+    ('position', slice(0, 3)),
+    ('quaternion', slice(3, 7)),
+    ('linear_velocity', slice(7, 10)),
+    ('angular_velocity', slice(10, 13)),
+])
+
 
 class Registrar(type):
     '''A metaclass that builds a registry of its subclasses.'''
@@ -33,9 +44,14 @@ class Body(Registrar(str('Base'), (), {})):
     This class basically provides lots of Python-specific properties that call
     the equivalent ODE getters and setters for things like position, rotation,
     etc.
+
+    Bodies created with ``collide=False`` get a geometry that is not placed in
+    the world's collision space, so they never take part in collision
+    detection.
     '''
 
-    def __init__(self, name, world, density=1000., mass=None, **shape):
+    def __init__(self, name, world, density=1000., mass=None, collide=True,
+                 **shape):
         self.name = name
         self.world = world
         self.shape = shape
@@ -45,7 +61,7 @@ class Body(Registrar(str('Base'), (), {})):
         self.ode_body = ode.Body(world.ode_world)
         self.ode_body.setMass(m)
         self.ode_geom = getattr(ode, 'Geom%s' % self.__class__.__name__)(
-            world.ode_space, **shape)
+            world.ode_space if collide else None, **shape)
         self.ode_geom.setBody(self.ode_body)
 
     def __str__(self):
@@ -1103,6 +1119,220 @@ def center_of_mass(bodies):
     return x / t
 
 
+class LazyStates(object):
+    '''A sequence of body states that are read from the world on demand.
+
+    Nothing is read from the simulation until the states are first accessed,
+    either as a sequence of :class:`BodyState` tuples or as an array (see
+    :func:`World.get_state_array`). Once :func:`expire` has been called (e.g.
+    because the simulation has moved on), states that were never read can no
+    longer be accessed.
+
+    Parameters
+    ----------
+    world : :class:`World`
+        The world containing the bodies.
+    bodies : sequence of :class:`Body`
+        The bodies whose states are held.
+    array : ndarray of shape (num-bodies, 13), optional
+        States that have already been read from the world.
+    '''
+
+    def __init__(self, world, bodies, array=None):
+        self.world = world
+        self.bodies = bodies
+        self._array = array
+        self._states = None
+        self._expired = False
+
+    def expire(self):
+        '''Prevent states that have not been read yet from being read.'''
+        self._expired = True
+
+    @property
+    def array(self):
+        '''The states of our bodies as an array of shape (num-bodies, 13).'''
+        if self._array is None:
+            if self._expired:
+                raise RuntimeError(
+                    'body states must be read before the simulation advances')
+            self._array = self.world.get_state_array(self.bodies)
+        return self._array
+
+    def _materialize(self):
+        if self._states is None:
+            self._states = [
+                BodyState(b.name, tuple(r[0:3]), tuple(r[3:7]),
+                          tuple(r[7:10]), tuple(r[10:13]))
+                for b, r in zip(self.bodies, self.array.tolist())]
+        return self._states
+
+    def __len__(self):
+        return len(self.bodies)
+
+    def __iter__(self):
+        return iter(self._materialize())
+
+    def __getitem__(self, idx):
+        return self._materialize()[idx]
+
+    def __eq__(self, other):
+        return self._materialize() == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(self._materialize())
+
+
+class Stats(object):
+    '''Per-step timers and counters for a :class:`World`.
+
+    While enabled, the world records for each step:
+
+    - step_time: wall time for the whole step (seconds)
+    - collide_time: time spent in collision detection, including Python
+      collision callbacks (seconds)
+    - solver_time: time spent in the ODE solver (seconds)
+    - pairs: number of broadphase geometry pairs handed to Python
+    - contacts: number of contact joints created
+    - ode_calls: number of calls into the ODE bindings made while stepping
+      (clearing contacts, collision detection and its callbacks, the solver)
+      and by :func:`World.get_state_array`, :func:`World.set_state_array`
+      and hooks; calls made elsewhere, e.g. by joint accessors, are not
+      counted
+
+    Values for the most recent steps are kept in a rolling window, from which
+    summaries and histograms can be computed.
+
+    Parameters
+    ----------
+    enabled : bool, optional
+        Record statistics iff this is True. When disabled, stepping the world
+        costs a few attribute checks more than without any instrumentation.
+        Defaults to False.
+    history : int, optional
+        Number of recent steps to keep in the rolling window. Defaults to 1000.
+    '''
+
+    FIELDS = ('step_time', 'collide_time', 'solver_time',
+              'pairs', 'contacts', 'ode_calls')
+
+    def __init__(self, enabled=False, history=1000):
+        self.enabled = enabled
+        self.history = history
+        self.reset()
+
+    def reset(self):
+        '''Discard all recorded statistics.'''
+        self.steps = 0
+        self._window = np.zeros((self.history, len(self.FIELDS)), float)
+        self._clear()
+
+    def _clear(self):
+        for field in self.FIELDS:
+            setattr(self, field, 0)
+
+    def end_step(self):
+        '''Record the counters for the current step and zero them.'''
+        row = self._window[self.steps % self.history]
+        for i, field in enumerate(self.FIELDS):
+            row[i] = getattr(self, field)
+        self.steps += 1
+        self._clear()
+
+    @property
+    def window(self):
+        '''Array of recorded values, one row per step in the rolling window.'''
+        return self._window[:min(self.steps, self.history)]
+
+    def values(self, field):
+        '''Get recorded values for one field in the rolling window.'''
+        return self.window[:, self.FIELDS.index(field)]
+
+    def histogram(self, field, bins=20):
+        '''Compute a histogram of recorded values for one field.
+
+        Parameters
+        ----------
+        field : str
+            Name of the field to summarize, e.g. "collide_time".
+        bins : int or sequence of float, optional
+            Bins for the histogram; see ``numpy.histogram``. Defaults to 20.
+
+        Returns
+        -------
+        counts : ndarray
+            Number of steps in each bin.
+        edges : ndarray
+            Edges of the histogram bins.
+        '''
+        return np.histogram(self.values(field), bins=bins)
+
+    def snapshot(self):
+        '''Summarize recorded statistics in the rolling window.
+
+        Returns
+        -------
+        summary : dict
+            Maps each field name to a dictionary of summary values ("mean",
+            "std", "min", "p50", "p90", "p99" and "max"). The "steps" key holds
+            the total number of recorded steps.
+        '''
+        summary = dict(steps=self.steps)
+        window = self.window
+        for i, field in enumerate(self.FIELDS):
+            x = window[:, i] if len(window) else np.zeros(1)
+            p50, p90, p99 = np.percentile(x, [50, 90, 99])
+            summary[field] = dict(mean=x.mean(), std=x.std(), min=x.min(),
+                                  p50=p50, p90=p90, p99=p99, max=x.max())
+        return summary
+
+
+class Hook(object):
+    '''Base class for plug-ins that run as part of each step of a world.
+
+    Hooks in :attr:`World.hooks` run, in order, at three stages of each step,
+    whether the world is advanced by :func:`World.step` or by one of the
+    marker-following and dynamics methods of :class:`pagoda.cooper.World`:
+
+    - ``pre_collide``: before collision detection,
+    - ``pre_step``: after collision detection, before the ODE solver runs,
+    - ``post_step``: after the ODE solver has advanced the world.
+
+    At each stage, every hook receives the world and an array of the current
+    states of all bodies in the world (sorted by name; see
+    :func:`World.get_state_array`). A hook may return None, or a dictionary
+    containing any of the following arrays of shape (num-bodies, 3):
+
+    - "force" and "torque": added to each body, in world coordinates, for the
+      next step of the ODE solver (including all of its substeps),
+    - "linear_velocity" and "angular_velocity": set on each body.
+
+    Results from all hooks in a stage are applied to the world in one pass
+    after the stage has run.
+
+    Parameters
+    ----------
+    every : int, optional
+        Run this hook only on steps whose frame number is a multiple of this
+        value. Defaults to 1, i.e., run on every step.
+    '''
+
+    def __init__(self, every=1):
+        self.every = every
+
+    def pre_collide(self, world, states):
+        pass
+
+    def pre_step(self, world, states):
+        pass
+
+    def post_step(self, world, states):
+        pass
+
+
 class World(object):
     '''A wrapper for an ODE World object, for running in a simulator.'''
 
@@ -1124,6 +1354,12 @@ class World(object):
         self._bodies = {}
         self._joints = {}
 
+        self.stats = Stats()
+
+        # plug-ins that run at fixed points during every step; see Hook.
+        self.hooks = []
+        self._hook_forces = None
+
     @property
     def gravity(self):
         '''Current gravity vector in the world.'''
@@ -1338,6 +1574,60 @@ class World(object):
         for state in states:
             self.get_body(state.name).state = state
 
+    def get_state_array(self, bodies=None, out=None):
+        '''Return the states of some bodies as one numeric array.
+
+        Parameters
+        ----------
+        bodies : sequence of :class:`Body`, optional
+            Get states for these bodies. Defaults to all bodies in the world,
+            sorted by name.
+        out : ndarray of shape (num-bodies, 13), optional
+            If given, write states into this array instead of allocating one.
+
+        Returns
+        -------
+        states : ndarray of shape (num-bodies, 13)
+            One row for each body, holding its position, quaternion, linear
+            velocity and angular velocity. See ``STATE_FIELDS``.
+        '''
+        if bodies is None:
+            bodies = list(self.bodies)
+        if out is None:
+            out = np.empty((len(bodies), STATE_WIDTH), float)
+        for row, b in zip(out, bodies):
+            body = b.ode_body
+            row[0:3] = body.getPosition()
+            row[3:7] = body.getQuaternion()
+            row[7:10] = body.getLinearVel()
+            row[10:13] = body.getAngularVel()
+        if self.stats.enabled:
+            self.stats.ode_calls += 4 * len(out)
+        return out
+
+    def set_state_array(self, states, bodies=None):
+        '''Set the states of some bodies from one numeric array.
+
+        Parameters
+        ----------
+        states : ndarray of shape (num-bodies, 13)
+            An array of body states. See :func:`get_state_array`.
+        bodies : sequence of :class:`Body`, optional
+            Set states for these bodies. Defaults to all bodies in the world,
+            sorted by name.
+        '''
+        if bodies is None:
+            bodies = list(self.bodies)
+        assert len(bodies) == len(states)
+        for row, b in zip(np.asarray(states, float).tolist(), bodies):
+            body = b.ode_body
+            body.setPosition(row[0:3])
+            body.setQuaternion(row[3:7])
+            body.setLinearVel(row[7:10])
+            body.setAngularVel(row[10:13])
+        if self.stats.enabled:
+            self.stats.ode_calls += 4 * len(bodies)
+
     def step(self, substeps=2):
         '''Step the world forward by one frame.
 
@@ -1347,12 +1637,127 @@ class World(object):
             Split the step into this many sub-steps. This helps to prevent the
             time delta for an update from being too large.
         '''
+        for _ in self._step(self.dt / substeps, substeps):
+            pass
+
+    def _step(self, dt, substeps=1):
+        '''Advance the world by one frame, running :attr:`hooks`.
+
+        This method returns a generator that yields once in each substep,
+        after collision detection and just before the ODE solver runs, so that
+        callers can set motor targets or add forces for the substep. The
+        generator must be exhausted to complete the step. Statistics for the
+        step are recorded in :attr:`stats`.
+
+        Parameters
+        ----------
+        dt : float
+            Time step for each substep.
+        substeps : int, optional
+            Number of substeps. Defaults to 1.
+
+        Returns
+        -------
+        substeps : sequence of int
+            A generator of substep indices.
+        '''
         self.frame_no += 1
-        dt = self.dt / substeps
-        for _ in range(substeps):
-            self.ode_contactgroup.empty()
+        hooks = [h for h in self.hooks if self.frame_no % h.every == 0]
+        stats = self.stats
+        start = timeit.default_timer() if stats.enabled else None
+        self._run_hooks(hooks, 'pre_collide')
+        for i in range(substeps):
+            self._collide()
+            if i == 0:
+                self._run_hooks(hooks, 'pre_step')
+            yield i
+            self._apply_hook_forces()
+            self._solve(dt)
+        self._hook_forces = None
+        self._run_hooks(hooks, 'post_step')
+        if start is not None:
+            stats.step_time = timeit.default_timer() - start
+            stats.end_step()
+
+    def _collide(self):
+        '''Replace all contact joints using collision detection.'''
+        self.ode_contactgroup.empty()
+        if not self.stats.enabled:
             self.ode_space.collide(None, self.on_collision)
+            return
+        start = timeit.default_timer()
+        self.ode_space.collide(None, self.on_collision)
+        self.stats.collide_time += timeit.default_timer() - start
+        self.stats.ode_calls += 2
+
+    def _solve(self, dt):
+        '''Advance the ODE world by one step of the solver.'''
+        if not self.stats.enabled:
             self.ode_world.step(dt)
+            return
+        start = timeit.default_timer()
+        self.ode_world.step(dt)
+        self.stats.solver_time += timeit.default_timer() - start
+        self.stats.ode_calls += 1
+
+    def _run_hooks(self, hooks, stage):
+        '''Run one stage of the hook pipeline and apply its results.
+
+        Each hook sees the body states as updated by hooks earlier in the
+        pipeline. Velocities returned by hooks are set on all bodies in one pass
+        after the stage is done; forces and torques are summed over hooks and
+        held until the end of the next ODE step (see :class:`Hook`).
+
+        Parameters
+        ----------
+        hooks : sequence of :class:`Hook`
+            Run these hooks, in order.
+        stage : str
+            Name of the stage to run: "pre_collide", "pre_step" or "post_step".
+        '''
+        # skip reading states for hooks that do nothing at this stage.
+        base = getattr(Hook, stage)
+        hooks = [h for h in hooks if getattr(type(h), stage) != base]
+        if not hooks:
+            return
+        bodies = list(self.bodies)
+        states = self.get_state_array(bodies)
+        moved = False
+        held = self._hook_forces
+        if held is not None and held[0] != bodies:
+            held = None
+        for hook in hooks:
+            effects = getattr(hook, stage)(self, states)
+            if not effects:
+                continue
+            for key in ('linear_velocity', 'angular_velocity'):
+                if key in effects:
+                    states[:, STATE_FIELDS[key]] = effects[key]
+                    moved = True
+            for i, key in enumerate(('force', 'torque')):
+                if key in effects:
+                    if held is None:
+                        held = bodies, np.zeros((len(bodies), 3)), \
+                            np.zeros((len(bodies), 3))
+                    held[i + 1][:] += effects[key]
+        if moved:
+            for b, row in zip(bodies, states[:, 7:].tolist()):
+                b.ode_body.setLinearVel(row[0:3])
+                b.ode_body.setAngularVel(row[3:6])
+            if self.stats.enabled:
+                self.stats.ode_calls += 2 * len(bodies)
+        self._hook_forces = held
+
+    def _apply_hook_forces(self):
+        '''Add forces and torques held from the hook pipeline to bodies.'''
+        if self._hook_forces is None:
+            return
+        bodies, forces, torques = self._hook_forces
+        for b, f, t in zip(bodies, forces.tolist(), torques.tolist()):
+            b.ode_body.addForce(f)
+            b.ode_body.addTorque(t)
+        if self.stats.enabled:
+            self.stats.ode_calls += 2 * len(bodies)
 
     def needs_reset(self):
         '''Return True iff the world needs to be reset.'''
@@ -1403,12 +1808,20 @@ class World(object):
         '''
         body_a = geom_a.getBody()
         body_b = geom_b.getBody()
-        if ode.areConnected(body_a, body_b) or \
-           (body_a and body_a.isKinematic()) or \
-           (body_b and body_b.isKinematic()):
-            return
-        for c in ode.collide(geom_a, geom_b):
+        calls = 3
+        skip = ode.areConnected(body_a, body_b)
+        for body in (body_a, body_b):
+            if body and not skip:
+                calls += 1
+                skip = body.isKinematic()
+        contacts = () if skip else ode.collide(geom_a, geom_b)
+        for c in contacts:
             c.setBounce(self.elasticity)
             c.setMu(self.friction)
             ode.ContactJoint(self.ode_world, self.ode_contactgroup, c).attach(
-                geom_a.getBody(), geom_b.getBody())
+                body_a, body_b)
+        stats = self.stats
+        if stats.enabled:
+            stats.pairs += 1
+            stats.contacts += len(contacts)
+            stats.ode_calls += calls + (not skip) + 4 * len(contacts)
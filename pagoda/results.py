@@ -0,0 +1,293 @@
+'''Labeled, memory-mappable storage for inverse kinematics and dynamics results.
+
+A result store is a directory that holds one raw binary file for each group of
+values -- for example joint angles, joint torques, marker residuals or body
+states -- plus a JSON metadata file. Every frame of a group is a fixed-size row
+of little-endian floats, so a whole group can be memory-mapped without reading
+it, and single columns can be selected by label as views of the mapped array.
+
+Frames are buffered in memory in chunks and appended to the group files, so the
+memory used while writing does not grow with the length of a recording. The
+metadata (labels, frame counts, the world time step, a hash of the skeleton and
+any parameters given by the caller) are rewritten after each chunk, so a store
+can be read while it is still being written.
+
+The directory layout is::
+
+    meta.json
+    angles.f8 | torques.f8 | residuals.f8 | states.f8 | ...
+'''
+
+from __future__ import division
+
+import json
+import numpy as np
+import os
+
+from . import physics
+
+DTYPE = '<f8'
+
+
+class Writer(object):
+    '''Append labeled frames of results to a store.
+
+    The groups "angles" and "torques" (labeled with
+    :func:`pagoda.skeleton.Skeleton.dof_labels`), "residuals" (marker
+    distances, labeled with marker names) and "states" (skeleton body states,
+    labeled with body names) are created as needed; other groups can be added
+    with :func:`add_group`.
+
+    Parameters
+    ----------
+    root : str
+        Directory for the store. It is created if needed. Files for groups
+        that already exist in the directory are overwritten.
+    world : :class:`pagoda.cooper.World`
+        Label results using the skeleton and markers in this world.
+    params : dict, optional
+        JSON-serializable parameters to store with the results, e.g. the
+        settings used to compute them.
+    chunk_frames : int, optional
+        Buffer this many frames of each group before appending them to disk.
+        Defaults to 256.
+    '''
+
+    def __init__(self, root, world, params=None, chunk_frames=256):
+        self.root = root
+        self.world = world
+        self.params = dict(params or {})
+        self.chunk_frames = chunk_frames
+        self._groups = {}
+        if not os.path.isdir(root):
+            os.makedirs(root)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _default_group(self, name):
+        '''Get labels and row shape for one of the standard groups.'''
+        skeleton = self.world.skeleton
+        if name in ('angles', 'torques'):
+            return skeleton.dof_labels, ()
+        if name == 'residuals':
+            return list(self.world.markers.labels), (3, )
+        if name == 'states':
+            return [b.name for b in skeleton.bodies], (physics.STATE_WIDTH, )
+        raise KeyError('unknown group {}'.format(name))
+
+    def add_group(self, name, labels, shape=()):
+        '''Add a group of labeled values to the store.
+
+        Parameters
+        ----------
+        name : str
+            Name of the group.
+        labels : sequence of str
+            One label for each column of the group.
+        shape : tuple of int, optional
+            Shape of the values stored under each label in one frame. Defaults
+            to (), i.e. one number per label.
+        '''
+        if name in self._groups:
+            raise ValueError('group {} already exists'.format(name))
+        labels = list(labels)
+        shape = tuple(shape)
+        self._groups[name] = dict(
+            labels=labels,
+            shape=shape,
+            frames=0,
+            count=0,
+            buffer=np.zeros((self.chunk_frames, len(labels)) + shape, DTYPE),
+            handle=open(os.path.join(self.root, name + '.f8'), 'wb'),
+        )
+
+    def num_frames(self, name):
+        '''Get the number of frames appended to a group so far.'''
+        group = self._groups.get(name)
+        return 0 if group is None else group['frames'] + group['count']
+
+    def append(self, **values):
+        '''Append one frame of values to one or more groups.
+
+        Parameters
+        ----------
+        values : array-like
+            Values to append, keyed by group name; each value must have shape
+            (num-labels, ...) for its group.
+        '''
+        for name, value in values.items():
+            if name not in self._groups:
+                self.add_group(name, *self._default_group(name))
+            group = self._groups[name]
+            group['buffer'][group['count']] = value
+            group['count'] += 1
+            if group['count'] == self.chunk_frames:
+                self._flush_group(group)
+                self._write_meta()
+
+    def record(self, frames, name='angles', residuals=False, states=False):
+        '''Append every frame from a result generator.
+
+        Parameters
+        ----------
+        frames : iterable
+            A sequence of values, one per frame -- e.g. the generators returned
+            by :func:`pagoda.cooper.World.inverse_kinematics` or
+            :func:`pagoda.cooper.World.inverse_dynamics`.
+        name : str, optional
+            Append values to this group. Defaults to "angles".
+        residuals : bool, optional
+            If True, also append the marker distances in the world after each
+            frame to the "residuals" group. Defaults to False.
+        states : bool, optional
+            If True, also append the skeleton body states in the world after
+            each frame to the "states" group. Defaults to False.
+
+        Returns
+        -------
+        count : int
+            The number of frames appended.
+        '''
+        count = 0
+        bodies = self.world.skeleton.bodies
+        for value in frames:
+            values = {name: value}
+            if residuals:
+                values['residuals'] = self.world.markers.distances()
+            if states:
+                values['states'] = self.world.get_state_array(bodies)
+            self.append(**values)
+            count += 1
+        return count
+
+    def _flush_group(self, group):
+        '''Append buffered frames of one group to its file.'''
+        if group['count']:
+            group['handle'].write(group['buffer'][:group['count']].tobytes())
+            group['handle'].flush()
+            group['frames'] += group['count']
+            group['count'] = 0
+
+    def _write_meta(self):
+        '''Write the metadata file, replacing any previous one.'''
+        skeleton = getattr(self.world, 'skeleton', None)
+        meta = dict(
+            dt=self.world.dt,
+            skeleton=skeleton.digest() if skeleton is not None else None,
+            params=self.params,
+            groups=dict((name, dict(labels=g['labels'], shape=g['shape'],
+                                    frames=g['frames']))
+                        for name, g in self._groups.items()),
+        )
+        path = os.path.join(self.root, 'meta.json')
+        with open(path + '.tmp', 'w') as handle:
+            json.dump(meta, handle, default=repr)
+        os.rename(path + '.tmp', path)
+
+    def flush(self):
+        '''Append all buffered frames to disk and update the metadata.'''
+        for group in self._groups.values():
+            self._flush_group(group)
+        self._write_meta()
+
+    def close(self):
+        '''Flush buffered frames and close the group files.'''
+        if self._groups is None:
+            return
+        self.flush()
+        for group in self._groups.values():
+            group['handle'].close()
+        self._groups = None
+
+
+class Reader(object):
+    '''Read labeled results from a store created by :class:`Writer`.
+
+    Parameters
+    ----------
+    root : str
+        Directory of the store.
+
+    Attributes
+    ----------
+    dt : float
+        Time step of the world that produced the results.
+    skeleton : str
+        Hash of the skeleton that produced the results; see
+        :func:`pagoda.skeleton.Skeleton.digest`.
+    params : dict
+        Parameters stored with the results.
+    groups : list of str
+        Names of the groups in the store.
+    '''
+
+    def __init__(self, root):
+        self.root = root
+        with open(os.path.join(root, 'meta.json')) as handle:
+            meta = json.load(handle)
+        self.dt = meta['dt']
+        self.skeleton = meta['skeleton']
+        self.params = meta['params']
+        self._meta = meta['groups']
+        self.groups = sorted(self._meta)
+        self._arrays = {}
+
+    def labels(self, name):
+        '''Get the column labels for a group.'''
+        return self._meta[name]['labels']
+
+    def num_frames(self, name):
+        '''Get the number of frames stored in a group.'''
+        return self._meta[name]['frames']
+
+    def __getitem__(self, name):
+        '''Get all values in a group.
+
+        Returns
+        -------
+        values : ndarray of shape (num-frames, num-labels, ...)
+            A read-only, memory-mapped array of the values in the group.
+        '''
+        if name not in self._arrays:
+            meta = self._meta[name]
+            shape = (meta['frames'], len(meta['labels'])) + tuple(meta['shape'])
+            if meta['frames']:
+                values = np.memmap(os.path.join(self.root, name + '.f8'),
+                                   dtype=DTYPE, mode='r', shape=shape)
+            else:
+                values = np.zeros(shape, DTYPE)
+                values.flags.writeable = False
+            self._arrays[name] = values
+        return self._arrays[name]
+
+    def get(self, name, label):
+        '''Get the values for one label in a group.
+
+        Parameters
+        ----------
+        name : str
+            Name of the group.
+        label : str
+            A column label, e.g. "hip:0" for the first degree of freedom of
+            the "hip" joint. A joint name, e.g. "hip", selects all of the
+            columns labeled "hip:N".
+
+        Returns
+        -------
+        values : ndarray
+            A view of the requested columns. A single label gives an array of
+            shape (num-frames, ...), and a joint name gives an array of shape
+            (num-frames, num-dofs, ...).
+        '''
+        labels = self.labels(name)
+        if label in labels:
+            return self[name][:, labels.index(label)]
+        prefix = label + ':'
+        idx = [i for i, l in enumerate(labels) if l.startswith(prefix)]
+        if not idx:
+            raise KeyError('{}: unknown label {}'.format(name, label))
+        return self[name][:, idx[0]:idx[-1] + 1]
@@ -0,0 +1,382 @@
+'''Host simulation worlds in a local server process.
+
+A :class:`Server` holds one or more named worlds (e.g. a
+:class:`pagoda.cooper.World` with a skeleton and marker data already loaded) and
+listens on a Unix socket or a localhost TCP port. Clients send batches of
+commands -- set arrays, step some frames, get arrays -- and receive all of the
+results in one reply, so the cost of building and warming up a world is paid
+once for all clients.
+
+Messages in both directions are framed as::
+
+    header length (4 bytes, big-endian) | JSON header | array payloads
+
+The JSON header describes the commands (or results) along with the dtype and
+shape of each array; array data follow as raw bytes, so numeric data are never
+encoded as JSON text.
+'''
+
+from __future__ import division
+
+import json
+import logging
+import numpy as np
+import socket
+import struct
+import threading
+
+try:
+    import socketserver
+except ImportError:  # python 2
+    import SocketServer as socketserver
+
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+
+
+def _recv_exactly(sock, size):
+    '''Read exactly ``size`` bytes from a socket.'''
+    buf = bytearray(size)
+    view = memoryview(buf)
+    got = 0
+    while got < size:
+        n = sock.recv_into(view[got:], size - got)
+        if not n:
+            raise EOFError('connection closed')
+        got += n
+    return buf
+
+
+def send_message(sock, header, arrays=()):
+    '''Send a framed message with a JSON header and binary array payloads.
+
+    Parameters
+    ----------
+    sock : socket
+        Send the message on this socket.
+    header : dict
+        JSON-serializable header for the message.
+    arrays : sequence of ndarray, optional
+        Arrays to send after the header. Their dtypes and shapes are recorded
+        in the "arrays" field of the header.
+    '''
+    arrays = [np.ascontiguousarray(a) for a in arrays]
+    header = dict(header, arrays=[
+        dict(dtype=a.dtype.str, shape=a.shape) for a in arrays])
+    head = json.dumps(header).encode('utf-8')
+    sock.sendall(struct.pack('>I', len(head)) + head)
+    for a in arrays:
+        sock.sendall(memoryview(a.reshape(-1).view(np.uint8)))
+
+
+def recv_message(sock):
+    '''Receive a framed message sent by :func:`send_message`.
+
+    Returns
+    -------
+    header : dict
+        The decoded JSON header.
+    arrays : list of ndarray
+        Arrays sent along with the header.
+    '''
+    size, = struct.unpack('>I', bytes(_recv_exactly(sock, 4)))
+    header = json.loads(bytes(_recv_exactly(sock, size)).decode('utf-8'))
+    arrays = []
+    for spec in header.pop('arrays', ()):
+        dtype = np.dtype(spec['dtype'])
+        shape = tuple(spec['shape'])
+        nbytes = dtype.itemsize * int(np.prod(shape))
+        arrays.append(np.frombuffer(
+            _recv_exactly(sock, nbytes), dtype).reshape(shape))
+    return header, arrays
+
+
+def get_array(world, name):
+    '''Get a named array from a world.
+
+    Parameters
+    ----------
+    world : :class:`pagoda.physics.World`
+        The world to query.
+    name : str
+        One of "states" (see :func:`pagoda.physics.World.get_state_array`),
+        "joint_angles", "joint_velocities", "joint_torques" (for worlds with a
+        skeleton) or "marker_distances" (for worlds with markers).
+
+    Returns
+    -------
+    array : ndarray
+        The requested array.
+    '''
+    if name == 'states':
+        return world.get_state_array()
+    if name in ('joint_angles', 'joint_velocities', 'joint_torques'):
+        return np.asarray(getattr(world.skeleton, name), float)
+    if name == 'marker_distances':
+        return world.markers.distances()
+    raise KeyError('unknown array {}'.format(name))
+
+
+def set_array(world, name, value):
+    '''Set a named array on a world.
+
+    Parameters
+    ----------
+    world : :class:`pagoda.physics.World`
+        The world to update.
+    name : str
+        One of "states" (see :func:`pagoda.physics.World.set_state_array`),
+        "target_angles" (see :func:`pagoda.skeleton.Skeleton.set_target_angles`)
+        or "torques" (added to the skeleton before the next step; see
+        :func:`pagoda.skeleton.Skeleton.add_torques`).
+    value : ndarray
+        The value to set.
+    '''
+    if name == 'states':
+        world.set_state_array(value)
+    elif name == 'target_angles':
+        world.skeleton.set_target_angles(value)
+    elif name == 'torques':
+        world.skeleton.add_torques(value)
+    else:
+        raise KeyError('unknown array {}'.format(name))
+
+
+class Handler(socketserver.BaseRequestHandler):
+    '''Run batches of commands from one client connection.'''
+
+    def handle(self):
+        while True:
+            try:
+                header, arrays = recv_message(self.request)
+            except EOFError:
+                return
+            try:
+                results, out = self.server.pagoda.run(
+                    header['commands'], arrays)
+                send_message(self.request, dict(results=results), out)
+            except Exception as err:
+                logging.exception('error running batch')
+                send_message(self.request, dict(error=str(err)))
+
+
+class _TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+if hasattr(socketserver, 'UnixStreamServer'):
+    class _UnixServer(socketserver.ThreadingMixIn,
+                      socketserver.UnixStreamServer):
+        daemon_threads = True
+
+
+class Server(object):
+    '''Serve batched step requests for a set of named worlds.
+
+    Parameters
+    ----------
+    worlds : dict
+        A mapping from names to the :class:`pagoda.physics.World` objects to
+        host.
+    address : str or (host, port) tuple
+        Listen on a Unix socket at this path, or on this TCP address. TCP
+        servers should normally bind to "localhost".
+
+    Attributes
+    ----------
+    address : str or (host, port) tuple
+        The address where the server is listening.
+    '''
+
+    def __init__(self, worlds, address):
+        self.worlds = dict(worlds)
+        self._lock = threading.Lock()
+        cls = _UnixServer if isinstance(address, str) else _TCPServer
+        self._server = cls(address, Handler)
+        self._server.pagoda = self
+        self.address = self._server.server_address
+
+    def run(self, commands, arrays):
+        '''Run a batch of commands.
+
+        Each command is a dictionary with an "op" key:
+
+        - ``{"op": "worlds"}`` returns the names of the hosted worlds.
+        - ``{"op": "set", "world": W, "name": N, "array": I}`` sets array
+          N (see :func:`set_array`) on world W to the I'th array sent with the
+          batch.
+        - ``{"op": "step", "world": W, "frames": N}`` steps world W forward N
+          frames and returns its frame number.
+        - ``{"op": "get", "world": W, "names": [N, ...]}`` returns the named
+          arrays (see :func:`get_array`) from world W.
+
+        Commands run in order while holding the server lock, so a batch sees a
+        consistent world even when several clients are connected.
+
+        Parameters
+        ----------
+        commands : list of dict
+            Commands to run.
+        arrays : list of ndarray
+            Arrays referenced by "set" commands.
+
+        Returns
+        -------
+        results : list
+            One JSON-serializable result for each command. Results for "get"
+            commands map names to indices into ``out``.
+        out : list of ndarray
+            Arrays returned by "get" commands.
+        '''
+        results = []
+        out = []
+        with self._lock:
+            for cmd in commands:
+                op = cmd['op']
+                if op == 'worlds':
+                    results.append(sorted(self.worlds))
+                    continue
+                world = self.worlds[cmd['world']]
+                if op == 'set':
+                    set_array(world, cmd['name'], arrays[cmd['array']])
+                    results.append(None)
+                elif op == 'step':
+                    for _ in range(cmd.get('frames', 1)):
+                        world.step()
+                    results.append(world.frame_no)
+                elif op == 'get':
+                    idx = {}
+                    for name in cmd['names']:
+                        idx[name] = len(out)
+                        out.append(get_array(world, name))
+                    results.append(idx)
+                else:
+                    raise ValueError('unknown op {}'.format(op))
+        return results, out
+
+    def serve_forever(self):
+        '''Handle client requests until :func:`shutdown` is called.'''
+        logging.info('serving %s on %s', sorted(self.worlds), self.address)
+        self._server.serve_forever()
+
+    def shutdown(self):
+        '''Stop serving and close the listening socket.'''
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class Batch(object):
+    '''A batch of commands to send to a :class:`Server` in one round trip.
+
+    Batches are normally created by calling :func:`Client.batch`.
+    '''
+
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+        self.arrays = []
+
+    def set(self, world, **arrays):
+        '''Set named arrays on a world; see :func:`set_array`.'''
+        for name, value in sorted(arrays.items()):
+            self.commands.append(dict(
+                op='set', world=world, name=name, array=len(self.arrays)))
+            self.arrays.append(np.asarray(value, float))
+        return self
+
+    def step(self, world, frames=1):
+        '''Step a world forward some number of frames.'''
+        self.commands.append(dict(op='step', world=world, frames=frames))
+        return self
+
+    def get(self, world, *names):
+        '''Get named arrays from a world; see :func:`get_array`.'''
+        self.commands.append(dict(op='get', world=world, names=names))
+        return self
+
+    def run(self):
+        '''Send the batch and wait for the results.
+
+        Returns
+        -------
+        results : list
+            One result for each command in the batch. "set" commands give None,
+            "step" commands give the world's frame number, and "get" commands
+            give a dictionary mapping names to arrays.
+        '''
+        return self.client.call(self.commands, self.arrays)
+
+
+class Client(object):
+    '''Send batched commands to a :class:`Server`.
+
+    Connections are kept in a pool and reused, so a client can be shared by
+    several threads; each call borrows one connection for its round trip.
+
+    Parameters
+    ----------
+    address : str or (host, port) tuple
+        Address of the server: a Unix socket path or a TCP address.
+    size : int, optional
+        Maximum number of idle connections to keep open. Defaults to 4.
+    '''
+
+    def __init__(self, address, size=4):
+        self.address = address
+        self._idle = queue.LifoQueue(size)
+
+    def _connect(self):
+        if isinstance(self.address, str):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.connect(self.address)
+        return sock
+
+    def call(self, commands, arrays=()):
+        '''Send one batch of commands and return the results.
+
+        See :func:`Server.run` for the command format.
+        '''
+        try:
+            sock = self._idle.get_nowait()
+        except queue.Empty:
+            sock = self._connect()
+        try:
+            send_message(sock, dict(commands=commands), arrays)
+            header, out = recv_message(sock)
+        except Exception:
+            sock.close()
+            raise
+        try:
+            self._idle.put_nowait(sock)
+        except queue.Full:
+            sock.close()
+        if 'error' in header:
+            raise RuntimeError(header['error'])
+        results = header['results']
+        for cmd, i in zip(commands, range(len(results))):
+            if cmd['op'] == 'get':
+                results[i] = dict(
+                    (name, out[j]) for name, j in results[i].items())
+        return results
+
+    def batch(self):
+        '''Start a new :class:`Batch` of commands for this client.'''
+        return Batch(self)
+
+    def worlds(self):
+        '''Get the names of the worlds hosted by the server.'''
+        return self.call([dict(op='worlds')])[0]
+
+    def close(self):
+        '''Close all idle connections.'''
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
@@ -0,0 +1,241 @@
+'''Share simulation state with other processes through memory-mapped rings.
+
+A :class:`StateRing` holds the most recent frames of world state in a fixed
+number of slots of a memory-mapped file. It is a :class:`pagoda.physics.Hook`:
+added to a world's hooks, it publishes one frame after every step, however the
+world is stepped, by writing body states (and, optionally, joint angles and torques)
+directly into the next slot; any number of :class:`StateReader` objects in other
+processes can map the same file read-only and look at published frames without
+copying or unpickling anything.
+
+Every published frame gets a sequence number. A slot's sequence number is set
+to -1 while the slot is being written, so readers can detect frames that were
+overwritten while they were looking at them by checking :func:`StateReader.valid`
+after they are done with a frame.
+'''
+
+from __future__ import division
+
+import json
+import numpy as np
+import os
+import tempfile
+
+from . import physics
+
+# bytes reserved at the start of a ring file for JSON metadata.
+HEADER_SIZE = 4096
+
+
+def _default_filename(suffix='.ring'):
+    '''Pick a filename for a new ring, preferring a RAM-backed filesystem.'''
+    root = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    fd, filename = tempfile.mkstemp(prefix='pagoda-', suffix=suffix, dir=root)
+    os.close(fd)
+    return filename
+
+
+class _Layout(object):
+    '''Memory-mapped arrays for the slots of a ring file.'''
+
+    def __init__(self, filename, meta, mode):
+        offset = HEADER_SIZE
+        for name, dtype, shape in _Layout.shapes(meta):
+            arr = np.memmap(filename, dtype, mode, offset, shape)
+            setattr(self, name, arr)
+            offset += arr.nbytes
+
+    @staticmethod
+    def shapes(meta):
+        '''List the name, dtype and shape of each array in a ring file.'''
+        slots = meta['slots']
+        dofs = meta['dofs']
+        shapes = [
+            ('latest', np.int64, (1, )),
+            ('seqs', np.int64, (slots, )),
+            ('frame_nos', np.int64, (slots, )),
+            ('states', np.float64,
+             (slots, len(meta['bodies']), physics.STATE_WIDTH)),
+        ]
+        if meta['angles']:
+            shapes.append(('angles', np.float64, (slots, dofs)))
+        if meta['torques']:
+            shapes.append(('torques', np.float64, (slots, dofs)))
+        return shapes
+
+    @staticmethod
+    def size(meta):
+        '''Total size in bytes of a ring file.'''
+        return HEADER_SIZE + sum(
+            np.dtype(dtype).itemsize * int(np.prod(shape))
+            for _, dtype, shape in _Layout.shapes(meta))
+
+
+class StateRing(physics.Hook):
+    '''Publish world states into a memory-mapped ring buffer.
+
+    Add the ring to :attr:`pagoda.physics.World.hooks` to publish a frame after
+    each step of the world, or call :func:`publish` directly.
+
+    Parameters
+    ----------
+    world : :class:`pagoda.physics.World`
+        Publish body states from this world.
+    filename : str, optional
+        Create the ring in this file. Defaults to a new file in ``/dev/shm``
+        (or the system temporary directory if that does not exist).
+    slots : int, optional
+        Number of frames retained in the ring. Defaults to 64.
+    bodies : sequence of :class:`pagoda.physics.Body`, optional
+        Publish states for these bodies. Defaults to all bodies in the world.
+    skeleton : :class:`pagoda.skeleton.Skeleton`, optional
+        If given, also publish joint angles for this skeleton.
+    torques : bool, optional
+        If True, also publish joint torques for ``skeleton``. This requires
+        feedback to be enabled on the skeleton's motors. Defaults to False.
+    every : int, optional
+        As a hook, publish only on steps whose frame number is a multiple of
+        this value. Defaults to 1.
+    '''
+
+    def __init__(self, world, filename=None, slots=64, bodies=None,
+                 skeleton=None, torques=False, every=1):
+        super(StateRing, self).__init__(every)
+        self.world = world
+        self.bodies = list(world.bodies if bodies is None else bodies)
+        self.skeleton = skeleton
+        self.filename = filename or _default_filename()
+        self.seq = -1
+
+        self.meta = dict(
+            slots=slots,
+            bodies=[b.name for b in self.bodies],
+            dofs=skeleton.num_dofs if skeleton else 0,
+            angles=skeleton is not None,
+            torques=skeleton is not None and bool(torques),
+        )
+        header = json.dumps(self.meta).encode('utf-8')
+        assert len(header) < HEADER_SIZE, 'too many bodies for ring header'
+        with open(self.filename, 'wb') as handle:
+            handle.write(header)
+            handle.truncate(_Layout.size(self.meta))
+        self._layout = _Layout(self.filename, self.meta, 'r+')
+        self._layout.latest[0] = -1
+        self._layout.seqs[:] = -1
+
+    def publish(self):
+        '''Write the current world state into the next slot of the ring.
+
+        Returns
+        -------
+        seq : int
+            The sequence number of the published frame.
+        '''
+        layout = self._layout
+        seq = self.seq + 1
+        slot = seq % self.meta['slots']
+        layout.seqs[slot] = -1
+        layout.frame_nos[slot] = self.world.frame_no
+        self.world.get_state_array(self.bodies, out=layout.states[slot])
+        if self.meta['angles']:
+            layout.angles[slot] = self.skeleton.joint_angles
+        if self.meta['torques']:
+            layout.torques[slot] = self.skeleton.joint_torques
+        layout.seqs[slot] = seq
+        layout.latest[0] = seq
+        self.seq = seq
+        return seq
+
+    def post_step(self, world, states):
+        self.publish()
+
+    def close(self, unlink=True):
+        '''Stop publishing, and remove the ring file if ``unlink`` is True.'''
+        self._layout = None
+        if unlink and os.path.exists(self.filename):
+            os.unlink(self.filename)
+
+
+class StateReader(object):
+    '''Attach read-only to a :class:`StateRing` published by another process.
+
+    Parameters
+    ----------
+    filename : str
+        The file backing a ring; see :attr:`StateRing.filename`.
+
+    Attributes
+    ----------
+    bodies : list of str
+        Names of the bodies whose states are published, in storage order.
+    slots : int
+        Number of frames retained in the ring.
+    '''
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as handle:
+            header = handle.read(HEADER_SIZE).rstrip(b'\x00')
+        self.meta = json.loads(header.decode('utf-8'))
+        self.bodies = self.meta['bodies']
+        self.slots = self.meta['slots']
+        self._layout = _Layout(filename, self.meta, 'r')
+        self._last = -1
+
+    @property
+    def latest(self):
+        '''Sequence number of the most recently published frame, or -1.'''
+        return int(self._layout.latest[0])
+
+    def valid(self, seq):
+        '''Return True iff the frame ``seq`` is still held in the ring.'''
+        return seq >= 0 and int(self._layout.seqs[seq % self.slots]) == seq
+
+    def frame(self, seq):
+        '''Get views of the data for one published frame.
+
+        The returned arrays are views into the shared ring; they will be
+        overwritten once the publisher wraps around. Call :func:`valid` after
+        using them to make sure the data were not replaced in the meantime.
+
+        Parameters
+        ----------
+        seq : int
+            Sequence number of the frame to get.
+
+        Returns
+        -------
+        frame : dict
+            A dictionary containing the "frame_no" of the world and views of
+            the "states" for each body, plus "angles" and "torques" if these
+            are published. Returns None if the frame is no longer in the ring.
+        '''
+        if not self.valid(seq):
+            return None
+        slot = seq % self.slots
+        layout = self._layout
+        frame = dict(seq=seq,
+                     frame_no=int(layout.frame_nos[slot]),
+                     states=layout.states[slot])
+        if self.meta['angles']:
+            frame['angles'] = layout.angles[slot]
+        if self.meta['torques']:
+            frame['torques'] = layout.torques[slot]
+        return frame
+
+    def poll(self):
+        '''Iterate over frames published since the previous call to poll.
+
+        Frames that were overwritten before we got to them are skipped.
+
+        Returns
+        -------
+        frames : sequence of dict
+            A generator of frames; see :func:`frame`.
+        '''
+        latest = self.latest
+        first = max(self._last + 1, latest - self.slots + 1)
+        for seq in range(first, latest + 1):
+            frame = self.frame(seq)
+            if frame is not None:
+                yield frame
+        self._last = max(self._last, latest)
@@ -1,5 +1,7 @@
 '''Articulated "skeleton" class and associated helper functions.'''
 
+import hashlib
+import json
 import logging
 import numpy as np
 import ode
@@ -99,6 +101,10 @@ class Skeleton:
 
     joints : list of :class:`pagoda.physics.Joint`
         A list of the joints that connect bodies in this skeleton.
+
+    pid_params : (tuple, dict)
+        The positional and keyword arguments last passed to
+        :func:`set_pid_params`.
     '''
 
     def __init__(self, world):
@@ -107,6 +113,15 @@ class Skeleton:
 
         self.bodies = []
         self.joints = []
+        self.pid_params = (), {}
+
+        # hash of the loaded skeleton structure; see digest.
+        self._digest = None
+
+        # ODE max-force parameters for all motors; see set_max_forces.
+        self._fmax_params = None, []
+        # ODE torque functions for all motors; see add_torques.
+        self._torque_adders = None, []
 
     def load(self, source, **kwargs):
         '''Load a skeleton definition from a file.
@@ -142,6 +157,7 @@ class Skeleton:
         self.bodies = p.bodies
         self.joints = p.joints
         self.set_pid_params(kp=0.999 / self.world.dt)
+        self._digest = self._structure_digest()
 
     def load_asf(self, source, **kwargs):
         '''Load a skeleton definition from an ASF text file.
@@ -160,16 +176,27 @@ class Skeleton:
         self.bodies = p.bodies
         self.joints = p.joints
         self.set_pid_params(kp=0.999 / self.world.dt)
+        self._digest = self._structure_digest()
 
     def set_pid_params(self, *args, **kwargs):
         '''Set PID parameters for all joints in the skeleton.
 
         Parameters for this method are passed directly to the `pid` constructor.
         '''
+        self.pid_params = args, kwargs
         for joint in self.joints:
             joint.target_angles = [None] * joint.ADOF
             joint.controllers = [pid(*args, **kwargs) for i in range(joint.ADOF)]
 
+    def reset_controllers(self):
+        '''Clear the integral and derivative state of all PID controllers.
+
+        Controllers are created again with the current :attr:`pid_params`, so
+        that later control signals do not depend on earlier errors.
+        '''
+        args, kwargs = self.pid_params
+        self.set_pid_params(*args, **kwargs)
+
     @property
     def color(self):
         return getattr(self.bodies[0], 'color', (1, 0, 0, 1))
@@ -184,6 +211,16 @@ class Skeleton:
         '''Return the number of degrees of freedom in the skeleton.'''
         return sum(j.ADOF for j in self.joints)
 
+    @property
+    def dof_labels(self):
+        '''Get a label for each degree of freedom in the skeleton.
+
+        Labels have the form "joint-name:N" for the Nth angular degree of
+        freedom of a joint, in the same order as :func:`joint_angles`.
+        '''
+        return ['{}:{}'.format(j.name, i)
+                for j in self.joints for i in range(j.ADOF)]
+
     @property
     def joint_angles(self):
         '''Get a list of all current joint angles in the skeleton.'''
@@ -281,6 +318,36 @@ class Skeleton:
                 return list(range(j * step, (j + 1) * step))
         return []
 
+    def digest(self):
+        '''Get a hash that identifies the structure of this skeleton.
+
+        The hash covers the names, shapes, sizes, masses and initial poses of
+        the bodies, and the names, types and initial anchors of the joints. It
+        is computed when the skeleton is loaded, so it does not change as the
+        skeleton moves.
+
+        Returns
+        -------
+        digest : str
+            Hex digest of the skeleton structure.
+        '''
+        if self._digest is None:
+            self._digest = self._structure_digest()
+        return self._digest
+
+    def _structure_digest(self):
+        '''Hash the current structure and pose of the skeleton.'''
+        def r(values):
+            # adding zero turns -0.0 into 0.0, so signs of zero don't matter.
+            return (np.round(np.asarray(values, float), 6) + 0.).tolist()
+        parts = [[b.__class__.__name__, b.name, r(b.dimensions),
+                  r(b.mass.mass), r(b.position), r(b.quaternion)]
+                 for b in self.bodies]
+        parts.extend([j.__class__.__name__, j.name, j.ADOF, r(j.anchor)]
+                     for j in self.joints)
+        text = json.dumps(parts, sort_keys=True)
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
     def joint_distances(self):
         '''Get the current joint separations for the skeleton.
 
@@ -345,6 +412,32 @@ class Skeleton:
         '''
         self.enable_motors(0)
 
+    def set_max_forces(self, max_force):
+        '''Set the maximum force for all joint motors, leaving feedback alone.
+
+        This is a cheaper way than :func:`enable_motors` and
+        :func:`disable_motors` to switch motors on and off every frame: the
+        list of ODE parameters to update is computed once and then reused.
+
+        Parameters
+        ----------
+        max_force : float
+            The maximum force that each joint is allowed to apply to attain its
+            target velocity. Use 0 to switch motors off.
+        '''
+        joints, params = self._fmax_params
+        if joints is not self.joints:
+            params = []
+            for joint in self.joints:
+                amotor = getattr(joint, 'amotor', joint)
+                dof = amotor.ADOF + amotor.LDOF
+                for s in ['', '2', '3'][:dof]:
+                    params.append((amotor.ode_obj.setParam,
+                                   getattr(ode, 'ParamFMax' + s)))
+            self._fmax_params = self.joints, params
+        for set_param, param in params:
+            set_param(param, max_force)
+
     def set_target_angles(self, angles):
         '''Move each joint toward a target angle.
 
@@ -380,8 +473,17 @@ class Skeleton:
             A list of the torques to add to each degree of freedom in the
             skeleton.
         '''
-        j = 0
-        for joint in self.joints:
-            joint.add_torques(
-                list(torques[j:j+joint.ADOF]) + [0] * (3 - joint.ADOF))
-            j += joint.ADOF
+        joints, adders = self._torque_adders
+        if joints is not self.joints:
+            adders = []
+            j = 0
+            for joint in self.joints:
+                amotor = getattr(joint, 'amotor', joint)
+                if joint.ADOF > 0 and amotor is not None:
+                    adders.append((amotor.ode_obj.addTorques, j, joint.ADOF))
+                j += joint.ADOF
+            self._torque_adders = self.joints, adders
+        if isinstance(torques, np.ndarray):
+            torques = torques.tolist()
+        for add, j, dof in adders:
+            add(*(list(torques[j:j+dof]) + [0] * (3 - dof)))
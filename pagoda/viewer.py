@@ -100,6 +100,10 @@ class Viewer(window.Window):
             self.draw_body(body)
 
         if hasattr(self.world, 'markers'):
+            # marker bodies are not part of the world's list of bodies.
+            for body in self.world.markers.bodies.values():
+                self.draw_body(body)
+
             # draw line between anchor1 and anchor2 for marker joints.
             window.glColor4f(0.9, 0.1, 0.1, 0.9)
             window.glLineWidth(3)
@@ -0,0 +1,63 @@
+import numpy as np
+import os
+import pagoda
+import pagoda.archive
+import pytest
+
+
+@pytest.fixture
+def recorded(world, tmpdir):
+    world.create_body('box', lengths=(1, 1, 1)).position = 0, 0, 2
+    world.create_body('sphere', radius=0.5).position = 2, 0, 3
+    filename = str(tmpdir.join('trial.pga'))
+    expected = []
+    with pagoda.archive.Writer(filename, world, chunk_frames=16) as writer:
+        for _ in range(50):
+            world.step()
+            writer.append()
+            expected.append(world.get_state_array())
+    return filename, np.array(expected)
+
+
+def close(actual, expected, cols=slice(None)):
+    # values are quantized to half a step of the default precision.
+    steps = pagoda.archive._steps(pagoda.archive.DEFAULT_PRECISION)[cols]
+    return (abs(actual - expected) <= 0.5001 * steps).all()
+
+
+def test_roundtrip(recorded):
+    filename, expected = recorded
+    with pagoda.archive.Reader(filename) as reader:
+        assert len(reader) == 50
+        assert reader.bodies == ['box0', 'sphere0']
+        assert close(reader.read(), expected)
+
+
+def test_window(recorded):
+    filename, expected = recorded
+    with pagoda.archive.Reader(filename) as reader:
+        window = reader.read(10, 40)
+        assert window.shape == (30, 2, 13)
+        assert close(window, expected[10:40])
+        assert close(reader[45], expected[45])
+
+
+def test_field(recorded):
+    filename, expected = recorded
+    with pagoda.archive.Reader(filename) as reader:
+        quat = reader.read(17, 20, field='quaternion')
+        assert quat.shape == (3, 2, 4)
+        assert close(quat, expected[17:20, :, 3:7], slice(3, 7))
+
+
+def test_size(world, tmpdir):
+    world.create_body('box', lengths=(1, 1, 1)).position = 0, 0, 2
+    world.create_body('sphere', radius=0.5).position = 2, 0, 3
+    filename = str(tmpdir.join('trial.pga'))
+    raw = 0
+    with pagoda.archive.Writer(filename, world) as writer:
+        for _ in range(600):
+            world.step()
+            writer.append()
+            raw += world.get_state_array().nbytes
+    assert os.path.getsize(filename) * 5 < raw
@@ -0,0 +1,44 @@
+from conftest import fn
+import numpy as np
+import pagoda
+import pagoda.cache
+import pytest
+
+
+@pytest.fixture
+def cache(tmpdir):
+    return pagoda.cache.Cache(str(tmpdir.join('cache')))
+
+
+def test_put_get(cache):
+    key = cache.key('test', 1, dict(a=2))
+    assert cache.get(key) == (None, None)
+    cache.put(key, dict(x=np.arange(10)), dict(label='foo'))
+    arrays, meta = cache.get(key)
+    assert np.array_equal(arrays['x'], np.arange(10))
+    assert meta == dict(label='foo')
+
+
+def test_key(cache):
+    digest = cache.digest(fn('cooper-markers.txt'))
+    assert digest == cache.digest(fn('cooper-markers.txt'))
+    assert cache.key(digest, 1) != cache.key(digest, 2)
+
+
+def test_evict(cache):
+    cache.max_bytes = 1
+    cache.put('a', dict(x=np.zeros(100)))
+    cache.put('b', dict(x=np.zeros(100)))
+    assert [path for _, _, path in cache.entries()] == [cache.root + '/b']
+
+
+def test_cached_markers(cache):
+    world = pagoda.cooper.World()
+    markers = pagoda.cooper.Markers(world)
+    markers.load_c3d(fn('cooper-motion.c3d'), cache=cache)
+    data = markers.data.copy()
+    markers = pagoda.cooper.Markers(world)
+    markers.load_c3d(fn('cooper-motion.c3d'), cache=cache)
+    assert isinstance(markers.data, np.memmap)
+    assert np.array_equal(markers.data, data)
+    assert len(markers.channels) == 41
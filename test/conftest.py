@@ -1,4 +1,5 @@
 import pagoda
+import pagoda.parallel
 import pytest
 
 
@@ -23,3 +24,10 @@ def cooper(request):
     world.load_markers(fn('cooper-motion.c3d'), fn('cooper-markers.txt'))
     request.addfinalizer(lambda: world.skeleton.disable_motors())
     return world
+
+
+@pytest.fixture
+def factory():
+    return pagoda.parallel.WorldFactory(
+        fn('cooper-skeleton.txt'), fn('cooper-motion.c3d'),
+        fn('cooper-markers.txt'), marker_settings=dict(cfms=1e-3))
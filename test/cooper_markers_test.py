@@ -1,4 +1,6 @@
+import collections
 from conftest import fn
+import numpy as np
 import pagoda
 import pytest
 
@@ -12,7 +14,7 @@ def markers():
 def test_c3d(markers):
     markers.load_c3d(fn('cooper-motion.c3d'))
     assert markers.num_frames == 343
-    assert len(markers.bodies) == 41
+    assert len(markers.bodies) == 0
     assert len(markers.targets) == 0
     assert len(markers.offsets) == 0
     assert len(markers.channels) == 41
@@ -22,7 +24,7 @@ def test_csv(markers):
     return  # TODO
     markers.load_csv(fn('cooper-motion.csv'))
     assert markers.num_frames == 343
-    assert len(markers.bodies) == 41
+    assert len(markers.bodies) == 0
     assert len(markers.targets) == 0
     assert len(markers.offsets) == 0
     assert len(markers.channels) == 41
@@ -38,3 +40,186 @@ def test_load_attachments(world):
 
     assert len(markers.targets) == 41
     assert len(markers.offsets) == 41
+    assert len(markers.bodies) == 41
+    assert not any(b.name.startswith('marker:') for b in world.bodies)
+
+
+@pytest.mark.parametrize('estimator', ['central', 'savgol', 'spline'])
+def test_process_data(markers, estimator):
+    markers.load_c3d(fn('cooper-motion.c3d'))
+    markers.process_data(estimator, accelerations=True)
+    assert markers.velocities.shape == markers.positions.shape
+    assert markers.accelerations.shape == markers.positions.shape
+    valid = markers.velocities != markers.INVALID_VELOCITY
+    assert valid.any()
+    assert np.isfinite(markers.accelerations[valid]).any()
+
+
+def test_c3d_window(markers, tmpdir):
+    markers.load_c3d(fn('cooper-motion.c3d'))
+    full = markers.data.copy()
+    markers.load_c3d(fn('cooper-motion.c3d'), start_frame=10, end_frame=50,
+                     dtype='f', mmap=str(tmpdir.join('markers.npy')))
+    assert markers.num_frames == 40
+    assert markers.data.dtype == np.float32
+    assert np.allclose(markers.data, full[10:50], atol=1e-5)
+    assert markers.positions.shape == (40, 41, 3)
+
+
+def test_c3d_max_frames(markers):
+    markers.load_c3d(fn('cooper-motion.c3d'), start_frame=5, max_frames=20)
+    assert markers.num_frames == 20
+
+
+def write_csv(filename, frames, dt=1. / 60):
+    labels = ['m{}'.format(i) for i in range(frames.shape[1])]
+    with open(filename, 'w') as handle:
+        handle.write(','.join(['time'] + [
+            'marker{:02d}-{}-{}'.format(i, l, a)
+            for i, l in enumerate(labels) for a in 'xyzc']) + '\n')
+        for t, frame in enumerate(frames):
+            handle.write(','.join(['{}'.format(t * dt)] + [
+                '{}'.format(x) for x in frame.ravel()]) + '\n')
+
+
+def test_csv_sidecar(markers, tmpdir):
+    frames = np.random.rand(30, 3, 4)
+    filename = str(tmpdir.join('motion.csv'))
+    write_csv(filename, frames)
+    markers.load_csv(filename, start_frame=5, max_frames=20)
+    assert markers.num_frames == 20
+    assert len(markers.channels) == 3
+    assert np.allclose(markers.data[:, :, [0, 2, 1, 3]], frames[5:25])
+    assert tmpdir.join('motion.csv.npy').check()
+    markers.load_csv(filename, start_frame=0)
+    assert markers.num_frames == 30
+    assert np.allclose(markers.data[:, :, [0, 2, 1, 3]], frames)
+
+
+def test_csv_sidecar_copy_on_write(markers, tmpdir):
+    frames = np.random.rand(30, 3, 4)
+    filename = str(tmpdir.join('motion.csv'))
+    write_csv(filename, frames)
+    markers.load_csv(filename, start_frame=0)
+    markers.data[...] = 0
+    markers.load_csv(filename, start_frame=0)
+    assert np.allclose(markers.data[:, :, [0, 2, 1, 3]], frames)
+
+
+def test_csv_frame_rate(markers, tmpdir):
+    filename = str(tmpdir.join('motion.csv'))
+    write_csv(filename, np.random.rand(30, 3, 4), dt=1. / 120)
+    with pytest.raises(ValueError):
+        markers.load_csv(filename)
+
+
+def test_csv_resample(markers, tmpdir):
+    frames = np.random.rand(31, 3, 4)
+    filename = str(tmpdir.join('motion.csv'))
+    write_csv(filename, frames, dt=1. / 120)
+    markers.load_csv(filename, start_frame=0, resample=True)
+    assert markers.num_frames == 16
+    assert np.allclose(markers.dt, markers.world.dt)
+    assert np.allclose(markers.data[:, :, [0, 2, 1, 3]], frames[::2])
+
+
+def test_resample_dropouts(markers):
+    data = np.zeros((9, 2, 4))
+    data[:, :, 0] = np.arange(9)[:, None]
+    data[3, 0, 3] = -1
+    markers.data = data
+    markers.dt = markers.world.dt
+    markers.resample(rate=2 / markers.world.dt)
+    assert markers.num_frames == 17
+    assert np.allclose(markers.positions[:, 1, 0], np.arange(17) / 2)
+    assert list(np.where(markers.visibility[:, 0] < 0)[0]) == [5, 6, 7]
+    assert (markers.visibility[:, 1] == 0).all()
+    # positions advance one unit per source frame, i.e. 1 / world.dt per second.
+    assert np.allclose(markers.velocities[1:-1, 1, 0], 1 / markers.world.dt)
+
+
+@pytest.mark.parametrize('method', ['linear', 'cubic'])
+def test_fill_gaps(markers, method):
+    data = np.zeros((30, 2, 4))
+    data[:, :, 0] = np.arange(30)[:, None]
+    data[10:14, 0] = -1
+    data[5:25, 1, 3] = -1
+    markers.data = data
+    markers.fill_gaps(max_gap=5, method=method)
+    assert np.allclose(markers.positions[:, 0, 0], np.arange(30))
+    assert markers.filled[:, 0].sum() == 4
+    assert not markers.filled[:, 1].any()
+    assert (markers.visibility[:, 0] == 0).all()
+    assert (markers.velocities[1:-1, 0] != markers.INVALID_VELOCITY).all()
+
+
+def test_fill_gaps_memmap(markers, tmpdir):
+    filename = str(tmpdir.join('data.npy'))
+    data = np.lib.format.open_memmap(filename, 'w+', float, (30, 2, 4))
+    data[:, :, 0] = np.arange(30)[:, None]
+    data[10:14, 0, 3] = -1
+    markers.data = data
+    markers.dt = markers.world.dt
+    markers.fill_gaps(clusters=False)
+    assert (markers.visibility[10:14, 0] == 0).all()
+    assert (np.load(filename)[10:14, 0, 3] == -1).all()
+
+
+def test_fill_gaps_clusters(markers):
+    Body = collections.namedtuple('Body', 'name')
+    rng = np.random.RandomState(0)
+    angles = np.linspace(0, 2, 40)
+    cos, sin = np.cos(angles), np.sin(angles)
+    local = rng.randn(4, 3)
+    data = np.zeros((40, 4, 4))
+    data[:, :, 0] = cos[:, None] * local[:, 0] - sin[:, None] * local[:, 1]
+    data[:, :, 1] = sin[:, None] * local[:, 0] + cos[:, None] * local[:, 1]
+    data[:, :, 2] = local[:, 2] + angles[:, None]
+    truth = data.copy()
+    data[20:25, 0] = -1
+    markers.data = data
+    markers.channels = dict(('m{}'.format(i), i) for i in range(4))
+    markers.targets = dict((c, Body('body')) for c in markers.channels)
+    markers.fill_gaps()
+    assert markers.filled.sum() == 5
+    assert np.allclose(markers.positions, truth[:, :, :3])
+
+
+def test_compute_attachable(markers):
+    data = np.zeros((20, 3, 4))
+    data[:, 1, 0] = np.arange(20) * 0.01
+    data[:, 2, 0] = np.arange(20) * 1.
+    data[5:8, 0, 3] = -1
+    data[10, 1, 3] = 5
+    markers.data = data
+    markers.process_data()
+    assert markers.attachable.shape == (20, 3)
+    assert list(markers.attachable.sum(axis=0)) == [13, 18, 0]
+    markers.compute_attachable(max_velocity=100, max_residual=1)
+    assert list(markers.attachable.sum(axis=0)) == [13, 17, 18]
+    markers.erp = 0.5
+    assert (markers.erps == 0.5).all()
+
+
+def test_compute_attachable_overrides(markers):
+    data = np.zeros((30, 2, 4))
+    data[:, :, 0] = np.arange(30)[:, None] * 0.01
+    data[10:14, 0, 3] = -1
+    markers.data = data
+    markers.process_data()
+    markers.cfms[:] = 1e-4
+    markers.erps[:, 1] = 0.1
+    markers.fill_gaps(max_gap=5)
+    assert (markers.cfms == 1e-4).all()
+    assert (markers.erps[:, 1] == 0.1).all()
+    markers.compute_attachable(filled_cfm=1e-2)
+    assert (markers.cfms[markers.filled] == 1e-2).all()
+    assert (markers.cfms[~markers.filled] == 1e-4).all()
+    markers.resample(rate=30)
+    assert (markers.cfms == markers.DEFAULT_CFM).all()
+    assert (markers.erps == markers.erp).all()
+
+
+def test_unique_labels():
+    labels = pagoda.cooper._unique_labels(['a', '', 'b', 'a', 'a-3', ''])
+    assert labels == ['a', 'point-1', 'b', 'a-3', 'a-3-4', 'point-5']
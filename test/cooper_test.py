@@ -1,4 +1,7 @@
+import logging
+import numpy as np
 import pagoda
+import pagoda.cache
 import pytest
 
 
@@ -26,12 +29,283 @@ def test_settle_to_markers(cooper):
     assert st100 != st200
 
 
+def test_skeleton_labels(cooper):
+    labels = cooper.skeleton.dof_labels
+    assert len(labels) == cooper.skeleton.num_dofs
+    joint = cooper.skeleton.joints[0]
+    idx = cooper.skeleton.indices_for_joint(joint.name)
+    assert [labels[i] for i in idx] == [
+        '{}:{}'.format(joint.name, i) for i in range(joint.ADOF)]
+
+
+def test_skeleton_digest(cooper):
+    digest = cooper.skeleton.digest()
+    cooper.settle_to_markers(100)
+    assert cooper.skeleton.digest() == digest
+    other = pagoda.cooper.World()
+    other.load_skeleton('examples/cooper-skeleton.txt')
+    assert other.skeleton.digest() == digest
+
+
+def test_settle_to_markers_plateau(cooper, caplog):
+    with caplog.at_level(logging.DEBUG):
+        cooper.settle_to_markers(100, max_distance=0, min_improvement=1,
+                                 patience=2)
+    steps = [r for r in caplog.records
+             if r.getMessage().startswith('settling to frame')]
+    assert len(steps) == 3
+
+
+def test_settle_to_markers_warm_start(cooper):
+    st000 = cooper.skeleton.get_body_states()
+    st100 = cooper.settle_to_markers(100)
+    cooper.skeleton.set_body_states(st000)
+    warm = cooper.settle_to_markers(110, max_iters=0, warm_start=True)
+    assert np.allclose([s.position for s in warm],
+                       [s.position for s in st100])
+    cooper.skeleton.set_body_states(st000)
+    cold = cooper.settle_to_markers(110, max_iters=0)
+    assert np.allclose([s.position for s in cold],
+                       [s.position for s in st000])
+
+
+def test_settle_to_markers_new_skeleton(cooper):
+    cooper.settle_to_markers(100)
+    cooper.load_skeleton('examples/cooper-skeleton.txt')
+    st000 = cooper.skeleton.get_body_states()
+    warm = cooper.settle_to_markers(110, max_iters=0, warm_start=True)
+    assert np.allclose([s.position for s in warm],
+                       [s.position for s in st000])
+
+
+def test_settle_to_markers_align(cooper):
+    markers = cooper.markers
+    frame = 100
+    labels = [l for l in markers.targets
+              if markers.attachable[frame, markers.channels[l]]]
+
+    def error():
+        return np.mean([np.linalg.norm(
+            markers.targets[l].body_to_world(markers.offsets[l]) -
+            markers.positions[frame, markers.channels[l]]) for l in labels])
+
+    before = error()
+    cooper.settle_to_markers(frame, max_iters=0, align=True)
+    assert error() < before
+
+
 def test_inverse_kinematics(cooper):
     angles = list(cooper.inverse_kinematics(10))
     assert len(angles) == cooper.markers.num_frames - 10
 
 
+def test_inverse_kinematics_cache(cooper, tmpdir):
+    cache = pagoda.cache.Cache(str(tmpdir.join('cache')))
+    bodies = cooper.skeleton.bodies
+    initial = cooper.get_state_array(bodies)
+    first, residuals = [], []
+    for angles in cooper.inverse_kinematics(10, 40, cache=cache):
+        first.append(np.array(angles))
+        residuals.append(cooper.markers.distances().copy())
+    first = np.array(first)
+    final = cooper.get_state_array(bodies)
+    assert first.shape == (30, cooper.skeleton.num_dofs)
+    assert len(cache.entries()) == 1
+
+    cooper.set_state_array(initial, bodies)
+    second, replayed = [], []
+    for angles in cooper.inverse_kinematics(10, 40, cache=cache):
+        second.append(np.array(angles))
+        replayed.append(cooper.markers.distances().copy())
+    assert np.allclose(first, second)
+    assert np.allclose(residuals, replayed, equal_nan=True)
+    assert np.allclose(final, cooper.get_state_array(bodies))
+    assert len(cache.entries()) == 1
+
+    cooper.set_state_array(initial, bodies)
+    list(cooper.inverse_kinematics(10, 40, max_force=10, cache=cache))
+    assert len(cache.entries()) == 2
+
+
+def test_multirate_inverse_kinematics(cooper):
+    initial = cooper.skeleton.get_body_states()
+    dense = np.array(list(cooper.inverse_kinematics(10, 50)))
+    dt = cooper.dt
+    cfms = cooper.markers.cfms.copy()
+    pid_params = cooper.skeleton.pid_params
+    angles, states = cooper.multirate_inverse_kinematics(
+        10, 50, states=initial, decimation=4)
+    assert angles.shape == dense.shape
+    assert states.shape == (40, len(cooper.skeleton.bodies), 13)
+    assert np.allclose(np.linalg.norm(states[:, :, 3:7], axis=-1), 1)
+    error = pagoda.cooper._wrap_angles(angles - dense)
+    assert np.sqrt((error ** 2).mean()) < 0.1
+    assert cooper.dt == dt
+    assert np.array_equal(cooper.markers.cfms, cfms)
+    assert cooper.skeleton.pid_params == pid_params
+
+
+def test_multirate_inverse_kinematics_dense(cooper):
+    initial = cooper.skeleton.get_body_states()
+    dense = np.array(list(cooper.inverse_kinematics(10, 30)))
+    angles, _ = cooper.multirate_inverse_kinematics(
+        10, 30, states=initial, decimation=1)
+    assert np.allclose(angles, dense, atol=1e-6)
+
+
+def test_settle_to_markers_cache(cooper, tmpdir):
+    cache = pagoda.cache.Cache(str(tmpdir.join('cache')))
+    bodies = cooper.skeleton.bodies
+    initial = cooper.get_state_array(bodies)
+    first = cooper.settle_to_markers(100, cache=cache)
+    cooper.set_state_array(initial, bodies)
+    cooper.settle_to_markers(120)
+    second = cooper.settle_to_markers(100, cache=cache)
+    assert len(cache.entries()) == 1
+    assert np.allclose([s.position for s in first],
+                       [s.position for s in second])
+
+    # a cache hit is used as a warm start.
+    cooper.load_skeleton('examples/cooper-skeleton.txt')
+    cooper.settle_to_markers(100, cache=cache)
+    warm = cooper.settle_to_markers(110, max_iters=0, warm_start=True)
+    assert np.allclose([s.position for s in first],
+                       [s.position for s in warm])
+
+
 def test_inverse_dynamics(cooper):
     angles = list(cooper.inverse_kinematics(10))
     torques = list(cooper.inverse_dynamics(angles))
     assert len(torques) == len(angles)
+
+
+@pytest.mark.parametrize('mode', ['onestep', 'twostep'])
+def test_inverse_dynamics_stop_early(cooper, mode):
+    angles = list(cooper.inverse_kinematics(10, 20))
+    torques = cooper.inverse_dynamics(angles, mode=mode)
+    next(torques)
+    torques.close()
+    for joint in cooper.skeleton.joints:
+        amotor = getattr(joint, 'amotor', joint)
+        assert not any(amotor.max_forces)
+
+
+def test_stats(cooper):
+    cooper.stats.enabled = True
+    angles = list(cooper.inverse_kinematics(10, 20))
+    assert cooper.stats.steps == 10
+    list(cooper.inverse_dynamics(angles))
+    assert cooper.stats.steps == 20
+    assert cooper.stats.pairs == 0
+    assert cooper.stats.snapshot()['solver_time']['max'] > 0
+
+
+class Counter(pagoda.physics.Hook):
+    def __init__(self):
+        super(Counter, self).__init__()
+        self.stages = []
+
+    def pre_step(self, world, states):
+        self.stages.append('pre_step')
+
+    def post_step(self, world, states):
+        self.stages.append('post_step')
+
+
+def test_hooks(cooper):
+    counter = Counter()
+    cooper.hooks.append(counter)
+    angles = list(cooper.inverse_kinematics(10, 15))
+    assert counter.stages == ['pre_step', 'post_step'] * 5
+    list(cooper.inverse_dynamics(angles))
+    assert len(counter.stages) == 20
+
+
+def test_marker_joints_persist(cooper):
+    markers = cooper.markers
+    markers.attach(0)
+    joints = dict(markers._joints)
+    assert len(joints) == len(markers.targets)
+    assert 0 < len(markers.joints) <= len(joints)
+    assert all(j.isEnabled() for j in markers.joints.values())
+    markers.detach()
+    assert not markers.joints
+    markers.attach(1)
+    assert all(markers._joints[k] is j for k, j in joints.items())
+
+
+def test_marker_set_offsets(cooper):
+    markers = cooper.markers
+    markers.attach(0)
+    label = sorted(markers.targets)[0]
+    joint = markers._joints[label]
+    markers.set_offsets({label: (0.01, 0, 0)})
+    assert np.allclose(markers.offsets[label], (0.01, 0, 0))
+    markers.attach(1)
+    assert markers._joints[label] is not joint
+    assert np.allclose(markers._joints[label].getAnchor2(),
+                       markers.targets[label].body_to_world((0.01, 0, 0)))
+
+
+def test_marker_forces(cooper):
+    markers = cooper.markers
+    for i, _ in enumerate(cooper.follow_markers(0, 3)):
+        dx = markers.distances()
+        assert dx is markers.distances()
+        assert dx.shape == (len(markers.channels), 3)
+        F = markers.forces()
+        assert F.shape == dx.shape
+        assert np.isfinite(F).any()
+
+
+def test_marker_forces_previous_distances(cooper):
+    markers = cooper.markers
+    prev = saved = None
+    for i, _ in enumerate(cooper.follow_markers(0, 5)):
+        if prev is not None:
+            F = markers.forces(prev).copy()
+            assert np.allclose(F, markers.forces(saved), equal_nan=True)
+        prev = markers.distances()
+        saved = prev.copy()
+
+
+def test_follow_markers_states(cooper):
+    bodies = cooper.skeleton.bodies
+    out = np.zeros((5, len(bodies), 13))
+    held = list(cooper.follow_markers(0, 5, snap=True, out=out))
+    assert len(held) == 5
+    assert np.allclose(held[-1].array, out[4])
+    assert held[0][0].name == bodies[0].name
+    lazy = list(cooper.follow_markers(5, 7))
+    with pytest.raises(RuntimeError):
+        lazy[0][0]
+
+
+@pytest.mark.parametrize('mode', ['onestep', 'twostep'])
+def test_inverse_dynamics_mode(cooper, mode):
+    angles = list(cooper.inverse_kinematics(10, 30))
+    torques = list(cooper.inverse_dynamics(angles, mode=mode))
+    assert len(torques) == len(angles)
+
+
+def test_compare_inverse_dynamics(cooper):
+    angles = list(cooper.inverse_kinematics(10, 30))
+    bodies = cooper.skeleton.bodies
+    before = cooper.get_state_array(bodies)
+    report = cooper.compare_inverse_dynamics(angles)
+    assert report['rms'] >= 0
+    assert report['speedup'] > 0
+    assert np.allclose(cooper.get_state_array(bodies), before)
+
+
+def test_forward_dynamics(cooper):
+    angles = list(cooper.inverse_kinematics(10, 30))
+    bodies = cooper.skeleton.bodies
+    start = cooper.get_state_array(bodies)
+    torques = np.array(list(cooper.inverse_dynamics(angles)))
+    out = np.zeros((len(torques), cooper.skeleton.num_dofs))
+    fd_angles, fd_states = cooper.forward_dynamics(
+        torques, end=10, states=start, angles_out=out)
+    assert fd_angles is out
+    assert np.isfinite(out[:10]).all()
+    assert fd_states.shape == (10, len(bodies), 13)
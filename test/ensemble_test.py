@@ -0,0 +1,58 @@
+import numpy as np
+import pagoda.ensemble
+import pytest
+
+
+def test_noise_model():
+    noise = pagoda.ensemble.NoiseModel(
+        jitter=0.01, offset_jitter=0.005, dropout=0.1, dropout_frames=5)
+    data = np.zeros((5000, 4, 4))
+    data[:, :, 3] = 1
+    offsets = dict(a=np.zeros(3))
+    out, moved = noise.perturb(data, offsets, np.random.RandomState(3))
+    assert (data[:, :, :3] == 0).all()
+    assert abs(out[:, :, :3].std() - 0.01) < 0.001
+    assert abs((out[:, :, 3] < 0).mean() - 0.1) < 0.02
+    assert moved['a'].shape == (3, )
+    again, _ = noise.perturb(data, offsets, np.random.RandomState(3))
+    assert np.array_equal(out, again)
+
+
+def test_moments():
+    values = np.random.RandomState(11).randn(50, 3, 2)
+    moments = pagoda.ensemble.Moments((3, 2))
+    for v in values:
+        moments.update(v)
+    assert moments.count == 50
+    assert np.allclose(moments.mean, values.mean(axis=0))
+    assert np.allclose(moments.variance, values.var(axis=0, ddof=1))
+
+
+@pytest.mark.parametrize('p', [0.05, 0.5, 0.95])
+def test_quantile(p):
+    values = np.random.RandomState(13).randn(2000, 3)
+    quantile = pagoda.ensemble.Quantile(p, (3, ))
+    for v in values[:4]:
+        quantile.update(v)
+    assert np.allclose(quantile.value,
+                       np.percentile(values[:4], 100 * p, axis=0))
+    for v in values[4:]:
+        quantile.update(v)
+    assert np.allclose(quantile.value,
+                       np.percentile(values, 100 * p, axis=0), atol=0.15)
+
+
+def test_inverse_dynamics(factory):
+    noise = pagoda.ensemble.NoiseModel(jitter=0.002, dropout=0.01)
+    kw = dict(replicas=3, start=10, end=30, seed=7, max_iters=20,
+              quantiles=(0.5, ))
+    summary = pagoda.ensemble.inverse_dynamics(
+        factory, noise, processes=1, **kw)
+    dofs = factory().skeleton.num_dofs
+    assert summary['count'] == 3
+    assert summary['mean'].shape == (20, dofs)
+    assert summary['std'].shape == (20, dofs)
+    assert sorted(summary['quantiles']) == [0.5]
+    again = pagoda.ensemble.inverse_dynamics(
+        factory, noise, processes=2, **kw)
+    assert np.allclose(summary['mean'], again['mean'])
@@ -0,0 +1,72 @@
+import numpy as np
+import os
+import pagoda.parallel
+import pytest
+
+
+def test_windows():
+    assert pagoda.parallel.windows(10, 35, 10, 4) == [
+        (10, 10, 20), (16, 20, 30), (26, 30, 35)]
+
+
+def test_factory(factory):
+    world = factory()
+    assert world.markers.num_frames == 343
+    assert (world.markers.cfms == 1e-3).all()
+
+
+def test_inverse_kinematics(factory):
+    kw = dict(start=10, end=90, window=30, overlap=10, max_iters=20)
+    angles, seams = pagoda.parallel.inverse_kinematics(
+        factory, processes=1, **kw)
+    assert angles.shape == (80, factory().skeleton.num_dofs)
+    assert [s['frame'] for s in seams] == [40, 70]
+    again, _ = pagoda.parallel.inverse_kinematics(factory, processes=2, **kw)
+    assert np.allclose(angles, again)
+
+
+def test_inverse_kinematics_pid_state(factory):
+    factory.pid_params = dict(kp=50, ki=5, kd=0.01)
+    kw = dict(start=10, end=90, window=30, overlap=10, max_iters=20)
+    angles, _ = pagoda.parallel.inverse_kinematics(factory, processes=1, **kw)
+    again, _ = pagoda.parallel.inverse_kinematics(factory, processes=2, **kw)
+    assert np.allclose(angles, again)
+
+
+def test_pipeline(factory):
+    frames = list(pagoda.parallel.pipeline(factory, 10, 40, slots=4,
+                                           max_iters=20))
+    assert [f for f, _, _ in frames] == list(range(10, 40))
+
+    world = factory()
+    world.settle_to_markers(10, 0.05, 20)
+    pose = world.get_state_array(world.skeleton.bodies)
+    angles = [np.array(a) for a in world.inverse_kinematics(10, 40)]
+    world = factory()
+    world.set_state_array(pose, world.skeleton.bodies)
+    torques = list(world.inverse_dynamics(angles))
+    assert np.allclose([a for _, a, _ in frames], angles)
+    assert np.allclose([t for _, _, t in frames], torques)
+
+
+class Exit(object):
+    def __call__(self):
+        os._exit(3)
+
+
+def test_pipeline_child_exits(factory):
+    with pytest.raises(RuntimeError):
+        list(pagoda.parallel.pipeline(Exit(), 10, 40, id_factory=factory))
+
+
+def test_forward_dynamics(factory):
+    world = factory()
+    bodies = world.skeleton.bodies
+    states = world.get_state_array(bodies)
+    torques = np.random.randn(3, 10, world.skeleton.num_dofs)
+    angles, out = pagoda.parallel.forward_dynamics(
+        factory, torques, states, processes=2)
+    assert angles.shape == (3, 10, world.skeleton.num_dofs)
+    assert out.shape == (3, 10, len(bodies), 13)
+    again, _ = world.forward_dynamics(torques[1], states=states)
+    assert np.allclose(angles[1], again)
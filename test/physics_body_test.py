@@ -123,3 +123,11 @@ def test_world_to_body(box):
     assert np.allclose(box.world_to_body((1, 2, 3)), (1, 2, 3))
     box.quaternion = 0, 1, 0, 1
     assert np.allclose(box.world_to_body((3, -2, 1)), (1, 2, 3))
+
+
+def test_collide():
+    world = pagoda.physics.World()
+    a = world.create_body('sphere', radius=1)
+    b = world.create_body('sphere', radius=1, collide=False)
+    assert world.ode_space.query(a.ode_geom)
+    assert not world.ode_space.query(b.ode_geom)
@@ -1,3 +1,4 @@
+import numpy as np
 import pagoda
 import pytest
 
@@ -48,6 +49,19 @@ def test_body_states(world):
         ('box0', (1, 2, 3), (1, 0, 0, 0), (3, -1, 2), (0, 0, 0))]
 
 
+def test_lazy_states(world):
+    b = world.create_body('box', lengths=(1, 1, 1))
+    b.position = 1, 2, 3
+    states = pagoda.physics.LazyStates(world, [b])
+    assert states == [b.state]
+    states.expire()
+    assert np.allclose(states.array[0, :3], (1, 2, 3))
+    states = pagoda.physics.LazyStates(world, [b])
+    states.expire()
+    with pytest.raises(RuntimeError):
+        states[0]
+
+
 def test_are_connected(world):
     box = world.create_body('box', lengths=(1, 1, 1))
     cap = world.create_body('cap', length=1, radius=0.1)
@@ -64,3 +78,64 @@ def test_on_collision(world):
     assert not world.are_connected('box0', 'cap0')
     world.on_collision(None, box.ode_geom, cap.ode_geom)
     assert world.are_connected('box0', 'cap0')
+
+
+def test_stats_disabled(world):
+    world.create_body('box', lengths=(1, 1, 1))
+    world.step()
+    assert world.stats.steps == 0
+
+
+def test_stats(world):
+    world.stats.enabled = True
+    box = world.create_body('box', lengths=(1, 1, 1))
+    box.position = 0, 0, 0.45
+    for _ in range(5):
+        world.step()
+    snap = world.stats.snapshot()
+    assert snap['steps'] == 5
+    assert snap['pairs']['max'] > 0
+    assert snap['contacts']['max'] > 0
+    # two substeps, each clearing contacts, colliding and solving.
+    assert snap['ode_calls']['min'] >= 6 + snap['contacts']['min']
+    assert snap['step_time']['mean'] > 0
+    counts, edges = world.stats.histogram('solver_time', bins=3)
+    assert counts.sum() == 5
+    world.stats.reset()
+    assert world.stats.snapshot()['steps'] == 0
+
+
+class Counter(pagoda.physics.Hook):
+    def __init__(self, every=1):
+        super(Counter, self).__init__(every)
+        self.calls = []
+
+    def pre_collide(self, world, states):
+        self.calls.append(('pre_collide', world.frame_no))
+
+    def post_step(self, world, states):
+        self.calls.append(('post_step', world.frame_no))
+
+
+class AntiGravity(pagoda.physics.Hook):
+    def pre_step(self, world, states):
+        masses = [b.mass.mass for b in world.bodies]
+        return dict(force=np.outer(masses, [0, 0, 9.81]))
+
+
+def test_hook_order(world):
+    counter = Counter(every=2)
+    world.hooks.append(counter)
+    for _ in range(4):
+        world.step()
+    assert counter.calls == [('pre_collide', 2), ('post_step', 2),
+                             ('pre_collide', 4), ('post_step', 4)]
+
+
+def test_hook_forces(world):
+    box = world.create_body('box', lengths=(1, 1, 1))
+    box.position = 0, 0, 10
+    world.hooks.append(AntiGravity())
+    for _ in range(10):
+        world.step()
+    assert np.allclose(box.position, (0, 0, 10))
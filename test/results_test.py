@@ -0,0 +1,66 @@
+import numpy as np
+import pagoda
+import pagoda.results
+import pytest
+
+
+@pytest.fixture
+def stored(cooper, tmpdir):
+    root = str(tmpdir.join('results'))
+    seen = []
+
+    def frames():
+        # remember the state that record() sees for each frame; the world
+        # steps once more after the last frame.
+        for angles in cooper.inverse_kinematics(10, 60):
+            seen.append(cooper.get_state_array(cooper.skeleton.bodies))
+            yield angles
+
+    with pagoda.results.Writer(root, cooper, params=dict(max_force=20),
+                               chunk_frames=16) as writer:
+        count = writer.record(frames(), 'angles', residuals=True, states=True)
+    assert count == 50
+    return root, np.array(seen)
+
+
+def test_meta(cooper, stored):
+    reader = pagoda.results.Reader(stored[0])
+    assert reader.groups == ['angles', 'residuals', 'states']
+    assert reader.dt == cooper.dt
+    assert reader.skeleton == cooper.skeleton.digest()
+    assert reader.params == dict(max_force=20)
+    assert reader.labels('angles') == cooper.skeleton.dof_labels
+    assert reader.labels('residuals') == list(cooper.markers.labels)
+
+
+def test_shapes(cooper, stored):
+    reader = pagoda.results.Reader(stored[0])
+    dofs = cooper.skeleton.num_dofs
+    assert reader['angles'].shape == (50, dofs)
+    assert reader['residuals'].shape == (50, len(cooper.markers.labels), 3)
+    assert reader['states'].shape == (50, len(cooper.skeleton.bodies), 13)
+    assert np.allclose(reader['states'], stored[1])
+
+
+def test_get(cooper, stored):
+    reader = pagoda.results.Reader(stored[0])
+    joint = [j for j in cooper.skeleton.joints if j.ADOF > 1][0]
+    idx = cooper.skeleton.indices_for_joint(joint.name)
+    angles = reader['angles']
+    assert np.array_equal(reader.get('angles', joint.name),
+                          angles[:, idx[0]:idx[-1] + 1])
+    column = reader.get('angles', '{}:1'.format(joint.name))
+    assert np.array_equal(column, angles[:, idx[1]])
+    assert column.base is not None
+    with pytest.raises(KeyError):
+        reader.get('angles', 'no-such-joint')
+
+
+def test_partial(cooper, tmpdir):
+    root = str(tmpdir.join('results'))
+    writer = pagoda.results.Writer(root, cooper, chunk_frames=4)
+    for _ in range(6):
+        writer.append(torques=np.zeros(cooper.skeleton.num_dofs))
+    assert pagoda.results.Reader(root).num_frames('torques') == 4
+    writer.close()
+    assert pagoda.results.Reader(root).num_frames('torques') == 6
@@ -0,0 +1,41 @@
+import numpy as np
+import pagoda
+import pagoda.server
+import pytest
+import threading
+
+
+@pytest.fixture
+def client(world, request):
+    world.create_body('box', lengths=(1, 1, 1)).position = 0, 0, 2
+    server = pagoda.server.Server(dict(w=world), ('localhost', 0))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    client = pagoda.server.Client(server.address)
+    def done():
+        client.close()
+        server.shutdown()
+    request.addfinalizer(done)
+    return client
+
+
+def test_worlds(client):
+    assert client.worlds() == ['w']
+
+
+def test_batch(client, world):
+    states = world.get_state_array()
+    states[0, 2] = 5
+    results = client.batch().set('w', states=states).get('w', 'states') \
+                    .step('w', frames=3).run()
+    assert results[0] is None
+    assert np.allclose(results[1]['states'], states)
+    assert results[2] == 3
+    assert world.frame_no == 3
+
+
+def test_error(client):
+    with pytest.raises(RuntimeError):
+        client.batch().get('w', 'unknown').run()
+    assert client.worlds() == ['w']
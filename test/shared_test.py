@@ -0,0 +1,49 @@
+import numpy as np
+import pagoda
+import pagoda.shared
+import pytest
+
+
+@pytest.fixture
+def ring(world, tmpdir):
+    world.create_body('box', lengths=(1, 1, 1)).position = 0, 0, 2
+    ring = pagoda.shared.StateRing(
+        world, filename=str(tmpdir.join('states.ring')), slots=4)
+    world.hooks.append(ring)
+    return ring
+
+
+def test_publish(world, ring):
+    reader = pagoda.shared.StateReader(ring.filename)
+    assert reader.latest == -1
+    assert reader.bodies == ['box0']
+    world.step()
+    assert reader.latest == 0
+    frame = reader.frame(0)
+    assert frame['frame_no'] == 1
+    assert np.allclose(frame['states'], world.get_state_array())
+
+
+def test_wraparound(world, ring):
+    reader = pagoda.shared.StateReader(ring.filename)
+    for _ in range(6):
+        world.step()
+    assert not reader.valid(1)
+    assert reader.valid(5)
+    assert [f['frame_no'] for f in reader.poll()] == [3, 4, 5, 6]
+    world.step()
+    assert [f['frame_no'] for f in reader.poll()] == [7]
+
+
+def test_publish_from_cooper(cooper, tmpdir):
+    ring = pagoda.shared.StateRing(
+        cooper, filename=str(tmpdir.join('states.ring')), slots=4,
+        bodies=cooper.skeleton.bodies, skeleton=cooper.skeleton)
+    cooper.hooks.append(ring)
+    reader = pagoda.shared.StateReader(ring.filename)
+    list(cooper.inverse_kinematics(10, 15))
+    assert reader.latest == 4
+    frame = reader.frame(4)
+    bodies = cooper.skeleton.bodies
+    assert np.allclose(frame['states'], cooper.get_state_array(bodies))
+    assert np.allclose(frame['angles'], cooper.skeleton.joint_angles)